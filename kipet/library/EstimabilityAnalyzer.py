@@ -53,6 +53,15 @@ class EstimabilityAnalyzer(ParameterEstimator):
             
             tee (bool,optional): flag to tell the optimizer whether to stream output
             to the terminal or not
+
+            backend (str,optional): 'k_aug' (default) solves the NLP and runs k_aug in dsdp mode.
+            'casadi' integrates the model with the forward sensitivities of the CasADi integrator
+            instead (no NLP, no k_aug and no files). It gives the rows of the concentrations only
+            and is not available with spectral data
+
+            builder (TemplateBuilder,optional): the template of the model (required by the casadi backend)
+
+            integrator (str,optional): 'cvodes' or 'idas' for the casadi backend
             
         Returns:
             dsdp (numpy matrix):  sensitivity matrix with columns being parameters and rows the Z vars
@@ -64,6 +73,17 @@ class EstimabilityAnalyzer(ParameterEstimator):
         sigma_sq = kwds.pop('sigmasq', dict())
         tee = kwds.pop('tee', False)
         species_list = kwds.pop('subset_components', None)
+        backend = kwds.pop('backend', 'k_aug')
+        builder = kwds.pop('builder', None)
+        integrator = kwds.pop('integrator', None)
+
+        if backend not in ['k_aug', 'casadi']:
+            raise RuntimeError('The sensitivity backend must be k_aug or casadi')
+        if backend == 'casadi' and builder is None:
+            raise RuntimeError('The casadi backend needs the TemplateBuilder of the model (builder keyword)')
+        if backend == 'casadi' and self._spectra_given:
+            # k_aug also returns the rows of S at the optimum, the casadi backend only dZ/dP
+            raise RuntimeError('The casadi backend only supports concentration data, use k_aug with spectral data')
 
         list_components = []
         if species_list is None:
@@ -92,6 +112,13 @@ class EstimabilityAnalyzer(ParameterEstimator):
         if not all_sigma_specified:
             raise RuntimeError(
                 'All variances must be specified to determine sensitivities.\n Please pass variance dictionary to run_opt')
+
+        if backend == 'casadi':
+            from kipet.library.casadi_tools import parameter_sensitivities
+            dsdp, parameter_names = parameter_sensitivities(self.model, builder, self._allmeas_times,
+                                                            self._sublist_components, solver=integrator)
+            idx_to_param = dict((i + 1, p) for i, p in enumerate(parameter_names))
+            return dsdp, idx_to_param
         
         m = self.model
 
@@ -214,7 +241,7 @@ class EstimabilityAnalyzer(ParameterEstimator):
         
         return dsdp , idx_to_param
 
-    def rank_params_yao(self, param_scaling = None, meas_scaling = None, sigmas = None):
+    def rank_params_yao(self, param_scaling = None, meas_scaling = None, sigmas = None, backend = 'k_aug', builder = None):
         """This function ranks parameters in the method described in Yao (2003) by obtaining the 
         sensitivities related to the parameters in the model through solving the original NLP model 
         for concentrations, getting the sensitivities relating to each paramater, and then using 
@@ -231,6 +258,11 @@ class EstimabilityAnalyzer(ParameterEstimator):
         manufacturer or general knowledge of process
         
         sigmasq (dict): map of component name to noise variance. The map also contains the device noise variance.
+
+        backend (str): 'k_aug' or 'casadi', the method used to compute the sensitivities
+        (see get_sensitivities_for_params)
+
+        builder (TemplateBuilder): the template of the model, needed by the casadi backend
         
         returns:
             list with order of parameters
@@ -286,7 +318,8 @@ class EstimabilityAnalyzer(ParameterEstimator):
         # k_aug is used to get the sensitivities. The full model is solved with dummy
         # parameters and variables at the initial values for the parameters
         self.cloned_before_k_aug = self.model.clone()
-        dsdp, idx_to_param = self.get_sensitivities_for_params(tee=True, sigmasq=sigmas)
+        dsdp, idx_to_param = self.get_sensitivities_for_params(tee=True, sigmasq=sigmas, backend=backend,
+                                                               builder=builder)
         # print("idx_to_param",idx_to_param )
         nvars = np.size(dsdp,0)
         #print("nvars,", nvars)
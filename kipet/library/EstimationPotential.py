@@ -13,13 +13,14 @@ import warnings
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from scipy.sparse import coo_matrix
-from scipy.sparse.linalg import spsolve
+from scipy.sparse import csc_matrix, csr_matrix, identity, vstack
+from scipy.sparse.linalg import splu
 
 from pyomo.environ import (
     Objective,
     SolverFactory,
     Suffix,
+    value,
     )
 
 from kipet.library.ParameterEstimator import ParameterEstimator
@@ -591,19 +592,60 @@ class EstimationPotential(ParameterEstimator):
             self.rh_model_builder.add_complementary_states_data(pd.DataFrame(fake_data[comp_state_headers]))
     
         self.rh_model = self.rh_model_builder.create_pyomo_model(self.start_time, self.end_time) 
+        self._setup_reduced_hessian_model()
         self._run_simulation()
      
         return None
     
+    def _setup_reduced_hessian_model(self):
+        """Discretizes the reduced hessian model and adds the objective and
+        suffixes once. The same model is then reused for every reduced
+        hessian calculation in the estimate loop - only the parameter bounds,
+        fixings and the simulated data change between the stages.
+        
+        Args:
+            None
+                
+        Returns:
+            None
+            
+        """
+        rh_sim = PyomoSimulator(self.rh_model)
+        rh_sim.apply_discretization('dae.collocation',
+                                    ncp = self.ncp,
+                                    nfe = self.nfe,
+                                    scheme = 'LAGRANGE-RADAU')
+        
+        self.rh_model.objective = self._rule_objective(self.rh_model, self.rh_model_builder)
+        self._prep_model_for_optimization(self.rh_model)
+        self._simulation_cache = {}
+        self._reduced_hessian_cache = {}
+        
+        return None
+    
+    def _simulation_key(self):
+        """Returns a hashable key for the current scaled parameter values
+        (model.K) of the reduced hessian model. The simulation only depends on
+        these values since the parameters P are fixed to one.
+        
+        Args:
+            None
+                
+        Returns:
+            key (tuple): The rounded values of K in parameter order
+            
+        """
+        return tuple(float('%.12g' % value(self.rh_model.K[k])) for k in self.rh_model.parameter_names)
+    
     def _run_simulation(self):
         """You need to run the simulation of the model to get data equal to 
         the current parameter set. The opt will be zero, but the reduced
         hessian should be correct.
         
-        TODO:
-            I think this needs to be changed - there must be an easier way
-            (Abstract model?) than by generating a new Concrete model each time
-            the reduced hessian needs to be calculated.
+        The simulation is performed on the reduced hessian model itself with
+        the objective deactivated and the parameters fixed. The results are
+        memoized by the values of K, so parameter sets that are revisited by
+        the Se/Sf loop do not need another simulation.
         
         Args:
             None
@@ -612,59 +654,39 @@ class EstimationPotential(ParameterEstimator):
             None
             
         """
-        print('*'*20 + ' Running Simulation ' + '*'*20)
-        
-        rh_model_builder = copy.copy(self.rh_model_builder)
-        rh_model = rh_model_builder.create_pyomo_model(self.start_time, self.end_time)
+        sim_vars = ['Z', 'dZdt', 'X', 'dXdt', 'Y']
         
-        rh_sim = PyomoSimulator(rh_model)
-            
-        for k, v in rh_sim.model.P.items():
-            rh_sim.model.P[k].fix(1)
-            rh_sim.model.K[k] = self.rh_model.K[k]
-
-        rh_sim.apply_discretization('dae.collocation',
-                                           ncp = self.ncp,
-                                           nfe = self.nfe,
-                                           scheme = 'LAGRANGE-RADAU')
-            
-        results_pyomo = rh_sim.run_sim('ipopt_sens',
-                                          tee=False,
-                                          solver_options={},
-                                          )
-                
-        self.rh_model = rh_model
-        t = np.linspace(self.start_time, self.end_time, self.nfe + 1)
-        t = [round(i, 6) for i in t]
+        for k, v in self.rh_model.P.items():
+            self.rh_model.P[k].fix(1)
         
-        all_data = pd.DataFrame(index=t[1:])
+        key = self._simulation_key()
         
-        if len(self.model_builder._component_names) > 0:
-            Z_data_full = pd.DataFrame(results_pyomo.Z)
-            Z_data_fe = Z_data_full.loc[t, :]
-            Z_data_fe.drop(index=0, inplace=True)
-            all_data = all_data.merge(Z_data_fe, right_index=True, left_index=True)
+        if key in self._simulation_cache:
+            if self.verbose:
+                print('*'*20 + ' Using Stored Simulation ' + '*'*20)
+            for name, values in self._simulation_cache[key].items():
+                getattr(self.rh_model, name).set_values(values)
         
-        if len(self.model_builder._complementary_states) > 0:
-            X_data_full = pd.DataFrame(results_pyomo.X)
-            X_data_fe = X_data_full.loc[t, :]
-            X_data_fe.drop(index=0, inplace=True)
-            all_data = all_data.merge(X_data_fe, right_index=True, left_index=True)
+        else:
+            print('*'*20 + ' Running Simulation ' + '*'*20)
+            
+            self.rh_model.objective.deactivate()
+            ipopt = SolverFactory('ipopt')
+            ipopt.solve(self.rh_model, tee=False)
+            self.rh_model.objective.activate()
+            
+            self._simulation_cache[key] = {name: getattr(self.rh_model, name).get_values() for name in sim_vars}
         
         for data_set in self.model.measured_data.value:
             if data_set in self.model_builder._complementary_states:
-                for fe in all_data.index:
-                    
-                    self.rh_model.U[(fe, data_set)].set_value(float(all_data.loc[fe, data_set]))
-                    self.rh_model.U[(fe, data_set)].fix()
+                for index in self.rh_model.U:
+                    if index[1] == data_set:
+                        self.rh_model.U[index].fix(self.rh_model.X[index].value)
             
             if data_set in self.model_builder._component_names:
-                for fe in all_data.index:
-                    self.rh_model.C[(fe, data_set)].set_value(float(all_data.loc[fe, data_set]))
-                    self.rh_model.C[(fe, data_set)].fix()
-    
-        self.rh_model.objective = self._rule_objective(self.rh_model, self.rh_model_builder)
-        self._prep_model_for_optimization(self.rh_model)
+                for index in self.rh_model.C:
+                    if index[1] == data_set:
+                        self.rh_model.C[index].fix(self.rh_model.Z[index].value)
     
         return None
         
@@ -736,9 +758,15 @@ class EstimationPotential(ParameterEstimator):
         return None
         
     def _calculate_reduced_hessian(self, Se, Sf, verbose=False):
-        """This function solves an optimization with very restrictive bounds
-        on the paramters in order to get the reduced hessian at fixed 
-        conditions
+        """Returns the reduced hessian for the parameters in Se with the
+        parameters in Sf fixed.
+        
+        The reduced hessian with respect to all of the parameters is only
+        calculated once for each operating point (the values of K). Fixing a
+        subset of the parameters removes the corresponding columns from the
+        null space basis, so the reduced hessian for any Se is the principal
+        submatrix of the full reduced hessian and no new solves are needed
+        while the parameter values do not move.
         
         Args:
             Se (list): The current list of estimable parameters.
@@ -751,9 +779,38 @@ class EstimationPotential(ParameterEstimator):
         Returns:
             reduced_hessian (np.ndarray): The resulting reduced hessian matrix.
             
+        """
+        key = self._simulation_key()
+        
+        if key not in self._reduced_hessian_cache:
+            all_params = list(self.rh_model.P.keys())
+            full_hessian = self._calculate_full_reduced_hessian(all_params, verbose=verbose)
+            self._reduced_hessian_cache[key] = (all_params, full_hessian)
+        elif self.verbose:
+            print('*'*20 + ' Using Stored Reduced Hessian ' + '*'*20)
+        
+        all_params, full_hessian = self._reduced_hessian_cache[key]
+        idx = [all_params.index(p) for p in Se]
+        
+        return full_hessian[np.ix_(idx, idx)]
+        
+    def _calculate_full_reduced_hessian(self, Se, verbose=False):
+        """This function solves an optimization with very restrictive bounds
+        on the paramters in order to get the reduced hessian at fixed 
+        conditions
+        
+        Args:
+            Se (list): The list of parameters to include in the reduced
+                hessian (all other parameters are fixed).
+            
+            verbose (bool): Defaults to False, option to show the output from
+                the solver (solver option 'tee').
+            
+        Returns:
+            reduced_hessian (np.ndarray): The resulting reduced hessian matrix.
+            
         """
         delta = 1e-12
-        n_free = len(Se)
         ipopt = SolverFactory('ipopt')
         kaug = SolverFactory('k_aug')
         tmpfile_i = "ipopt_output"
@@ -767,7 +824,7 @@ class EstimationPotential(ParameterEstimator):
             self.rh_model.P[k].setub(ub)
             self.rh_model.P[k].unfix()
         
-        for fixed_param in Sf:
+        for fixed_param in set(self.rh_model.P.keys()).difference(Se):
             self.rh_model.P[fixed_param].fix(1)
         
         self.rh_model.ipopt_zL_in.update(self.rh_model.ipopt_zL_out)
@@ -784,43 +841,59 @@ class EstimationPotential(ParameterEstimator):
         kaug.options["deb_kkt"] = ""  
         kaug.solve(self.rh_model, tee=verbose)
         
-        hess = pd.read_csv('hess_debug.in', delim_whitespace=True, header=None, skipinitialspace=True)
-        hess.columns = ['irow', 'jcol', 'vals']
-        hess.irow -= 1
-        hess.jcol -= 1
+        var_ind = pd.read_csv(col_file, sep = ';', header=None) # dummy sep
+        col_ind = [var_ind.loc[var_ind[0] == f'P[{v}]'].index[0] for v in Se]
         
-        jac = pd.read_csv('jacobi_debug.in', delim_whitespace=True, header=None, skipinitialspace=True)
-        m = jac.iloc[0,0]
-        n = jac.iloc[0,1]
-        jac.drop(index=[0], inplace=True)
-        jac.columns = ['irow', 'jcol', 'vals']
-        jac.irow -= 1
-        jac.jcol -= 1
+        return self._reduced_hessian_from_kkt('hess_debug.in', 'jacobi_debug.in', col_ind)
+    
+    @staticmethod
+    def _reduced_hessian_from_kkt(hess_file, jac_file, col_ind):
+        """Calculates the reduced hessian from the KKT matrix written by k_aug
+        (deb_kkt option) using the null space of the constraint jacobian.
         
-        Jac_coo = coo_matrix((jac.vals, (jac.irow, jac.jcol)), shape=(m, n)) 
-        Hess_coo = coo_matrix((hess.vals, (hess.irow, hess.jcol)), shape=(n, n)) 
-        Jac = Jac_coo.todense()
+        The jacobian is split by columns into the free (parameter) block Jf and
+        the dependent block Jd. The null space basis Z is [I; -Jd^-1 Jf], which
+        is obtained from a single sparse LU factorization of Jd solved against
+        the few free columns. Z and the hessian are kept sparse.
         
-        var_ind = pd.read_csv(col_file, sep = ';', header=None) # dummy sep
-        col_ind = [var_ind.loc[var_ind[0] == f'P[{v}]'].index[0] for v in Se]
+        Args:
+            hess_file (str): The hessian file in coordinate format (1-indexed).
+            
+            jac_file (str): The jacobian file in coordinate format (1-indexed)
+                with the dimensions m and n in the first row.
+                
+            col_ind (list): The column indices of the free variables.
+            
+        Returns:
+            reduced_hessian (np.ndarray): The resulting reduced hessian matrix.
+            
+        """
+        hess = np.loadtxt(hess_file, ndmin=2)
+        jac = np.loadtxt(jac_file, ndmin=2)
+        m, n = int(jac[0, 0]), int(jac[0, 1])
+        jac = jac[1:, :]
         
-        Jac_f = Jac[:, col_ind]
-        Jac_l = np.delete(Jac, col_ind, axis=1)
-        X = spsolve(coo_matrix(np.mat(Jac_l)).tocsc(), coo_matrix(np.mat(-Jac_f)).tocsc())
+        Jac = csc_matrix((jac[:, 2], (jac[:, 0].astype(int) - 1, jac[:, 1].astype(int) - 1)), shape=(m, n))
+        Hess = csr_matrix((hess[:, 2], (hess[:, 0].astype(int) - 1, hess[:, 1].astype(int) - 1)), shape=(n, n))
         
-        col_ind_left = list(set(range(n)).difference(set(col_ind)))
-        col_ind_left.sort()
+        n_free = len(col_ind)
+        is_free = np.zeros(n, dtype=bool)
+        is_free[col_ind] = True
+        col_ind_left = np.flatnonzero(~is_free)
         
-        Z = np.zeros([n, n_free])
-        Z[col_ind, :] = np.eye(n_free)
-        Z[col_ind_left, :] = X.todense()
-    
-        Z_mat = coo_matrix(np.mat(Z)).tocsr()
-        Z_mat_T = coo_matrix(np.mat(Z).T).tocsr()
-        Hess = Hess_coo.tocsr()
-        red_hessian = Z_mat_T * Hess * Z_mat
+        # only the few free columns are densified for the solve
+        Jac_f = Jac[:, col_ind].toarray()
+        Jac_l = Jac[:, col_ind_left]
+        X = splu(Jac_l).solve(-Jac_f)
         
-        return red_hessian.todense()
+        # Z in the order (free, dependent) of the variables
+        order = np.concatenate([np.asarray(col_ind, dtype=int), col_ind_left])
+        Z = vstack([identity(n_free, format='csr'), csr_matrix(X)], format='csr')
+        Hess = Hess[order, :][:, order]
+        
+        red_hessian = (Z.T @ (Hess @ Z)).toarray()
+        
+        return red_hessian
     
     def _parameter_ratios(self, reduced_hessian, Se):
         """This is Eq. 26 from Chen and Biegler 2020 where the ratio of the 
@@ -880,7 +953,6 @@ class EstimationPotential(ParameterEstimator):
             Sf_update (list): The updated list of parameters if Sf.
         
         """
-        eigenvector_tolerance = 1e-15
         parameter_tolerance = 1e-12
         squared_term_1 = 0
         squared_term_2 = 0
@@ -888,33 +960,21 @@ class EstimationPotential(ParameterEstimator):
         Se_update = []
         M = {}
         
-        param_set = set(param_list)
-        param_elim = set()
         eigenvalues, U = np.linalg.eigh(reduced_hessian)
-        
-        df_eigs = pd.DataFrame(np.diag(eigenvalues),
-                    index=param_list,
-                    columns=[i for i, x in enumerate(param_list)])
-        df_U_gj = pd.DataFrame(U,
-                    index=param_list,
-                    columns=[i for i, x in enumerate(param_list)])
+        U = np.array(U, dtype=float)
+        remaining = np.ones(len(param_list), dtype=bool)
         
         # Gauss-Jordan elimination
         for i, p in enumerate(param_list):
             
             # Since they are already ranked, just use the index
-            piv_col = i         #df_eigs[df_eigs.abs() > 1e-20].min().idxmin()
-            piv_row = df_U_gj.loc[:, piv_col].abs().idxmax()
-            piv = (piv_row, piv_col)
-            rows = list(param_set.difference(param_elim))
-            M[i] =  piv_row
-            df_U_gj = self._gauss_jordan_step(df_U_gj, piv, rows)
-            param_elim.add(piv_row)
-            df_eigs.drop(index=[param_list[piv_col]], inplace=True)
-            df_eigs.drop(columns=[piv_col], inplace=True)
+            piv_col = i
+            piv_row = int(np.argmax(np.abs(U[:, piv_col])))
+            M[i] = param_list[piv_row]
+            U = self._gauss_jordan_step(U, (piv_row, piv_col), remaining)
+            remaining[piv_row] = False
 
         # Parameter ranking
-        eigenvalues, eigenvectors = np.linalg.eigh(reduced_hessian)
         ranked_parameters = {k: M[abs(len(M)-1-k)] for k in M.keys()}
         
         for k, v in ranked_parameters.items():
@@ -931,42 +991,29 @@ class EstimationPotential(ParameterEstimator):
         return Se_update, Sf_update
 
     @staticmethod
-    def _gauss_jordan_step(df_U_update, pivot, rows):
+    def _gauss_jordan_step(U, pivot, rows):
         """Perfoms the Gauss-Jordan Elminiation step in W. Chen's method
         
         Args:
-            df_U_update: A pandas DataFrame instance of the U matrix from the
-                eigenvalue decomposition of the reduced hessian (can be obtained
-                through the HessianObject).
+            U (np.ndarray): The U matrix from the eigenvalue decomposition of
+                the reduced hessian (rows are the parameters).
             
-            pivot: The element where to perform the elimination.
+            pivot (tuple): The (row, column) of the element where to perform
+                the elimination.
             
-            rows: A set containing the rows that have already been eliminated.
+            rows (np.ndarray): A boolean mask of the rows that have not yet
+                been eliminated.
             
         Returns:
-            The df_U_update DataFrame is returned after one row is eliminated.
+            U (np.ndarray): The updated U matrix after one row is eliminated.
        
         """
-        if isinstance(pivot, tuple):
-            pivot=dict(r=pivot[0],
-                     c=pivot[1]
-                     )
-
-        uij = df_U_update.loc[pivot['r'], pivot['c']]
-    
-        for col in df_U_update.columns:
-            if col == pivot['c']:
-                continue
-            
-            factor = df_U_update.loc[pivot['r'], col]/uij
-            
-            for row in rows:
-                if row not in rows:
-                    continue
-                else:    
-                    df_U_update.loc[row, col] -= factor*df_U_update.loc[row, pivot['c']]
-                
-        df_U_update[abs(df_U_update) < 1e-15] = 0
-        df_U_update.loc[pivot['r'], pivot['c']] = 1
+        piv_row, piv_col = pivot
+        factor = U[piv_row, :]/U[piv_row, piv_col]
+        factor[piv_col] = 0
+        
+        U[rows, :] -= np.outer(U[rows, piv_col], factor)
+        U[np.abs(U) < 1e-15] = 0
+        U[piv_row, piv_col] = 1
         
-        return df_U_update
\ No newline at end of file
+        return U
@@ -7,6 +7,7 @@ from kipet.library.ResultsObject import *
 from kipet.library.Simulator import *
 from kipet.library.PyomoSimulator import *
 from kipet.library.fe_factory import *
+from kipet.library.timing_tools import timed_phase
 import warnings
 import six
 import sys
@@ -54,7 +55,9 @@ class FESimulator(PyomoSimulator):
             if t[0] == st:
                 self.ics_['X',t[1]] = v.value
 
-    def call_fe_factory(self, inputs_sub=None, jump_states=None, jump_times=None, feed_times=None):#added for inclusion of discrete jumps CS
+    @timed_phase('initialization')
+    def call_fe_factory(self, inputs_sub=None, jump_states=None, jump_times=None, feed_times=None,
+                        multiple_shooting=False, guess=None, n_workers=None):#added for inclusion of discrete jumps CS
         """
         call_fe_factory:
     
@@ -66,6 +69,11 @@ class FESimulator(PyomoSimulator):
                     jump_states (dict): dictionary of which variables and states are inputted and by how much
                     jump_times (dict): dictionary in same form as jump_states with times of input
                     feed_times (list): list of additional times needed, should be the same times as jump_times 
+                    multiple_shooting (bool): solve the elements concurrently in worker processes by multiple
+                        shooting instead of marching forward element by element
+                    guess (dict): guess of the trajectories for multiple shooting, e.g. {'Z': results.Z,
+                        'X': results.X} from a coarse CasadiSimulator run
+                    n_workers (int): number of worker processes for multiple shooting
         """
         #added for inclusion of inputs of different kind CS
         self.inputs_sub=inputs_sub
@@ -84,4 +92,7 @@ class FESimulator(PyomoSimulator):
 
         if jump_times!=None and jump_states!=None:
             init.load_discrete_jump(jump_states, jump_times, feed_times) #added for inclusion of discrete jumps
-        init.run()
+        if multiple_shooting:
+            init.run_multiple_shooting(guess=guess, n_workers=n_workers)
+        else:
+            init.run()
@@ -20,9 +20,29 @@ import copy
 import re
 import os
 from pyomo.opt import ProblemFormat
+from pyomo.core.expr import current as EXPR
+from kipet.library.parallel_tools import parallel_map
 
 __author__ = 'Michael Short'  #: February 2019
 
+class GlobalVariableVisitor(EXPR.ExpressionReplacementVisitor):
+    """Replaces the local variables of an experiment block with the global
+    variables given in the substitution map (id of local var: global var).
+    """
+    def __init__(self, substitution):
+        super(GlobalVariableVisitor, self).__init__()
+        self.substitution = substitution
+
+    def visiting_potential_leaf(self, node):
+
+        if node.__class__ in native_numeric_types:
+            return True, node
+
+        if node.is_variable_type():
+            return True, self.substitution.get(id(node), node)
+
+        return False, None
+
 class MultipleExperimentsEstimator(object):
     """This class is for Estimation of Variances and parameters when we have multiple experimental datasets.
     This class relies heavily on the Pyomo block class as we put each experimental class into its own block.
@@ -1410,6 +1430,239 @@ class MultipleExperimentsEstimator(object):
 
         m.del_component('objective')
         
+    def _add_global_variables(self, m, shared_params, spectra_shared):
+        """Adds one global variable for each shared parameter (and for each
+        S[l, k] if the spectra are shared) and substitutes it directly into the
+        constraints of every experiment block. This is used instead of the
+        linking constraints between consecutive experiments.
+        
+        The local variables are fixed since they no longer appear in the
+        model. Their values are updated from the global variables using
+        _load_global_variables after the solve.
+        
+        Not meant to be used directly by users
+        
+        Args:
+            m (pyomo ConcreteModel): the model with the experiment blocks
+            
+            shared_params (list): the parameters that are shared across blocks
+            
+            spectra_shared (bool): whether the spectra are shared
+            
+        Returns:
+            None
+            
+        """
+        def local_variables(name, index):
+            return [getattr(m.experiment[exp], name)[index] for exp in self.experiments 
+                    if hasattr(m.experiment[exp], name) and index in getattr(m.experiment[exp], name)]
+        
+        def initialize_global_variable(global_var, local_vars):
+            lbs = [v.lb for v in local_vars if v.lb is not None]
+            ubs = [v.ub for v in local_vars if v.ub is not None]
+            values = [v.value for v in local_vars if v.value is not None]
+            global_var.setlb(max(lbs) if lbs else None)
+            global_var.setub(min(ubs) if ubs else None)
+            if values:
+                global_var.set_value(sum(values)/len(values))
+        
+        substitution = dict()
+        m.global_variable_map = list()
+        
+        m.P_global = Var(shared_params)
+        for param in shared_params:
+            local_vars = local_variables('P', param)
+            initialize_global_variable(m.P_global[param], local_vars)
+            for v in local_vars:
+                substitution[id(v)] = m.P_global[param]
+                m.global_variable_map.append((v, m.P_global[param]))
+        
+        if spectra_shared:
+            shared_S = list()
+            for exp in self.experiments:
+                if hasattr(m.experiment[exp], 'S'):
+                    for index in m.experiment[exp].S:
+                        if index not in shared_S:
+                            shared_S.append(index)
+            
+            m.S_global = Var(shared_S)
+            for index in shared_S:
+                local_vars = local_variables('S', index)
+                initialize_global_variable(m.S_global[index], local_vars)
+                for v in local_vars:
+                    substitution[id(v)] = m.S_global[index]
+                    m.global_variable_map.append((v, m.S_global[index]))
+        
+        visitor = GlobalVariableVisitor(substitution)
+        for exp in self.experiments:
+            for con in m.experiment[exp].component_data_objects(Constraint, active=True):
+                body = visitor.dfs_postorder_stack(con.body)
+                if con.equality:
+                    con.set_value(body == con.upper)
+                else:
+                    con.set_value((con.lower, body, con.upper))
+        
+        for local_var, global_var in m.global_variable_map:
+            local_var.fix()
+        
+        return None
+    
+    def _load_global_variables(self, m):
+        """Copies the values of the global variables into the local variables
+        of each experiment block so that the results can be loaded per block.
+        
+        Not meant to be used directly by users
+        """
+        for local_var, global_var in m.global_variable_map:
+            local_var.fix(global_var.value)
+        
+        return None
+    
+    def _solve_decomposition(self, m, shared_params, **kwds):
+        """Solves the multiple experiment problem by decomposition. The
+        experiment blocks are solved independently (in parallel worker
+        processes) and only the shared kinetic parameters are coordinated
+        using a consensus ADMM outer loop:
+            
+            P_e = argmin error_e + y_e (P_e - z) + rho/2 |P_e - z|^2
+            z   = mean_e(P_e + y_e/rho)
+            y_e = y_e + rho (P_e - z)
+            
+        The loop stops when both the primal and the dual residuals are below
+        the tolerance. Each block is warm started from its previous solution.
+        Finally every block is solved with the parameters fixed at z, so that
+        the loaded states match the reported parameters.
+        
+        Not meant to be used directly by users
+        
+        Args:
+            m (pyomo ConcreteModel): the model with the experiment blocks (no
+                linking constraints)
+            
+            shared_params (list): the parameters that are shared across blocks
+            
+            solver_opts (dict, optional): options passed to ipopt
+            
+            n_workers (int, optional): number of worker processes (defaults to
+                the number of available cores)
+            
+            rho (float, optional): ADMM penalty parameter (default 1.0)
+            
+            max_iter (int, optional): maximum number of ADMM iterations
+                (default 100)
+                
+            tol (float, optional): tolerance for the primal and dual residuals
+                (default 1e-6)
+            
+            tee (bool, optional): print the progress of the ADMM loop
+            
+        Returns:
+            None
+            
+        """
+        solver_opts = kwds.pop('solver_opts', dict())
+        n_workers = kwds.pop('n_workers', None)
+        rho = kwds.pop('rho', 1.0)
+        max_iter = kwds.pop('max_iter', 100)
+        tol = kwds.pop('tol', 1e-6)
+        tee = kwds.pop('tee', False)
+        
+        block_params = dict()
+        for exp in self.experiments:
+            b = m.experiment[exp]
+            block_params[exp] = [k for k in shared_params if k in b.P and not b.P[k].is_fixed()]
+            params = block_params[exp]
+            
+            b.admm_z = Param(params, initialize=0.0, mutable=True)
+            b.admm_y = Param(params, initialize=0.0, mutable=True)
+            b.admm_rho = Param(initialize=rho, mutable=True)
+            b.admm_objective = Objective(sense=minimize,
+                                         expr=b.error + sum(b.admm_y[k]*(b.P[k] - b.admm_z[k]) 
+                                                            + b.admm_rho/2*(b.P[k] - b.admm_z[k])**2 for k in params))
+        
+        def consensus(P_blocks, y_blocks):
+            z = dict()
+            for k in shared_params:
+                vals = [P_blocks[exp][k] + y_blocks[exp][k]/rho for exp in self.experiments if k in block_params[exp]]
+                if vals:
+                    z[k] = sum(vals)/len(vals)
+            return z
+        
+        P_blocks = {exp: {k: m.experiment[exp].P[k].value for k in block_params[exp]} for exp in self.experiments}
+        y_blocks = {exp: {k: 0.0 for k in block_params[exp]} for exp in self.experiments}
+        z = consensus(P_blocks, y_blocks)
+        warm_start = {exp: None for exp in self.experiments}
+        
+        m.obj.deactivate()
+        
+        for iteration in range(max_iter):
+            tasks = [(exp, 
+                      {k: z[k] for k in block_params[exp]}, 
+                      y_blocks[exp], 
+                      rho, 
+                      warm_start[exp], 
+                      solver_opts) for exp in self.experiments]
+            
+            results = parallel_map(_solve_admm_block, tasks, n_workers=n_workers, shared=m)
+            
+            for exp, (P, values, status) in zip(self.experiments, results):
+                if status != 'optimal':
+                    print(f'WARNING: The subproblem for experiment {exp} terminated with status {status}')
+                P_blocks[exp] = P
+                warm_start[exp] = values
+            
+            z_old = z
+            z = consensus(P_blocks, y_blocks)
+            
+            primal_residual = 0.0
+            dual_residual = 0.0
+            for exp in self.experiments:
+                for k in block_params[exp]:
+                    y_blocks[exp][k] += rho*(P_blocks[exp][k] - z[k])
+                    primal_residual += (P_blocks[exp][k] - z[k])**2
+                    dual_residual += (rho*(z[k] - z_old[k]))**2
+            
+            primal_residual = np.sqrt(primal_residual)
+            dual_residual = np.sqrt(dual_residual)
+            
+            if tee:
+                print(f'ADMM iteration {iteration}: primal residual = {primal_residual:.3e}, dual residual = {dual_residual:.3e}')
+            
+            if primal_residual < tol and dual_residual < tol:
+                break
+        else:
+            print(f'WARNING: The decomposition did not converge in {max_iter} iterations')
+        
+        # the states of the blocks come from subproblems with P_e != z, so every block is solved
+        # once more with the parameters fixed at the consensus values
+        tasks = [(exp, 
+                  {k: z[k] for k in block_params[exp]}, 
+                  y_blocks[exp], 
+                  None, 
+                  warm_start[exp], 
+                  solver_opts) for exp in self.experiments]
+        results = parallel_map(_solve_admm_block, tasks, n_workers=n_workers, shared=m)
+        for exp, (P, values, status) in zip(self.experiments, results):
+            if status != 'optimal':
+                raise RuntimeError(f'The solve of experiment {exp} with the consensus parameters terminated with status {status}')
+            warm_start[exp] = values
+        
+        # load the final solutions of the blocks and the consensus parameters
+        for exp in self.experiments:
+            b = m.experiment[exp]
+            if warm_start[exp] is not None:
+                for v, val in zip(b.component_data_objects(Var), warm_start[exp]):
+                    if not v.is_fixed() and not np.isnan(val):
+                        v.set_value(val)
+            for k in block_params[exp]:
+                b.P[k].set_value(z[k])
+            b.admm_objective.deactivate()
+        
+        m.obj.activate()
+        self.admm_iterations = iteration + 1
+        
+        return None
+    
     def run_parameter_estimation(self, builder, **kwds):
         """Solves the Parameter Estimation procedure described in Chen et al 2016. Here, 
             we call the ParameterEstimator separately on each dataset before adding them
@@ -1447,6 +1700,16 @@ class MultipleExperimentsEstimator(object):
             spectra_problem (bool): tells whether we have spectral data or concentration data (False if not specified)
 
             shared_spectra (bool): tells whether spectra are shared across datasets for species (False if not specified)
+            
+            global_variables (bool): use one global variable for each shared parameter (and for S if the
+            spectra are shared) that all blocks reference directly instead of linking constraints between
+            the experiments (False if not specified)
+            
+            decomposition (bool): solve the experiment blocks in parallel worker processes and coordinate
+            the shared kinetic parameters with an ADMM outer loop instead of one large NLP (False if not
+            specified)
+            
+            decomposition_opts (dict): options for the decomposition: n_workers, rho, max_iter and tol
 
         Returns:
 
@@ -1503,6 +1766,15 @@ class MultipleExperimentsEstimator(object):
         # self.lbZ = kwds.pop('lbZ', False)
         
         spectra_shared = kwds.pop('shared_spectra', False)
+        global_variables = kwds.pop('global_variables', False)
+        decomposition = kwds.pop('decomposition', False)
+        decomposition_opts = kwds.pop('decomposition_opts', dict())
+        
+        if decomposition:
+            if covariance:
+                raise RuntimeError('The covariance matrix is not available with the decomposition solver')
+            if global_variables or spectra_shared:
+                raise RuntimeError('The decomposition solver only coordinates the kinetic parameters, it cannot be used with global_variables or shared_spectra')
         
         #read info of unwanted G for each experiment KH.L
         unwanted_G_info = kwds.pop("unwanted_G_info", dict())
@@ -1517,6 +1789,8 @@ class MultipleExperimentsEstimator(object):
                 raise RuntimeError('To get covariance matrix the solver needs to be ipopt_sens or k_aug')
             #if solver == 'ipopt_sens':
             #    raise RuntimeError('To get covariance matrix for multiple experiments, the solver needs to be k_aug')
+            if global_variables:
+                raise RuntimeError('The covariance matrix is not available with global_variables, use the linking constraints instead')
         
         if not isinstance(start_time, dict):
             raise RuntimeError("Must provide start_times as dict with each experiment")
@@ -2155,23 +2429,22 @@ class MultipleExperimentsEstimator(object):
         count = 0
         m.dataset_count = list()
         m.map_exp_to_count = dict()
+        m.map_exp_to_prev = dict()
         m.first_exp = None
         for i in self.experiments:
             m.dataset_count.append(count)
             m.map_exp_to_count[count] = i
             if count == 0:
                 m.first_exp = i
+            else:
+                m.map_exp_to_prev[i] = m.map_exp_to_count[count-1]
             count += 1
         def param_linking_rule(m, exp, param):
-            prev_exp = None
             if exp == m.first_exp:
 
                 return Constraint.Skip
             else:
-                for key, val in m.map_exp_to_count.items():
-                    #print(key,val)
-                    if val == exp:
-                        prev_exp = m.map_exp_to_count[key-1]
+                prev_exp = m.map_exp_to_prev.get(exp)
                 if param in global_params and prev_exp != None:
                     #This here is to check that the correct linking constraints are constructed
                     #print("this constraint is written:")
@@ -2195,17 +2468,12 @@ class MultipleExperimentsEstimator(object):
         for k in list_params_across_blocks:
             if k not in list_fixed_params:
                 new_list_params_across_blocks.append(k)
-        m.parameter_linking = Constraint(self.experiments, new_list_params_across_blocks, rule = param_linking_rule)
         
         def wavelength_linking_rule(m, exp, wave, comp):
-            prev_exp = None
             if exp == m.first_exp:
                 return Constraint.Skip
             else:
-                for key, val in m.map_exp_to_count.items():
-                    #print(key,val)
-                    if val == exp:
-                        prev_exp = m.map_exp_to_count[key-1]
+                prev_exp = m.map_exp_to_prev.get(exp)
                 if wave in list_waves_across_blocks and prev_exp != None:
                     #This here is to check that the correct linking constraints are constructed
 
@@ -2220,17 +2488,30 @@ class MultipleExperimentsEstimator(object):
                 else:
                     return Constraint.Skip
 
-        if spectra_shared == True:
-            #print(list_components[self.experiments])
-            #print(list_waves_across_blocks)
-            #print(self.experiments)
-            #print(list_species_across_blocks)
-            m.spectra_linking = Constraint(self.experiments, list_waves_across_blocks, list_species_across_blocks, rule = wavelength_linking_rule)
+        if global_variables:
+            shared_params = [k for k in new_list_params_across_blocks if k in global_params]
+            self._add_global_variables(m, shared_params, spectra_shared)
+        
+        elif decomposition:
+            shared_params = [k for k in new_list_params_across_blocks if k in global_params]
+        
+        else:
+            m.parameter_linking = Constraint(self.experiments, new_list_params_across_blocks, rule = param_linking_rule)
+            
+            if spectra_shared == True:
+                #print(list_components[self.experiments])
+                #print(list_waves_across_blocks)
+                #print(self.experiments)
+                #print(list_species_across_blocks)
+                m.spectra_linking = Constraint(self.experiments, list_waves_across_blocks, list_species_across_blocks, rule = wavelength_linking_rule)
         
         m.obj = Objective(sense = minimize, expr=sum(b.error for b in m.experiment[:]))
         self.model = m
         
-        if covariance and solver == 'k_aug' and self._spectra_given:
+        if decomposition:
+            self._solve_decomposition(m, shared_params, solver_opts=solver_opts, tee=tee, **decomposition_opts)
+        
+        elif covariance and solver == 'k_aug' and self._spectra_given:
             #Not yet working
             
             self.solve_full_problem(solver, tee = tee, solver_opts = solver_opts)
@@ -2263,6 +2544,9 @@ class MultipleExperimentsEstimator(object):
             
         solver_results = dict()   
         
+        if global_variables:
+            self._load_global_variables(m)
+        
         # loading the results, notice that we return a dictionary
         for i in m.experiment:
             solver_results[i] = ResultsObject()
@@ -2275,6 +2559,57 @@ class MultipleExperimentsEstimator(object):
         
         return solver_results
     
+def _solve_admm_block(m, task):
+    """Solves the ADMM subproblem of a single experiment block. This is the
+    worker function used by MultipleExperimentsEstimator._solve_decomposition
+    and is not meant to be used directly by users.
+    
+    Args:
+        m (pyomo ConcreteModel): the model with the experiment blocks
+        
+        task (tuple): experiment, consensus values z, multipliers y, penalty
+            rho, the warm start values of the block (or None) and the solver
+            options. If rho is None the parameters are fixed at z and only the
+            states of the block are solved for
+            
+    Returns:
+        P (dict): the parameter values of the block
+        
+        values (numpy.ndarray): the values of all variables in the block
+        
+        status (str): the solver termination condition
+        
+    """
+    exp, z, y, rho, warm_start, solver_opts = task
+    block = m.experiment[exp]
+    block_vars = list(block.component_data_objects(Var))
+    
+    if warm_start is not None:
+        for v, val in zip(block_vars, warm_start):
+            if not v.is_fixed() and val is not None:
+                v.set_value(val)
+    
+    for k in z.keys():
+        block.admm_z[k] = z[k]
+        block.admm_y[k] = y[k]
+    if rho is None:
+        for k in z.keys():
+            block.P[k].fix(z[k])
+    else:
+        block.admm_rho = rho
+    
+    optimizer = SolverFactory('ipopt')
+    results = optimizer.solve(block, options=solver_opts)
+    
+    if rho is None:
+        for k in z.keys():
+            block.P[k].unfix()
+    
+    P = {k: block.P[k].value for k in z.keys()}
+    values = np.array([v.value for v in block_vars], dtype=float)
+    
+    return P, values, str(results.solver.termination_condition)
+
 def split_sipopt_string1(output_string):
     start_hess = output_string.find('DenseSymMatrix')
     ipopt_string = output_string[:start_hess]
@@ -44,6 +44,63 @@ class Optimizer(PyomoSimulator):
     def run_opt(self,solver,**kwds):
         raise NotImplementedError("Optimizer abstract method. Call child class")
 
+    def load_data(self, D=None, C=None, U=None):
+        """Swaps the data of the (discretized) model in place.
+
+        Note:
+            The model has to be created with create_pyomo_model(...,
+            mutable_data=True) or array_data=True to load spectral data. The new data must be
+            given on the same time (and wavelength) grid as the data used to
+            build the model. Nothing is rebuilt: the variables keep the values
+            of the last solution, so that the next call to run_opt starts
+            warm from there.
+
+        Args:
+            D (DataFrame, optional): spectral data (times x wavelengths)
+
+            C (DataFrame, optional): concentration data (times x components)
+
+            U (DataFrame, optional): complementary state data (times x states)
+
+        Returns:
+            None
+
+        """
+        if D is not None:
+            if not self._spectra_given:
+                raise RuntimeError('The model has no spectral data to replace')
+            if not isinstance(self.model.D, SpectralData) and not self.model.D.mutable:
+                raise RuntimeError('Spectral data can only be loaded into a model created with mutable_data=True'
+                                   ' or array_data=True')
+
+            missing_times = [t for t in self._meas_times if t not in D.index]
+            missing_lambdas = [l for l in self._meas_lambdas if l not in D.columns]
+            if missing_times or missing_lambdas:
+                raise RuntimeError('The new spectral data must be given on the grid of the model')
+
+            if isinstance(self.model.D, SpectralData):
+                self.model.D.values = np.asarray(D.loc[self.model.D.times, self.model.D.lambdas].values, dtype=float)
+            else:
+                d_values = D.loc[self._meas_times, self._meas_lambdas].values
+                d_dict = dict()
+                for i, t in enumerate(self._meas_times):
+                    for j, l in enumerate(self._meas_lambdas):
+                        d_dict[t, l] = float(d_values[i, j])
+                self.model.D.store_values(d_dict)
+
+        for name, data in [('C', C), ('U', U)]:
+            if data is None:
+                continue
+            if not hasattr(self.model, '{}_indx'.format(name)):
+                raise RuntimeError('The model has no {} data to replace'.format(name))
+            var = getattr(self.model, name)
+            values = dict()
+            for t, k in var.keys():
+                if t not in data.index or k not in data.columns:
+                    raise RuntimeError('The new {} data must be given on the grid of the model'.format(name))
+                values[t, k] = float(data[k][t])
+            var.set_values(values)
+
     def _solve_S_from_DC(self,C_dataFrame,tee=False,with_bounds=False,max_iter=200):
         """Solves a basic least squares problems with SVD.
         
@@ -68,7 +125,10 @@ class Optimizer(PyomoSimulator):
                         row.append(i*self._n_meas_lambdas+j)
                         col.append(j*self._n_components+k)
                         data.append(C_dataFrame[c][t])
-                    D_vector[i*self._n_meas_lambdas+j] = D_data[t,l]    
+                    if not isinstance(D_data, SpectralData):
+                        D_vector[i*self._n_meas_lambdas+j] = value(D_data[t,l])
+            if isinstance(D_data, SpectralData):
+                D_vector = D_data.array(self._meas_times, self._meas_lambdas).ravel()
                 
                         
             Bd = scipy.sparse.coo_matrix((data, (row, col)),
@@ -223,11 +283,14 @@ class Optimizer(PyomoSimulator):
                                         with_bounds=wb,
                                         max_iter=max_iter)
 
-        d_results = []
-        for t in self._meas_times:
-            for l in self._meas_lambdas:
-                d_results.append(D_data[t,l])
-        d_array = np.array(d_results).reshape((self._n_meas_times,self._n_meas_lambdas))
+        if isinstance(D_data, SpectralData):
+            d_array = D_data.array(self._meas_times, self._meas_lambdas)
+        else:
+            d_results = []
+            for t in self._meas_times:
+                for l in self._meas_lambdas:
+                    d_results.append(value(D_data[t,l]))
+            d_array = np.array(d_results).reshape((self._n_meas_times,self._n_meas_lambdas))
                         
         results.S = pd.DataFrame(data=s_array,
                                  columns=self._mixture_components,
@@ -11,6 +11,7 @@ import time
 
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.stats import chi2
 from pyomo import *
 from pyomo.core.expr import current as EXPR
 from pyomo.core.expr.numvalue import NumericConstant
@@ -23,6 +24,9 @@ from pyomo.opt import (
 )
 
 from kipet.library.Optimizer import *
+from kipet.library.discretization_tools import t_ij, fe_cp
+from kipet.library.parallel_tools import parallel_map, parallel_imap, default_number_of_workers
+from kipet.library.timing_tools import PhaseTimer, timed_phase, timed_solver
 from kipet.library.TemplateBuilder import *
 
 class ParameterEstimator(Optimizer):
@@ -44,6 +48,9 @@ class ParameterEstimator(Optimizer):
         self._n_actual = self._n_components
         self.model_variance = True
         self.termination_condition = None
+        # termination of the last solve of spectral data (run_opt does not raise on those)
+        self._last_termination = None
+        self.objective_value = None
         
         self.unwanted_G = False
         self.time_variant_G = False
@@ -113,6 +120,7 @@ class ParameterEstimator(Optimizer):
         covariance = kwds.pop('covariance', False)
         species_list = kwds.pop('subset_components', None)
         set_A = kwds.pop('subset_lambdas', list())
+        svd_rank = kwds.pop('svd_rank', None)
         self._eigredhess2file=eigredhess2file
 
         if not set_A:
@@ -159,6 +167,20 @@ class ParameterEstimator(Optimizer):
             sigma_sq['device'] = sigma_dev
 
         m = self.model
+
+        if svd_rank is not None:
+            if with_d_vars:
+                raise RuntimeError('with_d_vars cannot be combined with svd_rank')
+            if self.unwanted_G or self.time_variant_G or self.time_invariant_G:
+                raise RuntimeError('Unwanted contributions cannot be combined with svd_rank')
+            if self._huplc_given or penaltyparam or penaltyparamcon:
+                raise RuntimeError('H/UPLC data and penalty terms cannot be combined with svd_rank')
+            self._solve_compressed_model(sigma_sq, optimizer, svd_rank, list_components,
+                                         tee=tee,
+                                         weights=weights,
+                                         covariance=covariance,
+                                         all_sigma_specified=all_sigma_specified)
+            return
         
         # When G is time-invariant and cannot be decomposed, problem (19) should be called.
         # Instead of calling (19), (24) is called but all qr[i] are fixed at 1.0. KH.L
@@ -509,6 +531,7 @@ class ParameterEstimator(Optimizer):
             solver_results = optimizer.solve(m, tee=tee,
                                              logfile=self._tmpfile,
                                              report_timing=True)
+            self._last_termination = solver_results.solver.termination_condition
 
             # self.model.red_hessian.pprint
             print("Done solving building reduce hessian")
@@ -610,11 +633,12 @@ class ParameterEstimator(Optimizer):
 
             print("SET FOR k_aug")
             self._tmpfile = "k_aug_hess"
-            ip = SolverFactory('ipopt')
+            ip = timed_solver(SolverFactory('ipopt'))
             solver_results = ip.solve(m, tee=tee,
                                       logfile=self._tmpfile,
                                       report_timing=True)
-            k_aug = SolverFactory('k_aug')
+            self._last_termination = solver_results.solver.termination_condition
+            k_aug = timed_solver(SolverFactory('k_aug'))
             # k_aug.options["compute_inv"] = ""
             m.ipopt_zL_in.update(m.ipopt_zL_out)  #: be sure that the multipliers got updated!
             m.ipopt_zU_in.update(m.ipopt_zU_out)
@@ -659,14 +683,192 @@ class ParameterEstimator(Optimizer):
             # with open("b4model.txt","w") as f:
             #     m.pprint(ostream=f)
             solver_results = optimizer.solve(m, tee=tee)
+            self._last_termination = solver_results.solver.termination_condition
             # with open("aftermodel.txt","w") as f2:
             #     m.pprint(ostream=f2)
 
         if with_d_vars:
             m.del_component('D_bar')
             m.del_component('D_bar_constraint')
+        self.objective_value = value(m.objective)
         m.del_component('objective')
 
+    def _solve_compressed_model(self, sigma_sq, optimizer, rank, list_components, **kwds):
+        """Solves the estimation based on spectral data projected onto the
+        leading right singular vectors of D. (known variances)
+
+        With D = U Sigma V^T and V_r the first r right singular vectors, the
+        residuals D V_r - C L^T are used instead of D - C S^T, where L = V_r^T S
+        are r x nc loading variables. This is the full problem restricted to
+        absorbances in the span of V_r, so the cost no longer depends on the
+        number of wavelengths. The non-negativity of S is not enforced. After
+        the solve S = V_r L is loaded into the model.
+
+           This method is not intended to be used by users directly
+        Args:
+            sigma_sq (dict): variances
+
+            optimizer (SolverFactory): Pyomo Solver factory object
+
+            rank (int): number of singular vectors r
+
+            list_components (list): the absorbing components
+
+            tee (bool,optional): flag to tell the optimizer whether to stream output
+            to the terminal or not
+
+            weights (list, optional): weights of the spectral and the
+            concentration terms
+
+            covariance (bool, optional): compute the covariance of the
+            parameters (solver ipopt_sens or k_aug)
+
+        Returns:
+            None
+        """
+        tee = kwds.pop('tee', False)
+        weights = kwds.pop('weights', [1.0, 1.0])
+        covariance = kwds.pop('covariance', False)
+        all_sigma_specified = kwds.pop('all_sigma_specified', True)
+
+        m = self.model
+
+        if isinstance(m.D, SpectralData):
+            D = m.D.array(self._meas_times, self._meas_lambdas)
+        else:
+            D = np.array([[value(m.D[t, l]) for l in self._meas_lambdas] for t in self._meas_times])
+
+        U, s, Vt = np.linalg.svd(D, full_matrices=False)
+        rank = int(min(rank, len(s)))
+        V = Vt[:rank, :].T
+        DV = D.dot(V)
+        print('Spectral data compressed to rank {} ({:.6g} of the squared norm retained)'.format(
+            rank, np.sum(s[:rank] ** 2) / np.sum(s ** 2)))
+
+        if hasattr(self, '_abs_components'):
+            components = list(self._abs_components)
+            conc = m.Cs if self.model_variance else m.Z
+        else:
+            components = list(list_components)
+            conc = m.C if self.model_variance else m.Z
+
+        S_values = np.array([[value(m.S[l, k]) for k in components] for l in self._meas_lambdas])
+        L_init = V.T.dot(S_values)
+
+        m.svd_index = Set(initialize=list(range(rank)), ordered=True)
+        m.L = Var(m.svd_index, components,
+                  initialize={(j, k): float(L_init[j, i]) for j in range(rank) for i, k in enumerate(components)})
+
+        def rule_objective(m):
+            expr = 0
+            for i, t in enumerate(self._meas_times):
+                for j in range(rank):
+                    expr += (float(DV[i, j]) - sum(conc[t, k] * m.L[j, k] for k in components)) ** 2 / (sigma_sq['device'])
+            expr *= weights[0]
+            if self.model_variance:
+                second_term = 0.0
+                for t in m.meas_times:
+                    second_term += sum((m.C[t, k] - m.Z[t, k]) ** 2 / sigma_sq[k] for k in list_components)
+                expr += weights[1] * second_term
+            return expr
+
+        m.objective = Objective(rule=rule_objective)
+
+        if covariance and self.solver in ['ipopt_sens', 'k_aug']:
+            if not all_sigma_specified:
+                raise RuntimeError(
+                    'All variances must be specified to determine covariance matrix.\n Please pass variance dictionary to run_opt')
+
+            # degrees of freedom of the compressed problem: C (with model variance), L and the parameters
+            dof = list()
+            if self.model_variance:
+                dof += [conc[t, k] for t in self._meas_times for k in components]
+            dof += [m.L[j, k] for j in range(rank) for k in components]
+            params = [v for v in six.itervalues(m.P) if not v.is_fixed()]
+            if hasattr(m, 'Pinit'):
+                params += [m.init_conditions[k] for k in m.Pinit.keys()]
+            dof += params
+
+            self._idx_to_variable = dict()
+            if hasattr(m, 'red_hessian'):
+                m.del_component('red_hessian')
+
+            if self.solver == 'ipopt_sens':
+                m.red_hessian = Suffix(direction=Suffix.IMPORT_EXPORT)
+                for i, v in enumerate(dof):
+                    self._idx_to_variable[i + 1] = v
+                    m.red_hessian[v] = i + 1
+                self._tmpfile = "ipopt_hess"
+                solver_results = optimizer.solve(m, tee=tee,
+                                                 logfile=self._tmpfile,
+                                                 report_timing=True)
+                self._last_termination = solver_results.solver.termination_condition
+                with open(self._tmpfile, 'r') as f:
+                    output_string = f.read()
+                if os.path.exists(self._tmpfile):
+                    os.remove(self._tmpfile)
+                ipopt_output, hessian_output = split_sipopt_string(output_string)
+                hessian = read_reduce_hessian(hessian_output, len(dof))
+            else:
+                m.dual = Suffix(direction=Suffix.IMPORT_EXPORT)
+                m.ipopt_zL_out = Suffix(direction=Suffix.IMPORT)
+                m.ipopt_zU_out = Suffix(direction=Suffix.IMPORT)
+                m.ipopt_zL_in = Suffix(direction=Suffix.EXPORT)
+                m.ipopt_zU_in = Suffix(direction=Suffix.EXPORT)
+                m.dof_v = Suffix(direction=Suffix.EXPORT)
+                m.rh_name = Suffix(direction=Suffix.IMPORT)
+                for i, v in enumerate(dof):
+                    self._idx_to_variable[i + 1] = v
+                    m.dof_v[v] = i + 1
+                ip = timed_solver(SolverFactory('ipopt'))
+                solver_results = ip.solve(m, tee=tee, report_timing=True)
+                self._last_termination = solver_results.solver.termination_condition
+                m.ipopt_zL_in.update(m.ipopt_zL_out)
+                m.ipopt_zU_in.update(m.ipopt_zU_out)
+                k_aug = timed_solver(SolverFactory('k_aug'))
+                k_aug.options['compute_inv'] = ''
+                k_aug.solve(m, tee=tee)
+                unordered_hessian = np.loadtxt('result_red_hess.txt')
+                if os.path.exists('result_red_hess.txt'):
+                    os.remove('result_red_hess.txt')
+                var_loc = m.rh_name
+                for v in six.itervalues(self._idx_to_variable):
+                    try:
+                        var_loc[v]
+                    except:
+                        var_loc[v] = 0
+                hessian = self._order_k_aug_hessian(unordered_hessian, var_loc)
+
+            if self._estimability == True:
+                self.hessian = hessian
+
+            # the objective is a weighted sum of squares, so the covariance is twice its inverse hessian
+            nparams = len(params)
+            V_param = 2.0 * np.atleast_2d(hessian)[-nparams:, -nparams:]
+            self.compressed_covariance = V_param
+            variances_p = np.diag(V_param)
+            print('\nConfidence intervals:')
+            for i, v in enumerate(params):
+                print('{} ({},{})'.format(v.name, v.value - variances_p[i] ** 0.5, v.value + variances_p[i] ** 0.5))
+        else:
+            solver_results = optimizer.solve(m, tee=tee)
+            self._last_termination = solver_results.solver.termination_condition
+
+        # back to the full absorbance space
+        L_values = np.array([[value(m.L[j, k]) for k in components] for j in range(rank)])
+        S_values = V.dot(L_values)
+        for i, l in enumerate(self._meas_lambdas):
+            for c, k in enumerate(components):
+                if not m.S[l, k].is_fixed():
+                    m.S[l, k].set_value(float(S_values[i, c]))
+
+        self.objective_value = value(m.objective)
+        m.del_component('objective')
+        m.del_component('L')
+        if hasattr(m, 'L_index'):
+            m.del_component('L_index')
+        m.del_component('svd_index')
+
     def _solve_model_given_c(self, sigma_sq, optimizer, **kwds):
         """Solves estimation based on concentration data. (known variances)
 
@@ -839,7 +1041,7 @@ class ParameterEstimator(Optimizer):
                     count_vars += 1
 
             self._tmpfile = "k_aug_hess"
-            ip = SolverFactory('ipopt')
+            ip = timed_solver(SolverFactory('ipopt'))
             solver_results = ip.solve(m, tee=False,
                                       logfile=self._tmpfile,
                                       report_timing=True, symbolic_solver_labels=True)
@@ -865,7 +1067,7 @@ class ParameterEstimator(Optimizer):
                         print("The current iteration was unsuccessful.")
             #############################################
             # m.P.pprint()
-            k_aug = SolverFactory('k_aug')
+            k_aug = timed_solver(SolverFactory('k_aug'))
 
             # k_aug.options["no_scale"] = ""
             m.ipopt_zL_in.update(m.ipopt_zL_out)  #: be sure that the multipliers got updated!
@@ -907,7 +1109,7 @@ class ParameterEstimator(Optimizer):
             if self._concentration_given:
                 self._compute_covariance_C(hessian, sigma_sq)
         elif self.solver == 'gams' and covariance==False: #To use conopt as alternative NLP solver, CS
-            ip = SolverFactory('gams')
+            ip = timed_solver(SolverFactory('gams'))
             solver_results = ip.solve(m, solver='conopt', tee=True)
             ##############################################
         else:
@@ -932,6 +1134,7 @@ class ParameterEstimator(Optimizer):
                     # options["OF_bound_relax_factor"] = 1E-08
                     if self.termination_condition!= TerminationCondition.optimal:
                         raise Exception("The current iteration was unsuccessful.")
+        self.objective_value = value(m.objective)
         m.del_component('objective')
 
     def _define_reduce_hess_order_new(self):
@@ -1089,6 +1292,7 @@ class ParameterEstimator(Optimizer):
                 self.model.red_hessian[v] = count_vars
                 count_vars += 1
 
+    @timed_phase('covariance_assembly')
     def _compute_covariance(self, hessian, variances):
 
         nt = self._n_allmeas_times
@@ -1279,6 +1483,7 @@ class ParameterEstimator(Optimizer):
                     i += 1
             return 1
 
+    @timed_phase('covariance_assembly')
     def _compute_covariance_C(self, hessian, variances):
         """
         Computes the covariance matrix for the paramaters taking in the Hessian
@@ -1340,6 +1545,7 @@ class ParameterEstimator(Optimizer):
                 i += 1
         return 1
 
+    @timed_phase('covariance_assembly')
     def _compute_covariance_no_model_variance(self, hessian, variance):
         """
         Computes the covariance matrix for the paramaters taking in the Hessian
@@ -2082,6 +2288,7 @@ class ParameterEstimator(Optimizer):
 
     ####################################################################
 
+    @timed_phase('hessian_parsing')
     def _order_k_aug_hessian(self, unordered_hessian, var_loc):
         """
         not meant to be used directly by users. Takes in the inverse of the reduced hessian
@@ -2130,6 +2337,11 @@ class ParameterEstimator(Optimizer):
             variables and constraints for D_bar(i,j).
             
             report_time (bool, optional): flag as to whether to time the parameter estimation or not.
+            The wall time of each phase (solver, hessian parsing, covariance assembly, ...) is returned
+            as a dict in results.timing.
+            
+            report_memory (bool, optional): also record the peak memory of each phase in results.timing
+            (only used with report_time).
 
             estimability (bool, optional): flag to tell the model whether it is
             being used by the estimability analysis and therefore will need to return the
@@ -2141,10 +2353,32 @@ class ParameterEstimator(Optimizer):
             model_variance (bool, optional): Default is True. Flag to tell whether we are only
             considering the variance in the device, or also model noise as well.
 
+            svd_rank (int, optional): project the spectral data onto its leading svd_rank right
+            singular vectors and estimate in the compressed space (nt*svd_rank residuals and
+            svd_rank*nc loading variables instead of nw*nc absorbances). S is recovered from the
+            loadings after the solve.
+
         Returns:
             Results object with loaded results
 
         """
+        report_time = kwds.pop('report_time', False)
+        report_memory = kwds.pop('report_memory', False)
+        if not report_time:
+            return self._run_opt(solver, **kwds)
+
+        # the timer is stopped even if the solve fails
+        start = time.time()
+        with PhaseTimer(track_memory=report_memory) as timer:
+            output = self._run_opt(solver, **kwds)
+        end = time.time()
+        results = output[1] if isinstance(output, tuple) else output
+        results.timing = timer.to_dict()
+        print("Total execution time in seconds for parameter estimation:", end - start)
+        return output
+
+    def _run_opt(self, solver, **kwds):
+        """Solves the parameter estimation (see run_opt). The timing options are handled by run_opt."""
 
         solver_opts = kwds.pop('solver_opts', dict())
         variances = kwds.pop('variances', dict())
@@ -2154,7 +2388,6 @@ class ParameterEstimator(Optimizer):
         symbolic_solver_labels = kwds.pop('symbolic_solver_labels', False)
 
         estimability = kwds.pop('estimability', False)
-        report_time = kwds.pop('report_time', False)
         model_variance = kwds.pop('model_variance', True)
 
         # additional arguments for inputs CS
@@ -2193,10 +2426,8 @@ class ParameterEstimator(Optimizer):
         if not self.model.alltime.get_discretization_info():
             raise RuntimeError('apply discretization first before initializing')
 
-        if report_time:
-            start = time.time()
         # Look at the output in results
-        opt = SolverFactory(self.solver)
+        opt = timed_solver(SolverFactory(self.solver))
         
         # Options for unwanted contribution cannot be True at the same time. KH.L
         if self.unwanted_G and self.time_variant_G:
@@ -2433,11 +2664,6 @@ class ParameterEstimator(Optimizer):
                 # print(param_valsinit)
             results.Pinit = param_valsinit
 
-        if report_time:
-            end = time.time()
-            print("Total execution time in seconds for variance estimation:", end - start)
-
-
         if self._estimability == True:
             if self.termination_condition!=None and self.termination_condition!=TerminationCondition.optimal:
                 raise Exception("The current iteration was unsuccessful.")
@@ -2449,6 +2675,380 @@ class ParameterEstimator(Optimizer):
             else:
                 return results
 
+    def run_bootstrap(self, solver, **kwds):
+        """ Computes bootstrap confidence intervals of the parameters.
+
+            The residuals of the nominal estimation are resampled (single time points or blocks of
+            consecutive time points, which keeps their correlation over the wavelengths/components
+            and over time) and added to the fitted D (or C). The estimation is solved again for
+            every replicate, warm started from the nominal solution, in worker processes. No
+            sensitivity solver (ipopt_sens or k_aug) is needed.
+
+            Note:
+                Spectral data is swapped in place with load_data, so the model has to be created
+                with create_pyomo_model(..., mutable_data=True) or array_data=True.
+
+            Args:
+                solver (str): name of the nonlinear solver to used
+
+                n_samples (int, optional): number of bootstrap replicates (default 100)
+
+                method (str, optional): 'residuals' resamples single time points, 'blocks' resamples
+                blocks of block_size consecutive time points (moving block bootstrap)
+
+                block_size (int, optional): length of the blocks (default sqrt of the number of times)
+
+                confidence (float, optional): level of the percentile intervals (default 0.95)
+
+                seed (int, optional): seed of the resampling
+
+                n_workers (int, optional): number of worker processes (defaults to the number of
+                available cores)
+
+                nominal (ResultsObject, optional): results of the nominal estimation. If not given
+                the nominal estimation is solved first with the remaining keywords
+
+                Any other keyword (variances, solver_opts, ...) is passed to run_opt.
+
+            Note:
+                Only the spectra (or the concentration data) are resampled. Complementary state
+                data (U) is held fixed at the measured values in every replicate.
+
+            Returns:
+                samples (DataFrame): the parameters of the replicates (one row per replicate that
+                converged)
+
+                intervals (dict): map of parameter name to the (lower, upper) percentile interval
+
+        """
+        n_samples = kwds.pop('n_samples', 100)
+        method = kwds.pop('method', 'residuals')
+        block_size = kwds.pop('block_size', None)
+        confidence = kwds.pop('confidence', 0.95)
+        seed = kwds.pop('seed', None)
+        n_workers = kwds.pop('n_workers', None)
+        nominal = kwds.pop('nominal', None)
+        kwds['covariance'] = False
+
+        if method not in ['residuals', 'blocks']:
+            raise RuntimeError('The bootstrap method must be residuals or blocks')
+        if self._spectra_given and not isinstance(self.model.D, SpectralData) and not self.model.D.mutable:
+            raise RuntimeError('The bootstrap needs a model created with mutable_data=True or array_data=True')
+        if not self._spectra_given and not self._concentration_given:
+            raise RuntimeError('Must either provide concentration data or spectra in order to run the bootstrap')
+
+        if nominal is None:
+            nominal = self.run_opt(solver, **copy.deepcopy(kwds))
+
+        # fitted data and residuals of the nominal solution (one row per time point)
+        if self._spectra_given:
+            times = list(self._meas_times)
+            columns = list(self._meas_lambdas)
+            data = self.model.D.to_frame() if isinstance(self.model.D, SpectralData) else \
+                pd.DataFrame([[value(self.model.D[t, l]) for l in columns] for t in times], index=times, columns=columns)
+            data = data.loc[times, columns].values
+            absorbing = list(nominal.S.columns)
+            fitted = nominal.C.loc[times, absorbing].values.dot(nominal.S.loc[columns, absorbing].values.T)
+        else:
+            # model.C is only indexed over the concentration data times (allmeas_times also has
+            # the times of the complementary state data and the feeds)
+            c_keys = list(self.model.C.keys())
+            times = sorted(set(t for t, k in c_keys))
+            columns = [k for k in self._mixture_components if any(c == k for t, c in c_keys)]
+            if len(c_keys) != len(times) * len(columns):
+                raise RuntimeError('The bootstrap needs concentration data of every component at every time')
+            data = np.array([[self.model.C[t, k].value for k in columns] for t in times])
+            fitted = np.array([[self.model.Z[t, k].value for k in columns] for t in times])
+
+        n_times = len(times)
+        if block_size is None:
+            block_size = max(1, int(round(n_times ** 0.5)))
+        block_size = max(1, min(block_size if method == 'blocks' else 1, n_times))
+
+        self._bootstrap = {'times': times, 'columns': columns, 'fitted': fitted, 'residuals': data - fitted,
+                           'block_size': block_size, 'solver': solver, 'options': kwds,
+                           'warm_start': [(v, v.value) for v in self.model.component_data_objects(Var)]}
+        seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=n_samples)
+        try:
+            replicates = parallel_map(_solve_bootstrap_replicate, list(seeds), n_workers=n_workers, shared=self)
+        finally:
+            # restores the data and the nominal solution (replicates solved in this process)
+            if self._spectra_given:
+                self.load_data(D=pd.DataFrame(data, index=times, columns=columns))
+            else:
+                self.load_data(C=pd.DataFrame(data, index=times, columns=columns))
+            for v, val in self._bootstrap['warm_start']:
+                v.value = val
+            del self._bootstrap
+
+        converged = [p for p in replicates if p is not None]
+        if len(converged) < n_samples:
+            print('***WARNING: {} of {} bootstrap replicates did not converge'.format(n_samples - len(converged), n_samples))
+        if not converged:
+            raise RuntimeError('None of the bootstrap replicates converged')
+
+        samples = pd.DataFrame(converged)
+        alpha = 100.0 * (1.0 - confidence) / 2.0
+        intervals = dict()
+        print('\nBootstrap confidence intervals ({}%):'.format(100.0 * confidence))
+        for k in samples.columns:
+            lower, upper = np.percentile(samples[k].values, [alpha, 100.0 - alpha])
+            intervals[k] = (float(lower), float(upper))
+            print('{} ({},{})'.format(k, lower, upper))
+        return samples, intervals
+
+    def run_profile_likelihood(self, solver, **kwds):
+        """ Computes profile-likelihood confidence intervals of the parameters.
+
+            Each parameter is fixed on a grid of values on both sides of the optimum and the
+            estimation is solved for the other parameters. Along each side the grid points are
+            solved in order, every point warm started from the solution of the one before
+            (continuation), until the objective rises above the threshold of the chi-squared
+            distribution (one degree of freedom). The profiles run in worker processes. Unlike
+            the linearized intervals of the covariance, the intervals can be asymmetric.
+
+            Note:
+                The objective is the weighted least squares objective of run_opt, so the
+                variances must be known (e.g. from the VarianceEstimator).
+
+            Args:
+                solver (str): name of the nonlinear solver to used
+
+                parameters (list, optional): parameters to profile (defaults to the unfixed ones)
+
+                n_points (int, optional): number of grid points on each side (default 10)
+
+                span (float, optional): relative distance of the last grid point from the
+                optimum (default 0.5, i.e. +/- 50%)
+
+                grid (dict, optional): map of parameter to the list of grid values (overrides
+                n_points and span)
+
+                confidence (float, optional): level of the intervals (default 0.95)
+
+                n_workers (int, optional): number of worker processes (defaults to the number of
+                available cores)
+
+                nominal (ResultsObject, optional): results of the nominal estimation. If not given
+                the nominal estimation is solved first with the remaining keywords
+
+                Any other keyword (variances, solver_opts, ...) is passed to run_opt.
+
+            Returns:
+                profiles (dict): map of parameter to a DataFrame indexed by the grid values with
+                the objective and the other parameters
+
+                intervals (dict): map of parameter to the (lower, upper) interval (None where the
+                profile does not cross the threshold within the grid)
+
+        """
+        parameters = kwds.pop('parameters', None)
+        n_points = kwds.pop('n_points', 10)
+        span = kwds.pop('span', 0.5)
+        grid = kwds.pop('grid', dict())
+        confidence = kwds.pop('confidence', 0.95)
+        n_workers = kwds.pop('n_workers', None)
+        nominal = kwds.pop('nominal', None)
+        kwds['covariance'] = False
+
+        if parameters is None:
+            parameters = [k for k, v in self.model.P.items() if not v.is_fixed()]
+        for k in parameters:
+            if k not in self.model.P or self.model.P[k].is_fixed():
+                raise RuntimeError('Parameter {} is not an unfixed parameter of the model'.format(k))
+
+        if nominal is None or self.objective_value is None:
+            self.run_opt(solver, **copy.deepcopy(kwds))
+        nominal_objective = self.objective_value
+        threshold = chi2.ppf(confidence, 1)
+
+        tasks = []
+        for k in parameters:
+            p_opt = self.model.P[k].value
+            lb, ub = self.model.P[k].lb, self.model.P[k].ub
+            if k in grid:
+                values = sorted(grid[k])
+                sides = [[v for v in reversed(values) if v < p_opt], [v for v in values if v > p_opt]]
+            else:
+                step = span * abs(p_opt) / n_points if p_opt != 0 else span / n_points
+                sides = [[p_opt - i * step for i in range(1, n_points + 1)],
+                         [p_opt + i * step for i in range(1, n_points + 1)]]
+            for side in sides:
+                side = [v for v in side if (lb is None or v >= lb) and (ub is None or v <= ub)]
+                if side:
+                    tasks.append((k, side))
+
+        self._profile = {'solver': solver, 'options': kwds, 'nominal_objective': nominal_objective,
+                         'threshold': threshold,
+                         'warm_start': [(v, v.value) for v in self.model.component_data_objects(Var)]}
+        try:
+            points = parallel_map(_solve_profile_side, tasks, n_workers=n_workers, shared=self)
+        finally:
+            for v, val in self._profile['warm_start']:
+                v.value = val
+            for k in parameters:
+                self.model.P[k].unfix()
+            self.objective_value = nominal_objective
+            del self._profile
+
+        profiles = dict()
+        intervals = dict()
+        print('\nProfile likelihood confidence intervals ({}%):'.format(100.0 * confidence))
+        for k in parameters:
+            p_opt = self.model.P[k].value
+            rows = [dict([(name, self.model.P[name].value) for name in self.model.parameter_names],
+                         objective=nominal_objective)]
+            bounds = []
+            for (name, side), side_points in zip(tasks, points):
+                if name != k:
+                    continue
+                rows.extend(side_points)
+                bound = None
+                previous = (p_opt, 0.0)
+                for point in side_points:
+                    delta = point['objective'] - nominal_objective
+                    if delta > threshold:
+                        # linear interpolation of the crossing
+                        bound = float(previous[0] + (point[k] - previous[0]) * (threshold - previous[1]) / (delta - previous[1]))
+                        break
+                    previous = (point[k], delta)
+                bounds.append((side[0] < p_opt, bound))
+            frame = pd.DataFrame(rows)
+            profiles[k] = frame.set_index(k).sort_index()
+            lower = [b for is_lower, b in bounds if is_lower]
+            upper = [b for is_lower, b in bounds if not is_lower]
+            intervals[k] = (lower[0] if lower else None, upper[0] if upper else None)
+            print('{} ({},{})'.format(k, intervals[k][0], intervals[k][1]))
+        return profiles, intervals
+
+    def run_multistart(self, solver, **kwds):
+        """ Solves the estimation from several starting points of the parameters.
+
+            The starting points are sampled within the bounds of the parameters (Latin hypercube or
+            Sobol sequence) and solved concurrently in worker processes that share the model. If
+            agree is given, the run stops as soon as that many finished starts reached the best
+            objective: no more starts are dispatched and the solves still running are terminated.
+            The best solution is loaded into the model.
+
+            Args:
+                solver (str): name of the nonlinear solver to used
+
+                n_starts (int, optional): number of starting points (default 20)
+
+                sampling (str, optional): 'lhs' (default) or 'sobol'
+
+                seed (int, optional): seed of the sampling
+
+                agree (int, optional): stop once this many starts reached the best objective
+
+                tol (float, optional): relative tolerance to consider two objectives equal (default 1e-6)
+
+                n_workers (int, optional): number of worker processes (defaults to the number of
+                available cores)
+
+                Any other keyword (variances, solver_opts, ...) is passed to run_opt.
+
+            Returns:
+                Results object with the best solution. Its attribute optima is a DataFrame with the
+                distinct local optima ranked by objective (parameters, objective and the number of
+                starts that reached each of them) and starts a DataFrame with every start
+
+        """
+        n_starts = kwds.pop('n_starts', 20)
+        sampling = kwds.pop('sampling', 'lhs')
+        seed = kwds.pop('seed', None)
+        agree = kwds.pop('agree', None)
+        tol = kwds.pop('tol', 1e-6)
+        n_workers = kwds.pop('n_workers', None)
+        kwds['covariance'] = False
+
+        if n_workers is None:
+            n_workers = default_number_of_workers()
+
+        names = [k for k, v in self.model.P.items() if not v.is_fixed()]
+        lower = np.array([self.model.P[k].lb for k in names], dtype=float)
+        upper = np.array([self.model.P[k].ub for k in names], dtype=float)
+        if np.isnan(lower).any() or np.isnan(upper).any():
+            raise RuntimeError('All unfixed parameters need bounds to sample the starting points')
+
+        if sampling == 'sobol':
+            try:
+                from scipy.stats import qmc
+            except ImportError:
+                raise RuntimeError('Sobol sampling needs scipy >= 1.7')
+            unit = qmc.Sobol(len(names), scramble=True, seed=seed).random(n_starts)
+        elif sampling == 'lhs':
+            rng = np.random.RandomState(seed)
+            unit = (np.array([rng.permutation(n_starts) for _ in names]).T + rng.uniform(size=(n_starts, len(names)))) / n_starts
+        else:
+            raise RuntimeError('The sampling must be lhs or sobol')
+        starts = lower + unit * (upper - lower)
+
+        self._multistart = {'solver': solver, 'options': kwds, 'names': names,
+                            'variables': list(self.model.component_data_objects(Var)),
+                            'warm_start': [v.value for v in self.model.component_data_objects(Var)]}
+        solved = []
+        tasks = [(i, dict(zip(names, starts[i]))) for i in range(n_starts)]
+        points = parallel_imap(_solve_multistart_point, tasks, n_workers=n_workers, shared=self)
+        try:
+            for point in points:
+                solved.append(point)
+                objectives = [p['objective'] for p in solved if p['objective'] is not None]
+                if agree and objectives:
+                    best = min(objectives)
+                    if sum(1 for o in objectives if abs(o - best) <= tol * max(1.0, abs(best))) >= agree:
+                        break
+        finally:
+            # stops the workers still solving
+            points.close()
+            variables = self._multistart['variables']
+            warm_start = self._multistart['warm_start']
+            del self._multistart
+
+        converged = sorted([p for p in solved if p['objective'] is not None], key=lambda p: p['objective'])
+        print('{} of {} starts solved, {} converged'.format(len(solved), n_starts, len(converged)))
+        if not converged:
+            for v, val in zip(variables, warm_start):
+                v.value = val
+            raise RuntimeError('None of the starts converged')
+
+        # distinct local optima
+        optima = []
+        for p in converged:
+            for o in optima:
+                same_objective = abs(p['objective'] - o['objective']) <= tol * max(1.0, abs(o['objective']))
+                same_point = all(abs(p['P'][k] - o[k]) <= 1e-3 * max(1.0, abs(o[k])) for k in names)
+                if same_objective and same_point:
+                    o['starts'] += 1
+                    break
+            else:
+                optimum = dict(p['P'])
+                optimum['objective'] = p['objective']
+                optimum['starts'] = 1
+                optima.append(optimum)
+
+        for v, val in zip(variables, converged[0]['values']):
+            v.value = val
+        self.objective_value = converged[0]['objective']
+
+        results = ResultsObject()
+        to_load = ['Z', 'dZdt', 'X', 'dXdt', 'C', 'Y']
+        if self._spectra_given:
+            to_load.append('S')
+        results.load_from_pyomo_model(self.model, to_load=to_load)
+        if self._spectra_given:
+            self.compute_D_given_SC(results)
+        results.P = dict([(name, self.model.P[name].value) for name in self.model.parameter_names])
+        results.objective = converged[0]['objective']
+        results.optima = pd.DataFrame(optima)
+        results.starts = pd.DataFrame([dict([('start', p['index']), ('objective', p['objective'])] +
+                                            [(k + '_0', p['start'][k]) for k in names] +
+                                            [(k, p['P'][k] if p['P'] else None) for k in names])
+                                       for p in sorted(solved, key=lambda p: p['index'])])
+        print('\nLocal optima:')
+        print(results.optima)
+        return results
+
     def run_param_est_with_subset_lambdas(self, builder_clone, end_time, subset, nfe, ncp, sigmas, solver='ipopt', ):
         """ Performs the parameter estimation with a specific subset of wavelengths.
             At the moment, this is performed as a totally new Pyomo model, based on the
@@ -2481,7 +3081,7 @@ class ParameterEstimator(Optimizer):
         for t in self._meas_times:
             for l in self._meas_lambdas:
                 if l in subset:
-                    new_D.at[t, l] = self.model.D[t, l]
+                    new_D.at[t, l] = value(self.model.D[t, l])
         # print(new_D)
         # Now that we have a new DataFrame, we need to build the entire problem from this
         # An entire new ParameterEstimation problem should be set up, on the outside of
@@ -2550,7 +3150,7 @@ class ParameterEstimator(Optimizer):
             for t in self._meas_times:
                 for l in self._meas_lambdas:
                     if l in new_subs:
-                        new_D.at[t, l] = self.model.D[t, l]
+                        new_D.at[t, l] = value(self.model.D[t, l])
 
             # opt_model, nfe, ncp = construct_model_from_reduced_set(builder_before_data, end_time, new_D)
             # Now that we have a new DataFrame, we need to build the entire problem from this
@@ -2642,14 +3242,14 @@ class ParameterEstimator(Optimizer):
             t_count += 1
             l_count = 0
             for l in self._meas_lambdas:
-                sum_e += (D_model[t_count, l_count] - self.model.D[t, l]) ** 2
+                sum_e += (D_model[t_count, l_count] - value(self.model.D[t, l])) ** 2
                 l_count += 1
 
         t_count = -1
         l_count = 0
         for t in self._meas_times:
             for l in self._meas_lambdas:
-                sum_d += (self.model.D[t, l]) ** 2
+                sum_d += (value(self.model.D[t, l])) ** 2
 
         lof = ((sum_e / sum_d) ** 0.5) * 100
 
@@ -2673,11 +3273,11 @@ class ParameterEstimator(Optimizer):
         # calculating the covariance dl with ck
         for c in self._sublist_components:
             for l in self._meas_lambdas:
-                mean_d = (sum(self.model.D[t, l] for t in self._meas_times) / nt)
+                mean_d = (sum(value(self.model.D[t, l]) for t in self._meas_times) / nt)
                 mean_c = (sum(self.model.C[t, c].value for t in self._meas_times) / nt)
                 cov_d_l[l, c] = 0
                 for t in self._meas_times:
-                    cov_d_l[l, c] += (self.model.D[t, l] - mean_d) * (self.model.C[t, c].value - mean_c)
+                    cov_d_l[l, c] += (value(self.model.D[t, l]) - mean_d) * (self.model.C[t, c].value - mean_c)
 
                 cov_d_l[l, c] = cov_d_l[l, c] / (nt - 1)
 
@@ -2686,10 +3286,10 @@ class ParameterEstimator(Optimizer):
 
         for l in self._meas_lambdas:
             s_dl[l] = 0
-            mean_d = (sum(self.model.D[t, l] for t in self._meas_times) / nt)
+            mean_d = (sum(value(self.model.D[t, l]) for t in self._meas_times) / nt)
             error = 0
             for t in self._meas_times:
-                error += (self.model.D[t, l] - mean_d) ** 2
+                error += (value(self.model.D[t, l]) - mean_d) ** 2
             s_dl[l] = (error / (nt - 1)) ** 0.5
 
         s_ck = dict()
@@ -2770,6 +3370,138 @@ class ParameterEstimator(Optimizer):
         return lof
 
 
+def _converged(estimator):
+    """Checks whether the last solve of a worker reached an optimal solution.
+    run_opt raises on a failed solve of concentration data, the solves of
+    spectral data only record their termination condition.
+
+    Args:
+        estimator (ParameterEstimator): the estimator
+
+    Returns:
+        converged (bool): False if the last solve did not terminate optimally
+
+    """
+    termination = estimator._last_termination
+    return termination is None or termination == TerminationCondition.optimal
+
+def _solve_bootstrap_replicate(estimator, seed):
+    """Solves the estimation for one bootstrap replicate. This is the worker
+    function used by ParameterEstimator.run_bootstrap and is not meant to be
+    used directly by users.
+
+    Args:
+        estimator (ParameterEstimator): the estimator after the nominal solve
+
+        seed (int): seed of the resampling of this replicate
+
+    Returns:
+        P (dict): the estimated parameters (None if the solve failed)
+
+    """
+    boot = estimator._bootstrap
+    residuals = boot['residuals']
+    n_times = residuals.shape[0]
+    size = boot['block_size']
+
+    rng = np.random.RandomState(seed)
+    starts = rng.randint(0, n_times - size + 1, size=int(np.ceil(n_times / float(size))))
+    rows = np.concatenate([np.arange(start, start + size) for start in starts])[:n_times]
+    data = pd.DataFrame(boot['fitted'] + residuals[rows, :], index=boot['times'], columns=boot['columns'])
+
+    for v, val in boot['warm_start']:
+        v.value = val
+    if estimator._spectra_given:
+        estimator.load_data(D=data)
+    else:
+        estimator.load_data(C=data)
+
+    estimator._last_termination = None
+    try:
+        results = estimator.run_opt(boot['solver'], **copy.deepcopy(boot['options']))
+    except Exception as e:
+        print('***WARNING: bootstrap replicate failed: {}'.format(e))
+        return None
+    if not _converged(estimator):
+        print('***WARNING: bootstrap replicate failed: {}'.format(estimator._last_termination))
+        return None
+    return dict(results.P)
+
+def _solve_profile_side(estimator, task):
+    """Solves the points of one side of the profile of a parameter by
+    continuation. This is the worker function used by
+    ParameterEstimator.run_profile_likelihood and is not meant to be used
+    directly by users.
+
+    Args:
+        estimator (ParameterEstimator): the estimator after the nominal solve
+
+        task (tuple): the parameter and its grid values, ordered away from the optimum
+
+    Returns:
+        points (list): the parameters and the objective of every solved point
+
+    """
+    name, values = task
+    profile = estimator._profile
+    model = estimator.model
+
+    for v, val in profile['warm_start']:
+        v.value = val
+    points = []
+    for val in values:
+        model.P[name].fix(val)
+        estimator._last_termination = None
+        try:
+            estimator.run_opt(profile['solver'], **copy.deepcopy(profile['options']))
+        except Exception as e:
+            print('***WARNING: profile of {} failed at {}: {}'.format(name, val, e))
+            break
+        if not _converged(estimator):
+            print('***WARNING: profile of {} failed at {}: {}'.format(name, val, estimator._last_termination))
+            break
+        point = dict([(k, model.P[k].value) for k in model.parameter_names])
+        point['objective'] = estimator.objective_value
+        points.append(point)
+        if point['objective'] - profile['nominal_objective'] > profile['threshold']:
+            break
+    model.P[name].unfix()
+    return points
+
+def _solve_multistart_point(estimator, task):
+    """Solves the estimation from one starting point of the parameters. This
+    is the worker function used by ParameterEstimator.run_multistart and is
+    not meant to be used directly by users.
+
+    Args:
+        estimator (ParameterEstimator): the estimator
+
+        task (tuple): index of the start and the starting values of the parameters
+
+    Returns:
+        start (dict): the index, the starting point, the parameters, the objective (None if the
+        solve failed) and the values of all variables of the solution
+
+    """
+    index, start = task
+    multistart = estimator._multistart
+    for v, val in zip(multistart['variables'], multistart['warm_start']):
+        v.value = val
+    for k, val in start.items():
+        estimator.model.P[k].value = val
+
+    estimator._last_termination = None
+    try:
+        results = estimator.run_opt(multistart['solver'], **copy.deepcopy(multistart['options']))
+    except Exception as e:
+        print('***WARNING: start {} failed: {}'.format(index, e))
+        return {'index': index, 'start': start, 'P': None, 'objective': None, 'values': None}
+    if not _converged(estimator):
+        print('***WARNING: start {} failed: {}'.format(index, estimator._last_termination))
+        return {'index': index, 'start': start, 'P': None, 'objective': None, 'values': None}
+    return {'index': index, 'start': start, 'P': dict(results.P), 'objective': estimator.objective_value,
+            'values': [v.value for v in multistart['variables']]}
+
 def split_sipopt_string(output_string):
     start_hess = output_string.find('DenseSymMatrix')
     ipopt_string = output_string[:start_hess]
@@ -2786,6 +3518,7 @@ def split_k_aug_string(output_string):
     return (ipopt_string, hess_string)
 
 
+@timed_phase('hessian_parsing')
 def read_reduce_hessian2(hessian_string, n_vars):
     hessian_string = re.sub('RedHessian unscaled\[', '', hessian_string)
     hessian_string = re.sub('\]=', ',', hessian_string)
@@ -2802,6 +3535,7 @@ def read_reduce_hessian2(hessian_string, n_vars):
     return hessian
 
 
+@timed_phase('hessian_parsing')
 def read_reduce_hessian(hessian_string, n_vars):
     hessian = np.zeros((n_vars, n_vars))
     for i, line in enumerate(hessian_string.split('\n')):
@@ -2819,6 +3553,7 @@ def read_reduce_hessian(hessian_string, n_vars):
     return hessian
 
 
+@timed_phase('hessian_parsing')
 def read_reduce_hessian_k_aug(hessian_string, n_vars):
     hessian = np.zeros((n_vars, n_vars))
     for i, line in enumerate(hessian_string.split('\n')):
@@ -2836,56 +3571,6 @@ def read_reduce_hessian_k_aug(hessian_string, n_vars):
     return hessian
 
 
-#######################additional for inputs###CS
-def t_ij(time_set, i, j):
-    # type: (ContinuousSet, int, int) -> float
-    """Return the corresponding time(continuous set) based on the i-th finite element and j-th collocation point
-    From the NMPC_MHE framework by @dthierry.
-
-    Args:
-        time_set (ContinuousSet): Parent Continuous set
-        i (int): finite element
-        j (int): collocation point
-
-    Returns:
-        float: Corresponding index of the ContinuousSet
-    """
-    if i < time_set.get_discretization_info()['nfe']:
-        h = time_set.get_finite_elements()[i + 1] - time_set.get_finite_elements()[i]  #: This would work even for 1 fe
-    else:
-        h = time_set.get_finite_elements()[i] - time_set.get_finite_elements()[i - 1]  #: This would work even for 1 fe
-    tau = time_set.get_discretization_info()['tau_points']
-    fe = time_set.get_finite_elements()[i]
-    time = fe + tau[j] * h
-    return round(time, 6)
-
-
-def fe_cp(time_set, feedtime):
-    # type: (ContinuousSet, float) -> tuple
-    # """Return the corresponding fe and cp for a given time
-    # Args:
-    #    time_set:
-    #    t:
-    # """
-    fe_l = time_set.get_lower_element_boundary(feedtime)
-    # print("fe_l", fe_l)
-    fe = None
-    j = 0
-    for i in time_set.get_finite_elements():
-        if fe_l == i:
-            fe = j
-            break
-        j += 1
-    h = time_set.get_finite_elements()[1] - time_set.get_finite_elements()[0]
-    tauh = [i * h for i in time_set.get_discretization_info()['tau_points']]
-    j = 0  #: Watch out for LEGENDRE
-    cp = None
-    for i in tauh:
-        if round(i + fe_l, 6) == feedtime:
-            cp = j
-            break
-        j += 1
-    return fe, cp
 
 
 #: This class can replace variables from an expression
@@ -8,6 +8,9 @@ from pyomo.environ import *
 
 from kipet.library.ResultsObject import *
 from kipet.library.Simulator import *
+from kipet.library.discretization_tools import discretization_index
+from kipet.library.TemplateBuilder import SpectralData
+from kipet.library.timing_tools import timed_phase, timed_solver
 
 class ScalingVisitor(EXPR.ExpressionReplacementVisitor):
 
@@ -80,6 +83,7 @@ class PyomoSimulator(Simulator):
         if not hasattr(self.model, 'scaling_factor'):
             self.model.scaling_factor = Suffix(direction=Suffix.EXPORT)
 
+    @timed_phase('discretization')
     def apply_discretization(self, transformation, **kwargs):
         """Discretizes the model.
 
@@ -104,6 +108,8 @@ class PyomoSimulator(Simulator):
                 discretizer.apply_to(self.model, wrt=fixed_times, **kwargs)
             self._alltimes = sorted(self.model.alltime)
             self._n_alltimes = len(self._alltimes)
+            # (fe, cp) <-> time map used by the initialization and the discrete jumps
+            discretization_index(self.model.alltime)
 
             #added for optional smoothing parameter with reading values from file CS:
             if self._smoothparam_given:
@@ -263,6 +269,7 @@ class PyomoSimulator(Simulator):
         for k, v in params.items():
             self.model.P[k].value = v
 
+    @timed_phase('initialization')
     def initialize_from_trajectory(self, variable_name, trajectories):
         """Initializes discretized points with values from trajectories.
 
@@ -416,6 +423,37 @@ class PyomoSimulator(Simulator):
                 if not np.isnan(val):
                     var[t, component].value = val
 
+    @timed_phase('initialization')
+    def initialize_from_casadi(self, builder, solver=None, solver_opts=None, parameters=None):
+        """Initializes Z, dZdt, X, dXdt and Y by integrating the model with
+        CasADi directly onto the discretized time points.
+
+        Note:
+            This costs one ODE/DAE integration instead of the NLP of run_sim.
+            The parameters, initial conditions and fixed algebraics are taken
+            from the pyomo model. Discrete jumps are not applied.
+
+        Args:
+            builder (TemplateBuilder): the template the model was created with
+
+            solver (str, optional): 'cvodes' or 'idas' (defaults to idas if the
+                model has unfixed algebraics and cvodes otherwise)
+
+            solver_opts (dict, optional): options passed to the integrator
+
+            parameters (dict, optional): values of the kinetic parameters
+
+        Returns:
+            ResultsObject with the integrated trajectories
+
+        """
+        from kipet.library.casadi_tools import simulate_collocation_points, load_trajectories
+
+        results = simulate_collocation_points(self.model, builder, solver=solver,
+                                              solver_opts=solver_opts, parameters=parameters)
+        load_trajectories(self.model, results)
+        return results
+
     def scale_variables_from_trajectory(self, variable_name, trajectories):
         """Scales discretized variables with maximum value of the trajectory.
 
@@ -566,7 +604,7 @@ class PyomoSimulator(Simulator):
 
         # Look at the output in results
         # self.model.write('f.nl')
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key] = val
@@ -711,14 +749,20 @@ class PyomoSimulator(Simulator):
                 s_data_dict[t, l] = float(results.D[l][t])
 
         # Added due to estimation with fe-factory and inputs where data already loaded to model before (CS)
-        if self._spectra_given:
-            self.model.del_component(self.model.D)
-            self.model.del_component(self.model.D_index)
-        #########
-
-        self.model.D = Param(self._meas_times,
-                             self._meas_lambdas,
-                             initialize=s_data_dict)
+        if self._spectra_given and isinstance(self.model.D, SpectralData):
+            self.model.D = SpectralData(results.D, self._meas_times, self._meas_lambdas)
+        elif self._spectra_given and self.model.D.mutable:
+            # model template: the data are swapped in place
+            self.model.D.store_values(s_data_dict)
+        else:
+            if self._spectra_given:
+                self.model.del_component(self.model.D)
+                self.model.del_component(self.model.D_index)
+            #########
+
+            self.model.D = Param(self._meas_times,
+                                 self._meas_lambdas,
+                                 initialize=s_data_dict)
 
         param_vals = dict()
         for name in self.model.parameter_names:
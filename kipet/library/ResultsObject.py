@@ -6,6 +6,8 @@ from pyomo.core import *
 from pyomo.environ import *
 import six
 
+from kipet.library.timing_tools import timed_phase
+
 class ResultsObject(object):
     def __init__(self):
         """
@@ -52,6 +54,7 @@ class ResultsObject(object):
         var_array = np.array(var)
         return np.linalg.norm(var_array,norm_type)
     
+    @timed_phase('results_loading')
     def load_from_pyomo_model(self,instance,to_load=[]):
 
         model_variables = set()
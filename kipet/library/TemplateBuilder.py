@@ -12,6 +12,8 @@ import pandas as pd
 from pyomo.environ import *
 from pyomo.dae import *
 
+from kipet.library.timing_tools import timed_phase
+
 try:
     if sys.version_info.major > 3:
         import importlib
@@ -63,6 +65,60 @@ class Component():
     def __repr__(self):
         return f'Component: {self.name}, init={self.init}, sigma={self.sigma}'
 
+
+class SpectralData():
+    """Array-backed storage of the spectral data D.
+
+    The values are kept in a single numpy array with maps from the measurement
+    times and wavelengths to the rows and columns. Indexing with D[t, l]
+    returns a float, so the objective rules emit the constants straight from
+    the array without creating one pyomo Param entry per (t, l).
+    """
+    mutable = False
+
+    def __init__(self, data, times, lambdas):
+
+        self.times = list(times)
+        self.lambdas = list(lambdas)
+        self.time_index = {t: i for i, t in enumerate(self.times)}
+        self.lambda_index = {l: j for j, l in enumerate(self.lambdas)}
+        self.values = np.asarray(data.loc[self.times, self.lambdas].values, dtype=float)
+
+    def __getitem__(self, key):
+        t, l = key
+        return float(self.values[self.time_index[t], self.lambda_index[l]])
+
+    def __contains__(self, key):
+        t, l = key
+        return t in self.time_index and l in self.lambda_index
+
+    def __len__(self):
+        return self.values.size
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [(t, l) for t in self.times for l in self.lambdas]
+
+    def items(self):
+        return [((t, l), float(self.values[i, j])) for i, t in enumerate(self.times) for j, l in enumerate(self.lambdas)]
+
+    def array(self, times=None, lambdas=None):
+        """Returns the values for the given times and wavelengths as an array."""
+        rows = [self.time_index[t] for t in (self.times if times is None else times)]
+        cols = [self.lambda_index[l] for l in (self.lambdas if lambdas is None else lambdas)]
+        return self.values[np.ix_(rows, cols)]
+
+    def to_frame(self):
+        return pd.DataFrame(data=self.values.copy(), index=self.times, columns=self.lambdas)
+
+    def __str__(self):
+        return f'SpectralData: {len(self.times)} times x {len(self.lambdas)} wavelengths'
+
+    def __repr__(self):
+        return f'SpectralData: {len(self.times)} times x {len(self.lambdas)} wavelengths'
+
 class TemplateBuilder(object):
     """Helper class for creation of models.
 
@@ -837,7 +893,9 @@ class TemplateBuilder(object):
             if not self._meas_times:
                 raise RuntimeError('Need to add measurement times')
 
-    def create_pyomo_model(self, start_time=None, end_time=None, parameter_normalization=False):
+    @timed_phase('model_construction')
+    def create_pyomo_model(self, start_time=None, end_time=None, parameter_normalization=False, mutable_data=False,
+                           array_data=False):
         """Create a pyomo model.
 
         This method is the core method for further simulation or optimization studies
@@ -847,6 +905,16 @@ class TemplateBuilder(object):
 
             end_time (float): final time considered in the model
 
+            mutable_data (bool, optional): creates the spectral data D as a
+                mutable parameter so that new data on the same time/wavelength
+                grid can be loaded into the discretized model with load_data
+                (model template mode)
+
+            array_data (bool, optional): stores the spectral data D as a
+                SpectralData array instead of a pyomo Param with one entry
+                per (t, l). Reduces the memory and the build time for large
+                spectra. Cannot be combined with mutable_data
+
         Returns:
             Pyomo ConcreteModel
 
@@ -1219,7 +1287,14 @@ class TemplateBuilder(object):
                 pyomo_model.P[p].fixed = True
 
         # spectral data
-        if self._spectral_data is not None: #changed for new data structure CS
+        if self._spectral_data is not None and array_data:
+            if mutable_data:
+                raise RuntimeError('array_data and mutable_data cannot be combined')
+            pyomo_model.D = SpectralData(self._spectral_data,
+                                         sorted(pyomo_model.meas_times),
+                                         sorted(pyomo_model.meas_lambdas))
+
+        elif self._spectral_data is not None: #changed for new data structure CS
             s_data_dict = dict()
             for t in pyomo_model.meas_times:
                 for l in pyomo_model.meas_lambdas:
@@ -1230,7 +1305,8 @@ class TemplateBuilder(object):
 
             pyomo_model.D = Param(pyomo_model.meas_times,
                                   pyomo_model.meas_lambdas,
-                                  initialize=s_data_dict)
+                                  initialize=s_data_dict,
+                                  mutable=mutable_data)
         
         # unwanted contributions: create variables qr and g KH.L
         if self._qr_bounds is not None:
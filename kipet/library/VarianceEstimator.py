@@ -29,6 +29,9 @@ except ImportError:
     from io import StringIO
 
 from kipet.library.Optimizer import *
+from kipet.library.discretization_tools import t_ij, fe_cp
+from kipet.library.parallel_tools import parallel_map, default_number_of_workers
+from kipet.library.timing_tools import PhaseTimer, timed_phase, timed_solver
 
     
     
@@ -47,6 +50,7 @@ class VarianceEstimator(Optimizer):
         if not self._spectra_given:
             raise NotImplementedError("Variance estimator requires spectral data in model as model.D[ti,lj]")
         self._is_D_deriv = False
+        self._last_delta_solved = None
     def run_sim(self, solver, **kwds):
         raise NotImplementedError("VarianceEstimator object does not have run_sim method. Call run_opt")
 
@@ -84,13 +88,19 @@ class VarianceEstimator(Optimizer):
 
             init_C (DataFrame,optional): Dataframe with concentration data used to start Weifengs procedure.
 
-            report_time (bool, optional): True if variance estimation is timed. Default False
+            report_time (bool, optional): True if variance estimation is timed. Default False. The wall time
+                                            of each phase (solver, results loading, ...) is returned as a dict
+                                            in results.timing
+            
+            report_memory (bool, optional): also record the peak memory of each phase in results.timing
+                                            (only used with report_time). Default False
             
             fixed_device_variance (float, optional): If the device variance is known in advanced we can fix it here.
                                                 Only to be used in conjunction with lsq_ipopt = True.
                                                 
-            secant_point (float, optional): Provides the second point (in addition to the init_sigma) for the secant method
-                                            if not provided it will use 10 times the initial point
+            secant_point (float, optional): Provides the second point (in addition to the init_sigma) for bracketing the
+                                            overall variance in the alternate method, if not provided it will use 10 times
+                                            the initial point. The number of NLP solves used is returned as results.nlp_solves
             
             device_range (tuple, optional): when using direct sigmas approach this provides the search region for delta
             
@@ -103,12 +113,47 @@ class VarianceEstimator(Optimizer):
             
             with_plots (bool, optional): if with_plots is provided, it will plot the log objective versus the
                                             iterations for the direct_sigmas method.
+            
+            parallel (bool, optional): evaluate the delta grid of the direct_sigmas method in parallel worker
+                                            processes. Each worker solves a contiguous part of the grid with warm
+                                            starts from the neighbouring delta. Default False
+            
+            n_workers (int, optional): number of worker processes when parallel is True (default is the number
+                                            of available cores)
+            
+            anderson_acceleration (bool, optional): accelerate the Z -> S -> C fixed point iteration of the
+                                            originalchenetal method with Anderson mixing on the C iterates. The
+                                            plain step is used whenever the C residual grows. The per iteration
+                                            convergence records are returned in results.convergence_records.
+                                            Default False
+            
+            anderson_memory (int, optional): number of previous iterates used in the Anderson mixing. Default 5
+            
+            adaptive_refinement (int, optional): number of rounds in which the delta grid of the direct_sigmas
+                                            method is refined around the current minimum. Each round evaluates
+                                            num_points new deltas between the neighbours of the minimum. Default 0
 
         Returns:
 
             Results from the optimization (pyomo model)
 
         """
+        report_time = kwds.pop('report_time', False)
+        report_memory = kwds.pop('report_memory', False)
+        if not report_time:
+            return self._run_opt(solver, **kwds)
+
+        # the timer is stopped even if the solve fails
+        start = time.time()
+        with PhaseTimer(track_memory=report_memory) as timer:
+            results = self._run_opt(solver, **kwds)
+        end = time.time()
+        results.timing = timer.to_dict()
+        print("Total execution time in seconds for variance estimation:", end - start)
+        return results
+
+    def _run_opt(self, solver, **kwds):
+        """Solves the variance estimation (see run_opt). The timing options are handled by run_opt."""
 
         solver_opts = kwds.pop('solver_opts', dict())
         sigma_sq = kwds.pop('variances', dict())
@@ -121,7 +166,6 @@ class VarianceEstimator(Optimizer):
         A = kwds.pop('subset_lambdas', None)
         lsq_ipopt = kwds.pop('lsq_ipopt', False)
         init_C = kwds.pop('init_C', None)
-        report_time = kwds.pop('report_time', False)
         individual_species = kwds.pop('individual_species', False)
 
         # additional arguments for inputs CS
@@ -146,6 +190,11 @@ class VarianceEstimator(Optimizer):
         secant_point2 = kwds.pop('secant_point', None)
         num_points = kwds.pop('num_points', None)
         with_plots = kwds.pop('with_plots', False)
+        parallel = kwds.pop('parallel', False)
+        n_workers = kwds.pop('n_workers', None)
+        adaptive_refinement = kwds.pop('adaptive_refinement', 0)
+        anderson_acceleration = kwds.pop('anderson_acceleration', False)
+        anderson_memory = kwds.pop('anderson_memory', 5)
         
         if method not in ['originalchenetal', "direct_sigmas", "alternate"]:
             method = 'originalchenetal'
@@ -247,8 +296,6 @@ class VarianceEstimator(Optimizer):
             self.load_discrete_jump()
         ######################################################
 
-        if report_time:
-            start = time.time()
         if method == 'originalchenetal':    
             # solves formulation 18
             if init_C is None:
@@ -308,8 +355,21 @@ class VarianceEstimator(Optimizer):
                     self._build_s_model()
                     self._build_c_model()
                 
+            # C (and Cs) iterates used for the Anderson acceleration
+            allmeas_times = set(self._allmeas_times)
+            c_vars = list()
+            for name in ['C', 'Cs']:
+                if hasattr(self.model, name):
+                    var = getattr(self.model, name)
+                    c_vars.extend([var[idx] for idx in var if idx[0] in allmeas_times and not var[idx].is_fixed()])
+            x_hist = list()
+            g_hist = list()
+            prev_res_norm = np.inf
+            convergence_records = list()
+            
             for it in range(max_iter):
                 
+                x_k = np.array([v.value for v in c_vars], dtype=float)
                 rb = ResultsObject()
                 # added due to new structure for non_abs species, non-absorbing species not included in S and Cs as subset of C (CS):
                 if hasattr(self, '_abs_components'):
@@ -345,8 +405,36 @@ class VarianceEstimator(Optimizer):
                     #print("{: >11} {: >20} {: >16} {: >16}".format(it,Z_norm,C_norm,S_norm))
                     print("{: >11} {: >20}".format(it, Z_norm))
                 self._log_iterations(logiterfile, it)
+                
+                g_k = np.array([v.value for v in c_vars], dtype=float)
+                res_norm = np.linalg.norm(g_k - x_k, norm_order) if len(c_vars) > 0 else 0.0
+                record = {'iteration': it, 'Z_norm': Z_norm, 'C_residual_norm': res_norm, 'step': 'plain'}
+                convergence_records.append(record)
+                
                 if Z_norm<tol and it >= 1:
                     break
+                
+                if anderson_acceleration and len(c_vars) > 0:
+                    if res_norm > prev_res_norm:
+                        # safeguard: the residual grew, restart the history and take the plain step
+                        x_hist = list()
+                        g_hist = list()
+                    x_hist.append(x_k)
+                    g_hist.append(g_k)
+                    x_hist = x_hist[-(anderson_memory + 1):]
+                    g_hist = g_hist[-(anderson_memory + 1):]
+                    prev_res_norm = res_norm
+                    
+                    if len(x_hist) > 1:
+                        x_new = anderson_mixing(x_hist, g_hist)
+                        if np.all(np.isfinite(x_new)):
+                            for v, val in zip(c_vars, x_new):
+                                if v.lb is not None:
+                                    val = max(val, value(v.lb))
+                                if v.ub is not None:
+                                    val = min(val, value(v.ub))
+                                v.set_value(val)
+                            record['step'] = 'anderson'
                     
             results = ResultsObject()
             
@@ -359,6 +447,8 @@ class VarianceEstimator(Optimizer):
                 results.load_from_pyomo_model(self.model,
                                               to_load=['Z', 'dZdt', 'X', 'dXdt', 'C', 'S', 'Y'])
     
+            results.convergence_records = pd.DataFrame(convergence_records)
+            
             print('Iterative optimization converged. Estimating variances now')
             # compute variances
             solved_variances = self._solve_variances(results, fixed_dev_var = fixed_device_var)
@@ -383,101 +473,28 @@ class VarianceEstimator(Optimizer):
                 
             nu_squared = self.solve_max_device_variance('ipopt', tee = tee, subset_lambdas = A, solver_opts = solver_opts)
             
-            init_sigmas = init_sigmas
-            
             if secant_point2 is not None:
                 second_point = secant_point2
             else:
                 second_point = init_sigmas*10
-            itersigma = dict()
-            
-            itersigma[1] = init_sigmas
-            itersigma[0] = second_point
             
-            iterdelta = dict()
+            overall_sigma, new_delta, nlp_solves = self._solve_alternate_sigma('ipopt', nu_squared, init_sigmas, second_point, 
+                                                                                tol = tol, max_iter = max_iter, tee = tee, 
+                                                                                subset_lambdas = A, solver_opts = solver_opts)
             
-            count = 1
-            tol = tol
-            funcval = 1000
-            tee = False
-            
-            iterdelta[0] = self._solve_delta_given_sigma('ipopt', tee = tee, subset_lambdas = A, solver_opts = solver_opts, init_sigmas = itersigma[0])
-
-            while abs(funcval) >= tol:
-                print("overall sigma value at iteration", count,": ", itersigma[count])
-                new_delta = self._solve_delta_given_sigma('ipopt', tee = tee, subset_lambdas = A, solver_opts = solver_opts, init_sigmas = itersigma[count])
-                print("new delta_sq val: ", new_delta)
-                iterdelta[count] = new_delta
-
-                if hasattr(self, '_abs_components'):
-                    def func1(nu_squared, new_delta, init_sigmas):
-                        sigmult = 0
-                        nwp = len(self._meas_lambdas)
-                        for l in self._meas_lambdas:
-                            for k in self._abs_components:
-                               sigmult += value(self.model.S[l, k])
-                        #print("sum of absorbances: ",sigmult)
-                        funcval = nu_squared - new_delta - init_sigmas*(sigmult/nwp)
-                        return funcval, sigmult
-                else:
-                    def func1(nu_squared, new_delta, init_sigmas):
-                        sigmult = 0
-                        nwp = len(self._meas_lambdas)
-                        for l in self._meas_lambdas:
-                            for k in self._sublist_components:
-                               sigmult += value(self.model.S[l, k])
-                        #print("sum of absorbances: ",sigmult)
-                        funcval = nu_squared - new_delta - init_sigmas*(sigmult/nwp)
-                        return funcval, sigmult
-
-                if hasattr(self, '_abs_components'):
-                    def func2(nu_squared, new_delta, init_sigmas):
-                        sigmult = 0
-                        nwp = len(self._meas_lambdas)
-                        for l in self._meas_lambdas:
-                            for k in self._abs_components:
-                                sigmult += value(self.model.S[l, k])
-                        funcval = nu_squared - new_delta - init_sigmas * (sigmult / nwp)
-                        return funcval
-
-                else:
-                    def func2(nu_squared, new_delta, init_sigmas):
-                        sigmult = 0
-                        nwp = len(self._meas_lambdas)
-                        for l in self._meas_lambdas:
-                            for k in self._sublist_components:
-                               sigmult += value(self.model.S[l, k])
-                        funcval = nu_squared - new_delta - init_sigmas*(sigmult/nwp)
-                        return funcval
-
-                funcval, sigmult = func1(nu_squared, new_delta, itersigma[count])
-
-                if abs(funcval) <= tol:
-                    break
-                else:
-                    #print("continue")
-                    #print("damp*init_sigmas:", damp*init_sigmas)
-                    #print("(1 - damp)*nwp*(nu_squared - new_delta)/(sigmult)",(1 - damp)*nwp*(nu_squared - new_delta)/(sigmult))
-                    #itersigma[count + 1] = damp*itersigma[count] + (1 - damp)*nwp*(nu_squared - new_delta)/(sigmult)
-                    #numerator_secant = itersigma[count-1]*(func2(nu_squared, new_delta, itersigma[count])) - itersigma[count]*(func2(nu_squared, iterdelta[count-1], itersigma[count - 1]))
-                    denom_secant = func2(nu_squared, new_delta, itersigma[count]) - func2(nu_squared, iterdelta[count-1], itersigma[count - 1])
-                    #itersigma1= numerator_secant/denom_secant
-                    itersigma[count + 1] = itersigma[count] - func2(nu_squared, new_delta, itersigma[count])*((itersigma[count]-itersigma[count-1])/denom_secant)
-                    if itersigma[count + 1] < 0:
-                        itersigma[count + 1] = -1*itersigma[count + 1]
-                    count += 1
             if individual_species:
                 print("solving for individual species' variance based on the obtained delta")
                 max_likelihood_val, sigma_vals, stop_it, results = self._solve_sigma_given_delta(solver, subset_lambdas= A, solver_opts = solver_opts, tee=tee, delta = new_delta)
+                nlp_solves += 1
             else:
-                print("The overall model variance is: ", itersigma[count])
+                print("The overall model variance is: ", overall_sigma)
                 sigma_vals = {}
                 if hasattr(self, '_abs_components'):
                     for k in self._abs_components:
-                        sigma_vals[k] = abs(itersigma[count])
+                        sigma_vals[k] = abs(overall_sigma)
                 else:
                     for k in self._sublist_components:
-                        sigma_vals[k] = abs(itersigma[count])
+                        sigma_vals[k] = abs(overall_sigma)
             #print("residuals:",max_likelihood_val )
             results = ResultsObject()
             if hasattr(self, '_abs_components'):
@@ -494,6 +511,7 @@ class VarianceEstimator(Optimizer):
             results.P = param_vals
             results.sigma_sq = sigma_vals
             results.sigma_sq['device'] = new_delta
+            results.nlp_solves = nlp_solves
         
         elif method == 'direct_sigmas':            
             print("Solving for sigmas assuming known device variances")
@@ -529,29 +547,48 @@ class VarianceEstimator(Optimizer):
             
             if direct_or_it in ["it"]:
                 dist = abs((device_range[1] - device_range[0])/num_points)
+                deltas = [device_range[0] + i*dist for i in range(num_points)]
                 
-                max_likelihood_vals = []
-                delta_vals = []
-                iteration_counter = []
-                delta = device_range[0]
-                
-                count = 0
                 print("0000000000000000000000000000000000000000000000000000000")
                 print("000000000 ITERATION COUNT FOR VARIANCE 0000000000000000")
-                while delta < device_range[1]:
-                    print("iteration: ",count,"---------delta_sq: ",delta, "--------" )
-                    max_likelihood_val, sigma_vals, stop_it, results= self._solve_sigma_given_delta(solver, subset_lambdas= A, solver_opts = solver_opts, tee=tee,delta = delta)
-                    if max_likelihood_val >= 5000:
-                        max_likelihood_vals.append(5000)
-                        delta_vals.append(log(delta))
-                        iteration_counter.append(count)
-                    else:
-                        max_likelihood_vals.append(max_likelihood_val)
-                        delta_vals.append(log(delta))
-                        iteration_counter.append(count)
-                        
-                    delta = delta + dist
-                    count += 1 
+                evaluations = self._solve_delta_grid(solver, deltas, subset_lambdas = A, solver_opts = solver_opts, tee = tee,
+                                                     parallel = parallel, n_workers = n_workers)
+                
+                for refinement in range(adaptive_refinement):
+                    grid = sorted(evaluations.keys())
+                    best = min((d for d in grid if not evaluations[d][2]), key=lambda d: evaluations[d][0], default=None)
+                    if best is None:
+                        break
+                    i = grid.index(best)
+                    lower = grid[i - 1] if i > 0 else best
+                    upper = grid[i + 1] if i < len(grid) - 1 else best
+                    new_deltas = [d for d in np.linspace(lower, upper, num_points + 2)[1:-1] if d not in evaluations]
+                    if not new_deltas:
+                        break
+                    print("refining the delta grid around: ", best)
+                    evaluations.update(self._solve_delta_grid(solver, new_deltas, subset_lambdas = A, solver_opts = solver_opts, tee = tee,
+                                                              parallel = parallel, n_workers = n_workers))
+                
+                grid = sorted(evaluations.keys())
+                likelihood_curve = np.array([[d, np.nan if evaluations[d][2] else evaluations[d][0]] for d in grid])
+                
+                solved = [d for d in grid if not evaluations[d][2]]
+                if not solved:
+                    raise RuntimeError("The variance estimation failed for every delta in the device range")
+                delta = min(solved, key=lambda d: evaluations[d][0])
+                
+                # the model has to contain the solution at the best delta to load the results
+                if parallel or delta != self._last_delta_solved:
+                    max_likelihood_val, sigma_vals, stop_it, results = self._solve_sigma_given_delta(solver, subset_lambdas= A, solver_opts = solver_opts, tee=tee, delta = delta, warm_start = True)
+                else:
+                    sigma_vals = evaluations[delta][1]
+                
+                if with_plots:
+                    plt.plot(np.log(likelihood_curve[:, 0]), likelihood_curve[:, 1], 'o-')
+                    plt.xlabel("log(delta_sq)")
+                    plt.ylabel("objective")
+                    plt.title("Objective for the direct sigmas method")
+                    plt.show()
 
                 results = ResultsObject()
             
@@ -571,6 +608,7 @@ class VarianceEstimator(Optimizer):
                 results.P = param_vals
                 results.sigma_sq = sigma_vals
                 results.sigma_sq['device'] = delta
+                results.likelihood_curve = likelihood_curve
                 
             else:
                 max_likelihood_val, sigma_vals, stop_it= self._solve_sigma_given_delta(solver, subset_lambdas= A, solver_opts = solver_opts, tee=tee,delta = fixed_device_var)
@@ -591,9 +629,6 @@ class VarianceEstimator(Optimizer):
                 results.sigma_sq = sigma_vals
                 results.sigma_sq['device'] = delta
             
-        if report_time:
-            end = time.time()
-            print("Total execution time in seconds for variance estimation:", end - start)
         
         return results
 
@@ -646,7 +681,7 @@ class VarianceEstimator(Optimizer):
 
         for t in self._meas_times:
             for l in self._meas_lambdas:
-                if self.model.D[t, l] >= 0:
+                if value(self.model.D[t, l]) >= 0:
                     pass
                 else:
                     self._is_D_deriv = True
@@ -691,7 +726,7 @@ class VarianceEstimator(Optimizer):
                     obj += (self.model.D[t, l] - D_bar) ** 2
         self.model.init_objective = Objective(expr=obj)
         
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key]=val
@@ -754,7 +789,7 @@ class VarianceEstimator(Optimizer):
 
         for t in self._meas_times:
             for l in self._meas_lambdas:
-                if self.model.D[t, l] >= 0:
+                if value(self.model.D[t, l]) >= 0:
                     pass
                 else:
                     self._is_D_deriv = True
@@ -780,7 +815,7 @@ class VarianceEstimator(Optimizer):
          
         self.model.init_objective = Objective(expr=obj)
         
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key]=val
@@ -810,6 +845,122 @@ class VarianceEstimator(Optimizer):
 
         return deltasq
 
+    def _solve_alternate_sigma(self, solver, nu_squared, init_sigma, second_point, **kwds):
+        """Finds the overall model variance sigma for the alternate method as
+        the root of
+        
+            f(sigma) = nu_squared - delta(sigma) - sigma*sum(S)/nwp
+            
+        where delta(sigma) and S come from _solve_delta_given_sigma. The root
+        is first bracketed, starting from init_sigma and second_point, and then
+        refined with the Illinois (modified regula falsi) method. Every solve
+        is memoized together with the resulting model solution and each new
+        solve is warm started from the solution at the closest sigma.
+
+           This method is not intended to be used by users directly
+
+        Args:
+            solver (str): solver to use to solve the problems
+            
+            nu_squared (float): the maximum device variance
+            
+            init_sigma (float): first point for the bracket
+            
+            second_point (float): second point for the bracket
+            
+            tol (float, optional): tolerance on |f(sigma)|. Default 5.0e-5
+            
+            max_iter (int, optional): maximum number of NLP solves. Default 400
+            
+            Remaining keyword arguments are passed to _solve_delta_given_sigma
+
+        Returns:
+
+            sigma (float): the overall model variance
+            
+            delta (float): the device variance at sigma
+            
+            nlp_solves (int): the number of NLP solves used
+
+        """
+        tol = kwds.pop('tol', 5.0e-5)
+        max_iter = kwds.pop('max_iter', 400)
+        max_expansions = 20
+        
+        if hasattr(self, '_abs_components'):
+            components = self._abs_components
+        else:
+            components = self._sublist_components
+        nwp = len(self._meas_lambdas)
+        model_vars = list(self.model.component_data_objects(Var))
+        evaluations = dict()
+        
+        def load_solution(sigma):
+            for v, val in zip(model_vars, evaluations[sigma][2]):
+                if not v.is_fixed():
+                    v.set_value(val)
+        
+        def func(sigma):
+            sigma = abs(sigma)
+            if sigma in evaluations:
+                return evaluations[sigma][0]
+            if len(evaluations) >= max_iter:
+                raise StopIteration
+            if evaluations:
+                load_solution(min(evaluations.keys(), key=lambda x: abs(x - sigma)))
+            print("overall sigma value at iteration", len(evaluations) + 1, ": ", sigma)
+            delta = self._solve_delta_given_sigma(solver, init_sigmas = float(sigma), **dict(kwds))
+            print("new delta_sq val: ", delta)
+            sigmult = sum(value(self.model.S[l, k]) for l in self._meas_lambdas for k in components)
+            funcval = nu_squared - delta - sigma*(sigmult/nwp)
+            evaluations[sigma] = (funcval, delta, [v.value for v in model_vars])
+            return funcval
+        
+        a, b = sorted([abs(init_sigma), abs(second_point)])
+        try:
+            fa = func(a)
+            fb = func(b)
+            
+            # bracket the root, sigma stays positive
+            expansions = 0
+            while fa*fb > 0 and abs(fa) > tol and abs(fb) > tol and expansions < max_expansions:
+                if abs(fa) < abs(fb):
+                    a = a/10
+                    fa = func(a)
+                else:
+                    b = b*10
+                    fb = func(b)
+                expansions += 1
+            
+            if fa*fb < 0:
+                # Illinois method
+                side = 0
+                while True:
+                    c = (a*fb - b*fa)/(fb - fa)
+                    fc = func(c)
+                    if abs(fc) < tol or abs(b - a) < tol*max(1.0, abs(c)):
+                        break
+                    if fc*fb > 0:
+                        b, fb = c, fc
+                        if side == -1:
+                            fa /= 2
+                        side = -1
+                    else:
+                        a, fa = c, fc
+                        if side == 1:
+                            fb /= 2
+                        side = 1
+            elif abs(fa) > tol and abs(fb) > tol:
+                print("WARNING: Could not bracket the overall model variance, using the best point found")
+            
+        except StopIteration:
+            print("WARNING: Maximum number of NLP solves reached for the alternate method")
+        
+        sigma = min(evaluations.keys(), key=lambda x: abs(evaluations[x][0]))
+        load_solution(sigma)
+        
+        return sigma, evaluations[sigma][1], len(evaluations)
+    
     def _solve_delta_given_sigma(self, solver, **kwds):
         """Solves the maximum likelihood formulation with fixed sigmas in order to
         obtain delta. This formulation is highly unstable as the problem is ill-posed
@@ -871,7 +1022,7 @@ class VarianceEstimator(Optimizer):
 
         for t in self._meas_times:
             for l in self._meas_lambdas:
-                if self.model.D[t, l] >= 0:
+                if value(self.model.D[t, l]) >= 0:
                     pass
                 else:
                     self._is_D_deriv = True
@@ -908,7 +1059,7 @@ class VarianceEstimator(Optimizer):
         #obj += (ntp*nc/2)*log((inlog/(ntp*nc))+self.model.eps)              
         self.model.init_objective = Objective(expr=obj)
         
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key]=val
@@ -960,6 +1111,9 @@ class VarianceEstimator(Optimizer):
             (Weifeng paper). Default all wavelengths.
             
             solver_opts (dict, optional): dictionary containing solver options for IPOPT
+            
+            warm_start (bool, optional): warm start IPOPT from the current solution and bound multipliers
+            of the model (e.g. from the previous delta). Default False
 
         Returns:
 
@@ -980,6 +1134,7 @@ class VarianceEstimator(Optimizer):
         profile_time = kwds.pop('profile_time', False)
         delta = kwds.pop('delta', dict())
         species_list = kwds.pop('subset_components', None)
+        warm_start = kwds.pop('warm_start', False)
 
         if not set_A:
             set_A = self._meas_lambdas
@@ -1002,7 +1157,7 @@ class VarianceEstimator(Optimizer):
 
         for t in self._meas_times:
             for l in self._meas_lambdas:
-                if self.model.D[t, l] >= 0:
+                if value(self.model.D[t, l]) >= 0:
                     pass
                 else:
                     self._is_D_deriv = True
@@ -1067,10 +1222,19 @@ class VarianceEstimator(Optimizer):
                        
         self.model.init_objective = Objective(expr=obj)
 
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
+        
+        if warm_start and len(self.model.ipopt_zL_out) > 0:
+            self.model.ipopt_zL_in.update(self.model.ipopt_zL_out)
+            self.model.ipopt_zU_in.update(self.model.ipopt_zU_out)
+            opt.options['warm_start_init_point'] = 'yes'
+            opt.options['warm_start_bound_push'] = 1e-6
+            opt.options['warm_start_mult_bound_push'] = 1e-6
+            opt.options['mu_init'] = 1e-6
 
         for key, val in solver_opts.items():
             opt.options[key]=val
+        self._last_delta_solved = delta
         try:
             solver_results = opt.solve(self.model,
                                    tee=tee,
@@ -1154,6 +1318,47 @@ class VarianceEstimator(Optimizer):
         all_variances['device'] = delta
         return all_variances
     
+    def _solve_delta_grid(self, solver, deltas, **kwds):
+        """Solves the maximum likelihood problem for each device variance in
+        deltas. The deltas are solved in increasing order and every solve is
+        warm started from the neighbouring delta. If parallel is True, the grid
+        is split into contiguous parts that are solved in worker processes.
+
+           This method is not intended to be used by users directly
+
+        Args:
+            solver (str): solver to use to solve the problems
+            
+            deltas (list): the device variances to evaluate
+            
+            parallel (bool, optional): solve the grid in worker processes
+            
+            n_workers (int, optional): number of worker processes
+            
+            Remaining keyword arguments are passed to _solve_sigma_given_delta
+
+        Returns:
+
+            evaluations (dict): delta: (residuals, variancesdict, stop_it)
+
+        """
+        parallel = kwds.pop('parallel', False)
+        n_workers = kwds.pop('n_workers', None)
+        deltas = sorted(deltas)
+        
+        if parallel:
+            if n_workers is None:
+                n_workers = default_number_of_workers()
+            n_chunks = max(1, min(n_workers, len(deltas)))
+            chunks = [list(c) for c in np.array_split(deltas, n_chunks) if len(c) > 0]
+            results = parallel_map(_solve_delta_chunk, [(solver, chunk, kwds) for chunk in chunks], n_workers=n_chunks, shared=self)
+            evaluations = dict()
+            for res in results:
+                evaluations.update(res)
+            return evaluations
+        
+        return _solve_delta_chunk(self, (solver, deltas, kwds))
+    
     def _solve_iterative_init(self, solver, **kwds):
         """This method first fixes params and makes C = Z to solve for S. Requires fixed delta and sigmas.
         following this, the parameters are freed to users bounds and full problem is solved with fixed variances.
@@ -1207,7 +1412,7 @@ class VarianceEstimator(Optimizer):
 
         for t in self._meas_times:
             for l in self._meas_lambdas:
-                if self.model.D[t, l] >= 0:
+                if value(self.model.D[t, l]) >= 0:
                     pass
                 else:
                     self._is_D_deriv = True
@@ -1244,7 +1449,7 @@ class VarianceEstimator(Optimizer):
                     obj += (self.model.D[t, l] - D_bar) ** 2
         self.model.init_objective = Objective(expr=obj)
         
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key]=val
@@ -1305,7 +1510,7 @@ class VarianceEstimator(Optimizer):
 
         m.objective = Objective(rule=rule_objective) 
         
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key]=val
@@ -1370,7 +1575,7 @@ class VarianceEstimator(Optimizer):
         if profile_time:
             print('-----------------Solve_Z--------------------')
             
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key]=val
@@ -1838,7 +2043,7 @@ class VarianceEstimator(Optimizer):
                     for w, k in enumerate(self._abs_components):
                         A[i, w] = results.S[k][l] ** 2
                         D_bar += results.S[k][l] * results.Z[k][t]
-                    b[i] += (self.model.D[t, l] - D_bar) ** 2
+                    b[i] += (value(self.model.D[t, l]) - D_bar) ** 2
                 b[i] *= reciprocal_nt
 
             if fixed_dev_var == None:
@@ -1917,7 +2122,7 @@ class VarianceEstimator(Optimizer):
                     for w, k in enumerate(self._sublist_components):
                         A[i, w] = results.S[k][l]**2
                         D_bar += results.S[k][l]*results.Z[k][t]
-                    b[i] += (self.model.D[t, l]-D_bar)**2
+                    b[i] += (value(self.model.D[t, l])-D_bar)**2
                 b[i] *= reciprocal_nt
 
             if fixed_dev_var == None:
@@ -1999,10 +2204,13 @@ class VarianceEstimator(Optimizer):
             None
 
         """
-        self._d_array = np.zeros((self._n_meas_times,self._n_meas_lambdas))
-        for i,t in enumerate(self._meas_times):
-            for j,l in enumerate(self._meas_lambdas):
-                self._d_array[i,j] = self.model.D[t,l]
+        if isinstance(self.model.D, SpectralData):
+            self._d_array = self.model.D.array(self._meas_times, self._meas_lambdas)
+        else:
+            self._d_array = np.zeros((self._n_meas_times,self._n_meas_lambdas))
+            for i,t in enumerate(self._meas_times):
+                for j,l in enumerate(self._meas_lambdas):
+                    self._d_array[i,j] = value(self.model.D[t,l])
 
         # added due to new structure for non_abs species, non-absorbing species not included in S and Cs as subset of C (CS):
         if hasattr(self,'_abs_components'):
@@ -2178,7 +2386,7 @@ class VarianceEstimator(Optimizer):
         if profile_time:
             print('-----------------Solve_S--------------------')
 
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key]=val
@@ -2275,7 +2483,7 @@ class VarianceEstimator(Optimizer):
         if profile_time:
             print('-----------------Solve_C--------------------')
 
-        opt = SolverFactory(solver)
+        opt = timed_solver(SolverFactory(solver))
 
         for key, val in solver_opts.items():
             opt.options[key]=val
@@ -2402,6 +2610,40 @@ class VarianceEstimator(Optimizer):
                     kn = kn + 1
 #############################################################
 
+def _solve_delta_chunk(estimator, task):
+    """Solves _solve_sigma_given_delta for a sorted list of deltas with warm
+    starts from the previous delta. Used by VarianceEstimator._solve_delta_grid
+    (also as the worker function) and not meant to be used directly by users.
+    """
+    solver, deltas, kwds = task
+    evaluations = dict()
+    for count, delta in enumerate(deltas):
+        print("iteration: ",count,"---------delta_sq: ",delta, "--------" )
+        residuals, sigma_vals, stop_it, results = estimator._solve_sigma_given_delta(solver, delta=float(delta), warm_start=count > 0, **dict(kwds))
+        evaluations[float(delta)] = (residuals, sigma_vals, stop_it)
+    return evaluations
+
+def anderson_mixing(x_hist, g_hist):
+    """Anderson mixing (type II) for the fixed point iteration x = g(x).
+    
+    Args:
+        x_hist (list): the previous iterates x_i (numpy arrays)
+        
+        g_hist (list): the fixed point map evaluations g(x_i)
+        
+    Returns:
+        x_new (numpy.ndarray): the extrapolated iterate
+        
+    """
+    X = np.array(x_hist).T
+    G = np.array(g_hist).T
+    F = G - X
+    dF = np.diff(F, axis=1)
+    dG = np.diff(G, axis=1)
+    gamma = np.linalg.lstsq(dF, F[:, -1], rcond=None)[0]
+    
+    return G[:, -1] - dG.dot(gamma)
+
 def add_warm_start_suffixes(model):
     # Ipopt bound multipliers (obtained from solution)
     model.ipopt_zL_out = Suffix(direction=Suffix.IMPORT)
@@ -2420,56 +2662,6 @@ def compute_diff_results(results1,results2):
     diff_results.C = results1.C - results2.C
     return diff_results
 
-#######################additional for inputs###CS
-def t_ij(time_set, i, j):
-    # type: (ContinuousSet, int, int) -> float
-    """Return the corresponding time(continuous set) based on the i-th finite element and j-th collocation point
-    From the NMPC_MHE framework by @dthierry.
-
-    Args:
-        time_set (ContinuousSet): Parent Continuous set
-        i (int): finite element
-        j (int): collocation point
-
-    Returns:
-        float: Corresponding index of the ContinuousSet
-    """
-    if i < time_set.get_discretization_info()['nfe']:
-        h = time_set.get_finite_elements()[i + 1] - time_set.get_finite_elements()[i]  #: This would work even for 1 fe
-    else:
-        h = time_set.get_finite_elements()[i] - time_set.get_finite_elements()[i - 1]  #: This would work even for 1 fe
-    tau = time_set.get_discretization_info()['tau_points']
-    fe = time_set.get_finite_elements()[i]
-    time = fe + tau[j] * h
-    return round(time, 6)
-
-
-def fe_cp(time_set, feedtime):
-    # type: (ContinuousSet, float) -> tuple
-    # """Return the corresponding fe and cp for a given time
-    # Args:
-    #    time_set:
-    #    t:
-    # """
-    fe_l = time_set.get_lower_element_boundary(feedtime)
-    # print("fe_l", fe_l)
-    fe = None
-    j = 0
-    for i in time_set.get_finite_elements():
-        if fe_l == i:
-            fe = j
-            break
-        j += 1
-    h = time_set.get_finite_elements()[1] - time_set.get_finite_elements()[0]
-    tauh = [i * h for i in time_set.get_discretization_info()['tau_points']]
-    j = 0  #: Watch out for LEGENDRE
-    cp = None
-    for i in tauh:
-        if round(i + fe_l, 6) == feedtime:
-            cp = j
-            break
-        j += 1
-    return fe, cp
 ###########################################################
 
 #: This class can replace variables from an expression
@@ -15,10 +15,10 @@ except ImportError:
  
  
 if found_casadi: 
-    __all__ = ['CasadiModel','TemplateBuilder','BaseAbstractModel','CasadiSimulator',
-               'data_tools','fe_factory','Optimizer','ParameterEstimator','PyomoSimulator',
+    __all__ = ['CasadiModel','TemplateBuilder','BaseAbstractModel','CasadiSimulator','casadi_tools',
+               'data_tools','discretization_tools','fe_factory','model_cache','moving_horizon','parallel_tools','timing_tools','Optimizer','ParameterEstimator','PyomoSimulator',
                'ResultsObject','Simulator','VarianceEstimator','FESimulator'] 
 else: 
     __all__ = ['TemplateBuilder','BaseAbstractModel',
-               'data_tools','fe_factory','Optimizer','ParameterEstimator',
+               'data_tools','discretization_tools','fe_factory','model_cache','moving_horizon','parallel_tools','timing_tools','Optimizer','ParameterEstimator',
                'PyomoSimulator','ResultsObject','Simulator','VarianceEstimator','FESimulator']  
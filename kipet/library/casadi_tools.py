@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+Simulation of a KIPET model with the CasADi integrators (CVODES/IDAS) directly
+onto the collocation points of a discretized pyomo model.
+
+Initializing an estimator with PyomoSimulator.run_sim (or fe_factory) solves
+an NLP over the whole discretized model. The integrators of CasADi give the
+same trajectories for the cost of one ODE/DAE integration, which are then
+loaded in bulk into the pyomo variables.
+
+Example:
+
+    p_estimator = ParameterEstimator(model)
+    p_estimator.apply_discretization('dae.collocation', nfe=60, ncp=3, scheme='LAGRANGE-RADAU')
+    p_estimator.initialize_from_casadi(builder)
+    results = p_estimator.run_opt('ipopt', ...)
+
+Discrete jumps (dosing points) are not applied by the integration.
+"""
+import casadi as ca
+import numpy as np
+import pandas as pd
+from pyomo.environ import value
+
+from kipet.library.CasadiModel import KipetCasadiStruct
+from kipet.library.ResultsObject import ResultsObject
+
+#=============================================================================
+#-------------------------------CASADI TOOLS----------------------------------
+#=============================================================================
+
+def _fixed_algebraics(model):
+    """Returns the algebraics that are fixed at all times in the pyomo model (inputs)."""
+    if not hasattr(model, 'Y'):
+        return []
+    fixed = []
+    for k in model.algebraics:
+        if all(model.Y[t, k].fixed for t in model.alltime):
+            fixed.append(k)
+    return fixed
+
+def _casadi_problem(model, builder, solver=None, solver_opts=None):
+    """Builds the integrator of the model of the builder over the time points
+    of the discretized pyomo model.
+
+    The parameters are symbolic and every interval is mapped to (0,1), so that
+    one integrator, accumulated with mapaccum, covers the whole horizon. Its
+    parameters are the start and length of the interval, the kinetic
+    parameters and the fixed algebraics (inputs). If the model is scaled
+    (set_parameter_scaling), the parameters are the scaled ones of model.P, as
+    in the pyomo odes.
+
+    Returns:
+        problem (dict): the integrator and the data needed to evaluate it
+
+    """
+    if not model.alltime.get_discretization_info():
+        raise RuntimeError('apply discretization first before initializing')
+    if solver_opts is None:
+        solver_opts = dict()
+
+    times = sorted(model.alltime)
+    c_model = builder.create_casadi_model(times[0], times[-1])
+
+    # rebuilds the expressions with symbolic parameters
+    parameter_names = list(model.parameter_names)
+    c_model.P = KipetCasadiStruct('P', parameter_names)
+    c_model.odes = builder._odes(c_model, 0)
+    c_model.alg_exprs = list(builder._algebraic_constraints(c_model, 0)) if builder._algebraic_constraints else []
+
+    components = list(model.mixture_components)
+    states_names = list(model.complementary_states)
+    algebraics_names = list(model.algebraics) if hasattr(model, 'algebraics') else []
+    inputs = _fixed_algebraics(model)
+    unfixed = [k for k in algebraics_names if k not in inputs]
+
+    states = ca.vertcat(*([c_model.Z[k] for k in components] + [c_model.X[k] for k in states_names]))
+    algebraics = ca.vertcat(*[c_model.Y[k] for k in unfixed])
+    p_syms = ca.vertcat(*([c_model.P[p] for p in parameter_names] + [c_model.Y[k] for k in inputs]))
+    ode = ca.vertcat(*[c_model.odes[k] for k in components + states_names])
+    alg = ca.vertcat(*c_model.alg_exprs)
+    if hasattr(model, 'K'):
+        # scaled model: the pyomo odes use K[p]*P[p] (see PyomoSimulator.scale_parameters)
+        p_vec = ca.vertcat(*[c_model.P[p] for p in parameter_names])
+        scaled = ca.vertcat(*[value(model.K[p])*c_model.P[p] for p in parameter_names])
+        ode = ca.substitute(ode, p_vec, scaled)
+        if alg.numel():
+            alg = ca.substitute(alg, p_vec, scaled)
+    if alg.numel() != len(unfixed):
+        raise RuntimeError('The number of algebraic equations ({}) does not match the number of '
+                           'unfixed algebraics ({})'.format(alg.numel(), len(unfixed)))
+
+    if solver is None:
+        solver = 'idas' if unfixed else 'cvodes'
+
+    tau = ca.SX.sym('tau')
+    t_start = ca.SX.sym('t_start')
+    h = ca.SX.sym('h')
+    t_expr = t_start + h*tau
+    dae = {'t': tau, 'x': states, 'p': ca.vertcat(t_start, h, p_syms),
+           'ode': h*ca.substitute(ode, c_model.t, t_expr)}
+    if unfixed:
+        dae['z'] = algebraics
+        dae['alg'] = ca.substitute(alg, c_model.t, t_expr)
+    integrator = ca.integrator('I', solver, dae, 0.0, 1.0, solver_opts)
+
+    # the first interval is a tiny step that gives consistent algebraics at the initial time
+    n = len(times)
+    t_first = [times[0]] + times[:-1]
+    steps = [1.0e-12] + [times[i] - times[i - 1] for i in range(1, n)]
+    u_array = np.array([[value(model.Y[t, k]) for k in inputs] for t in times]).reshape((n, len(inputs)))
+
+    x0 = [value(model.Z[times[0], k]) for k in components] + [value(model.X[times[0], k]) for k in states_names]
+    z0 = [value(model.Y[times[0], k]) if model.Y[times[0], k].value is not None else 1.0 for k in unfixed]
+
+    return {'times': times, 'components': components, 'states_names': states_names,
+            'unfixed': unfixed, 'inputs': inputs, 'parameter_names': parameter_names,
+            'integrator': integrator.mapaccum('I_acc', n, 2 if unfixed else 1),
+            'fun_ode': ca.Function('odeFunc', [c_model.t, states, algebraics, p_syms], [ode]),
+            'interval_array': np.column_stack([t_first, steps]), 'u_array': u_array,
+            'x0': x0, 'z0': z0}
+
+def _integrate(problem, p_values, x0=None):
+    """Evaluates the accumulated integrator for the (numeric or symbolic MX)
+    parameter values. Returns the states and algebraics (one column per time point)."""
+    if x0 is None:
+        x0 = problem['x0']
+    n = len(problem['times'])
+    p_rows = ca.repmat(ca.reshape(p_values, 1, -1), n, 1) if isinstance(p_values, ca.MX) \
+        else np.tile(p_values, (n, 1))
+    p_all = ca.horzcat(problem['interval_array'], p_rows, problem['u_array']).T
+    if problem['unfixed']:
+        res = problem['integrator'](x0=x0, z0=problem['z0'], p=p_all)
+        return res['xf'], res['zf']
+    res = problem['integrator'](x0=x0, p=p_all)
+    return res['xf'], None
+
+def simulate_collocation_points(model, builder, solver=None, solver_opts=None, parameters=None):
+    """Integrates the model of the builder with CasADi and returns the
+    trajectories at the time points of the discretized pyomo model.
+
+    The kinetic parameters, the initial conditions and the fixed algebraics
+    (inputs, piecewise constant between the time points) are taken from the
+    pyomo model. The integration runs over all the intervals between time
+    points in a single call.
+
+    Args:
+        model (ConcreteModel): the discretized pyomo model
+
+        builder (TemplateBuilder): the template the model was created with
+
+        solver (str, optional): 'cvodes' or 'idas' (defaults to idas if the
+            model has unfixed algebraics and cvodes otherwise)
+
+        solver_opts (dict, optional): options passed to the integrator
+
+        parameters (dict, optional): values of the kinetic parameters
+            (defaults to the current values in the pyomo model)
+
+    Returns:
+        results (ResultsObject): Z, dZdt, X, dXdt and Y indexed by the time
+        points of the pyomo model
+
+    """
+    problem = _casadi_problem(model, builder, solver, solver_opts)
+    times = problem['times']
+    components = problem['components']
+    n = len(times)
+
+    if parameters is None:
+        parameters = dict((p, value(model.P[p])) for p in problem['parameter_names'])
+    p_values = [parameters[p] for p in problem['parameter_names']]
+
+    xf, zf = _integrate(problem, p_values)
+    x_array = np.array(xf).T
+    z_array = np.array(zf).T if zf is not None else np.zeros((n, 0))
+    if np.isnan(x_array).any():
+        raise RuntimeError('The integrator returned nan. exiting the program')
+
+    # derivatives at all the time points in one evaluation
+    p_array = np.column_stack([np.tile(p_values, (n, 1)), problem['u_array']])
+    dx_array = np.array(problem['fun_ode'].map(n)(np.array(times).reshape((1, n)),
+                                                  x_array.T, z_array.T, p_array.T)).T
+
+    n_c = len(components)
+    states_names = problem['states_names']
+    results = ResultsObject()
+    results.Z = pd.DataFrame(data=x_array[:, :n_c], columns=components, index=times)
+    results.dZdt = pd.DataFrame(data=dx_array[:, :n_c], columns=components, index=times)
+    results.X = pd.DataFrame(data=x_array[:, n_c:], columns=states_names, index=times)
+    results.dXdt = pd.DataFrame(data=dx_array[:, n_c:], columns=states_names, index=times)
+    results.Y = pd.DataFrame(data=np.hstack([z_array, problem['u_array']]),
+                             columns=problem['unfixed'] + problem['inputs'], index=times)
+    results.P = dict(parameters)
+    return results
+
+def parameter_sensitivities(model, builder, times, components, solver=None, solver_opts=None, parameters=None):
+    """Computes the sensitivities of the concentrations Z with respect to the
+    kinetic parameters with the forward sensitivities of the CasADi integrator.
+
+    Args:
+        model (ConcreteModel): the discretized pyomo model
+
+        builder (TemplateBuilder): the template the model was created with
+
+        times (list): time points of the rows (must be time points of the model)
+
+        components (list): components of the rows
+
+        solver (str, optional): 'cvodes' or 'idas'
+
+        solver_opts (dict, optional): options passed to the integrator
+
+        parameters (dict, optional): values of the kinetic parameters
+            (defaults to the current values in the pyomo model)
+
+    Returns:
+        dzdp (numpy array): sensitivities with one row per (time, component),
+        ordered by time and then component, and one column per parameter
+        (of model.P, i.e. the scaled parameters for a scaled model)
+
+        parameter_names (list): the parameters of the columns
+
+    """
+    problem = _casadi_problem(model, builder, solver, solver_opts)
+    parameter_names = problem['parameter_names']
+    if parameters is None:
+        parameters = dict((p, value(model.P[p])) for p in parameter_names)
+
+    p_sym = ca.MX.sym('P', len(parameter_names))
+    xf, zf = _integrate(problem, p_sym)
+    sens = ca.Function('sens', [p_sym], [ca.jacobian(ca.vec(xf), p_sym)])
+    jac = np.array(sens([parameters[p] for p in parameter_names]))
+
+    n_x = len(problem['components']) + len(problem['states_names'])
+    time_rows = dict((t, i) for i, t in enumerate(problem['times']))
+    comp_rows = dict((k, i) for i, k in enumerate(problem['components']))
+    rows = [time_rows[t]*n_x + comp_rows[k] for t in times for k in components]
+    return jac[rows, :], parameter_names
+
+def _sample_matrix(samples, names, defaults):
+    """Returns the samples (DataFrame, list of dicts or array) as an array with
+    one row per sample and one column per name. Missing names take the default."""
+    if samples is None:
+        return np.array([defaults])
+    if isinstance(samples, pd.DataFrame):
+        samples = samples.to_dict('records')
+    if len(samples) and isinstance(samples[0], dict):
+        unknown = set(k for sample in samples for k in sample.keys()) - set(names)
+        if unknown:
+            raise RuntimeError('Unknown names in the samples: {}'.format(sorted(unknown, key=str)))
+        return np.array([[sample.get(k, d) for k, d in zip(names, defaults)] for sample in samples], dtype=float)
+    samples = np.atleast_2d(np.asarray(samples, dtype=float))
+    if samples.shape[1] != len(names):
+        raise RuntimeError('The samples must have {} columns ({})'.format(len(names), names))
+    return samples
+
+def simulate_ensemble(model, builder, parameter_sets=None, initial_conditions=None, times=None,
+                      solver=None, solver_opts=None, parallelization='thread', n_threads=None):
+    """Simulates the model for a batch of parameter sets and initial conditions.
+
+    The integrator is built once and mapped over the samples with the map of
+    CasADi, which evaluates the samples in parallel threads.
+
+    Args:
+        model (ConcreteModel): the discretized pyomo model (defines the time
+            points, the inputs and the default values)
+
+        builder (TemplateBuilder): the template the model was created with
+
+        parameter_sets (DataFrame, list or array, optional): one sample per
+            row; a DataFrame or list of dicts keyed by parameter name, or an
+            array with the parameters in the order of model.parameter_names.
+            Missing parameters take their value in the pyomo model. For a
+            scaled model these are the scaled values (relative to model.K)
+
+        initial_conditions (DataFrame, list or array, optional): initial
+            states (components, then complementary states) per sample, in the
+            same formats. If both are given they must have the same number of
+            samples, a single row is broadcast
+
+        times (list, optional): time points returned (defaults to all the
+            time points of the model)
+
+        solver (str, optional): 'cvodes' or 'idas'
+
+        solver_opts (dict, optional): options passed to the integrator
+
+        parallelization (str, optional): 'serial', 'thread' or 'openmp'
+
+        n_threads (int, optional): number of threads (defaults to the number
+            of available cores)
+
+    Returns:
+        trajectories (numpy array): sample x time x state
+
+        times (list): the time points of the second axis
+
+        states (list): the states of the third axis (components, then
+        complementary states)
+
+    """
+    problem = _casadi_problem(model, builder, solver, solver_opts)
+    parameter_names = problem['parameter_names']
+    state_names = problem['components'] + problem['states_names']
+
+    p_samples = _sample_matrix(parameter_sets, parameter_names, [value(model.P[p]) for p in parameter_names])
+    x_samples = _sample_matrix(initial_conditions, state_names, problem['x0'])
+    n_samples = max(len(p_samples), len(x_samples))
+    if len(p_samples) not in (1, n_samples) or len(x_samples) not in (1, n_samples):
+        raise RuntimeError('The parameter sets and the initial conditions must have the same number of samples')
+    p_samples = np.broadcast_to(p_samples, (n_samples, p_samples.shape[1]))
+    x_samples = np.broadcast_to(x_samples, (n_samples, x_samples.shape[1]))
+
+    p_sym = ca.MX.sym('P', len(parameter_names))
+    x0_sym = ca.MX.sym('x0', len(state_names))
+    xf, zf = _integrate(problem, p_sym, x0=x0_sym)
+    single = ca.Function('single', [p_sym, x0_sym], [xf])
+
+    if n_threads is None:
+        from kipet.library.parallel_tools import default_number_of_workers
+        n_threads = default_number_of_workers()
+    if parallelization == 'thread':
+        ensemble = single.map(n_samples, 'thread', n_threads)
+    else:
+        ensemble = single.map(n_samples, parallelization)
+    out = np.array(ensemble(p_samples.T, x_samples.T))
+
+    all_times = problem['times']
+    trajectories = out.T.reshape((n_samples, len(all_times), len(state_names)))
+    if times is not None:
+        rows = dict((t, i) for i, t in enumerate(all_times))
+        trajectories = trajectories[:, [rows[t] for t in times], :]
+    else:
+        times = all_times
+    return trajectories, list(times), state_names
+
+def load_trajectories(model, results, to_load=('Z', 'dZdt', 'X', 'dXdt', 'Y')):
+    """Loads trajectories indexed by the time points of the model into the
+    pyomo variables at once. Fixed variables are not modified.
+
+    Args:
+        model (ConcreteModel): the discretized pyomo model
+
+        results (ResultsObject): object with the trajectories as DataFrames
+
+        to_load (tuple, optional): names of the variables to load
+
+    Returns:
+        None
+
+    """
+    for name in to_load:
+        frame = getattr(results, name, None)
+        if frame is None or not hasattr(model, name) or frame.empty:
+            continue
+        var = getattr(model, name)
+        columns = dict((k, i) for i, k in enumerate(frame.columns))
+        rows = dict((t, i) for i, t in enumerate(frame.index))
+        data = frame.values
+        values = dict()
+        for index, var_data in var.items():
+            t, k = index
+            if var_data.fixed or t not in rows or k not in columns:
+                continue
+            values[index] = float(data[rows[t], columns[k]])
+        var.set_values(values)
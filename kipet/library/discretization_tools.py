@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Mapping between the finite elements/collocation points of a discretized
+ContinuousSet and its time points.
+
+The index is built once per discretization and stored on the ContinuousSet,
+so that t_ij and fe_cp are dictionary lookups instead of fetching the finite
+elements and the discretization info of the set on every call.
+"""
+import bisect
+
+#=============================================================================
+#--------------------------DISCRETIZATION TOOLS-------------------------------
+#=============================================================================
+
+class DiscretizationIndex(object):
+    """Maps (finite element, collocation point) <-> time for a discretized
+    ContinuousSet.
+
+    Attributes:
+
+        nfe (int): number of finite elements
+
+        tau (list): collocation points in the unit interval
+
+        finite_elements (list): the finite element boundaries
+
+    """
+    def __init__(self, time_set):
+        info = time_set.get_discretization_info()
+        self.nfe = info['nfe']
+        self.tau = list(info['tau_points'])
+        self.finite_elements = list(time_set.get_finite_elements())
+        self._n_points = len(time_set)
+
+        self._times = dict()
+        self._fe_cp = dict()
+        for i, fe in enumerate(self.finite_elements):
+            if i < self.nfe:
+                h = self.finite_elements[i + 1] - fe
+            else:
+                h = fe - self.finite_elements[i - 1]
+            for j, tau in enumerate(self.tau):
+                time = round(fe + tau * h, 6)
+                self._times[i, j] = time
+                # a time on an element boundary belongs to the element ending there
+                self._fe_cp.setdefault(time, (i, j))
+
+    def matches(self, time_set):
+        """Checks whether the index still describes the discretization of the set."""
+        return len(time_set) == self._n_points and time_set.get_discretization_info().get('nfe') == self.nfe
+
+    def time(self, i, j):
+        """Returns the time of the j-th collocation point of the i-th finite element."""
+        return self._times[i, j]
+
+    def fe_cp(self, time):
+        """Returns the finite element and the collocation point of a time. The
+        collocation point is None if the time is not a collocation point."""
+        key = round(time, 6)
+        if key in self._fe_cp:
+            return self._fe_cp[key]
+        fe = bisect.bisect_right(self.finite_elements, time) - 1
+        return (fe if fe >= 0 else None), None
+
+def discretization_index(time_set):
+    """Returns the DiscretizationIndex of a discretized ContinuousSet. It is
+    built on the first call and stored on the set.
+
+    Args:
+        time_set (ContinuousSet): the discretized set
+
+    Returns:
+        index (DiscretizationIndex): the index
+
+    """
+    index = getattr(time_set, '_kipet_discretization_index', None)
+    if index is None or not index.matches(time_set):
+        index = DiscretizationIndex(time_set)
+        time_set._kipet_discretization_index = index
+    return index
+
+def t_ij(time_set, i, j):
+    # type: (ContinuousSet, int, int) -> float
+    """Return the corresponding time(continuous set) based on the i-th finite element and j-th collocation point
+    From the NMPC_MHE framework by @dthierry.
+
+    Args:
+        time_set (ContinuousSet): Parent Continuous set
+        i (int): finite element
+        j (int): collocation point
+
+    Returns:
+        float: Corresponding index of the ContinuousSet
+    """
+    return discretization_index(time_set).time(i, j)
+
+def fe_cp(time_set, feedtime):
+    # type: (ContinuousSet, float) -> tuple
+    """Return the corresponding fe and cp for a given time
+
+    Args:
+        time_set (ContinuousSet): Parent Continuous set
+        feedtime (float): the time
+
+    Returns:
+        tuple: finite element and collocation point (None if the time is not a collocation point)
+    """
+    return discretization_index(time_set).fe_cp(feedtime)
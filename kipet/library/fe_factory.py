@@ -15,6 +15,7 @@ from pyomo.core.expr.numvalue import NumericConstant
 import numpy as np
 import math
 import pandas as pd
+from kipet.library.discretization_tools import t_ij, fe_cp
 
 
 __author__ = 'David M Thierry'  #: April 2018
@@ -338,6 +339,74 @@ class fe_initialize(object):
             raise Exception("Inconsistent problem; n={}, m={}".format(n, m))
         self.jump = False
 
+        self._build_transfer_maps()
+
+    def _build_transfer_maps(self):
+        """Precomputes the variable data objects that are copied by patch and
+        cycle_ics.
+
+        The source variables of the initializing model are the same for every
+        finite element, only the target time changes. The maps are built once
+        here so that patch and cycle_ics are plain loops over pairs of variable
+        data objects.
+        """
+        ts = getattr(self.mod, self.time_set)
+        ttgt = getattr(self.tgt, self.time_set)
+
+        #: Variables not indexed by time: same target for every element
+        self._weird_src = []
+        self._weird_tgt = []
+        #: Variables indexed by time: one target list per finite element
+        self._patch_src = []
+        self._patch_index = []  #: (target variable, collocation point, remaining index)
+        for v in self.mod.component_objects(Var, active=True):
+            v_tgt = getattr(self.tgt, v.name)
+            if v.name in self.weird_vars:
+                for k in v.keys():
+                    self._weird_src.append(v[k])
+                    self._weird_tgt.append(v_tgt[k])
+                continue
+            if v.name in self.dvs_names:
+                drs = self.remaining_set[v.name]
+            else:
+                drs = self.remaining_set_alg[v.name]
+            for j in range(0, self.ncp + 1):
+                t_src = t_ij(ts, 0, j)
+                if drs is None:
+                    self._patch_src.append(v[t_src])
+                    self._patch_index.append((v_tgt, j, None))
+                    continue
+                for k in drs:
+                    for key in k:
+                        key = key if isinstance(key, tuple) else (key,)
+                        self._patch_src.append(v[(t_src,) + key])
+                        self._patch_index.append((v_tgt, j, key))
+
+        self._patch_tgt = []
+        for fe in range(0, self.nfe):
+            t_tgt = [t_ij(ttgt, fe, j) for j in range(0, self.ncp + 1)]
+            self._patch_tgt.append([v_tgt[t_tgt[j]] if key is None else v_tgt[(t_tgt[j],) + key]
+                                    for v_tgt, j, key in self._patch_index])
+
+        #: States at the end of the element and at t=0 of the initializing model
+        t_last = t_ij(ts, 0, self.ncp)
+        self._ics_src = []
+        self._ics_tgt = []
+        self._ics_keys = []  #: (state name, remaining index)
+        for i in self.dvs_names:
+            dv = getattr(self.mod, i)
+            if self.remaining_set[i] is None:
+                self._ics_src.append(dv[t_last])
+                self._ics_tgt.append(dv[0])
+                self._ics_keys.append((i, None))
+                continue
+            for s in self.remaining_set[i]:
+                for k in s:
+                    k = k if isinstance(k, tuple) else (k,)
+                    self._ics_src.append(dv[(t_last,) + k])
+                    self._ics_tgt.append(dv[(0,) + k])
+                    self._ics_keys.append((i, k))
+
     def load_initial_conditions(self, init_cond=None):
         if not isinstance(init_cond, dict):
             raise Exception("init_cond must be a dictionary")
@@ -377,6 +446,21 @@ class fe_initialize(object):
             fe (int): The correspoding finite element.
         """
         print("fe {}".format(fe))
+        self.solve_element(fe)
+        self.patch(fe)
+        self.cycle_ics(fe)
+
+    def solve_element(self, fe, tee=True):
+        # type: (int, bool) -> None
+        """Solves the initializing model for the `fe-th` element from the current initial conditions.
+
+        Adjust h and inputs.
+        Solve current problem (retrying with restoration and bound relaxation).
+
+        Args:
+            fe (int): The correspoding finite element.
+            tee (bool): Stream the solver output.
+        """
         self.adjust_h(fe)
         if self.inputs or self.inputs_sub:
             self.load_input(fe)
@@ -393,14 +477,14 @@ class fe_initialize(object):
         self.ip.options["print_level"] = 1  #: change this on demand
         # self.ip.options["start_with_resto"] = 'no'
         self.ip.options['bound_push'] = 1e-02
-        sol = self.ip.solve(self.mod, tee=True, symbolic_solver_labels=True)
+        sol = self.ip.solve(self.mod, tee=tee, symbolic_solver_labels=True)
 
         if sol.solver.termination_condition != TerminationCondition.optimal:
             self.ip.options["OF_start_with_resto"] = 'yes'
             # self.ip.options["linear_solver"] = "ma57"
             # for i in self.mod.component_objects(Var):
             #     i.pprint()
-            sol = self.ip.solve(self.mod, tee=True, symbolic_solver_labels=True)
+            sol = self.ip.solve(self.mod, tee=tee, symbolic_solver_labels=True)
             if sol.solver.termination_condition != TerminationCondition.optimal:
                 self.ip.options["OF_start_with_resto"] = 'no'
                 self.ip.options["bound_push"] = 1E-02
@@ -416,15 +500,13 @@ class fe_initialize(object):
                 #         i.setlb(-0.05)
                 #     else:
                 #         i.setlb(None)
-                sol = self.ip.solve(self.mod, tee=True, symbolic_solver_labels=True)
+                sol = self.ip.solve(self.mod, tee=tee, symbolic_solver_labels=True)
                 self.ip.options["OF_bound_relax_factor"] = 1E-08
                 if sol.solver.termination_condition != TerminationCondition.optimal:
                     raise Exception("The current iteration was unsuccessful. Iteration :{}".format(fe))
 
-        else:
+        elif tee:
             print("fe {} - status: optimal".format(fe))
-        self.patch(fe)
-        self.cycle_ics(fe)
 
     #Inclusion of discrete jumps: (CS)
     def load_discrete_jump(self, var_dic, jump_times, feed_times):
@@ -465,25 +547,11 @@ class fe_initialize(object):
         #print("Current Finite element [cycle_ics]{}".format(curr_fe)) #comment out these lines?
         #print('*' * 20)
 
-        ts = getattr(self.mod, self.time_set)
-        t_last = t_ij(ts, 0, self.ncp)
-
         #Inclusion of discrete jumps: (CS)
-        for i in self.dvs_names:
-            dv = getattr(self.mod, i)
-            for s in self.remaining_set[i]:
-                if s is None:
-                    val = value(dv[t_last])
-                    dv[0].set_value(val)
-                    if not dv[0].fixed:
-                        dv[0].fix()
-                    continue
-                for k in s:
-                    k = k if isinstance(k, tuple) else (k,)
-                    val = value(dv[(t_last,) + k])
-                    dv[(0,) + k].set_value(val)
-                    if not dv[(0,) + k].fixed:
-                        dv[(0,) + k].fix()
+        for src, tgt in zip(self._ics_src, self._ics_tgt):
+            tgt.value = value(src)
+            if not tgt.fixed:
+                tgt.fix()
 
     def patch(self, fe):
         # type: (int) -> None
@@ -493,53 +561,28 @@ class fe_initialize(object):
         Args:
             fe (int): The current finite element to be patched (tgt_model).
         """
-        ###########################
-        ts = getattr(self.mod, self.time_set)
-        ttgt = getattr(self.tgt, self.time_set)
-        # with open('model_mod.txt', 'w') as f1:
-        #     self.mod.pprint(ostream = f1)
-        # with open('model_tgt.txt', 'w') as f2:
-        #     self.tgt.pprint(ostream = f2)
-        for v in self.mod.component_objects(Var, active=True):
-            v_tgt = getattr(self.tgt, v.name)
-            if v.name in self.weird_vars:  #: This has got to work.
-                for k in v.keys():
-                    if v[k].stale or v[k].is_fixed():
-                        continue
-                    try:
-                        val = value(v[k])
-                    except ValueError:
-                        pass
-                    v_tgt[k].set_value(val)
+        #: Fixed and stale variables are skipped as a safeguard
+        for src, tgt in zip(self._weird_src, self._weird_tgt):
+            if src.stale or src.fixed or src.value is None:
                 continue
-            #: From this point on all variables are indexed over time.
-            if v.name in self.dvs_names:
-                drs = self.remaining_set[v.name]
-            else:
-                drs = self.remaining_set_alg[v.name]
-            for j in range(0, self.ncp + 1):
-                t_tgt = t_ij(ttgt, fe, j)
-                t_src = t_ij(ts, 0, j)
+            tgt.value = src.value
+        for src, tgt in zip(self._patch_src, self._patch_tgt[fe]):
+            if src.stale or src.fixed:
+                continue
+            if src.value is None:
+                print("Error at {}".format(src.name))
+                continue
+            tgt.value = src.value
+        self.patch_jumps(fe)
 
-                if drs is None:
-                    if v[t_src].stale or v[t_src].is_fixed():
-                        continue
-                    try:
-                        val = value(v[t_src])
-                    except ValueError:
-                        print("Error at {}, {}".format(v.name, t_src))
-                    v_tgt[t_tgt].set_value(val)
-                    continue
-                for k in drs:
-                    for key in k:
-                        key = key if isinstance(key, tuple) else (key,)
-                        if v[(t_src,) + key].stale or v[(t_src,) + key].is_fixed():
-                            continue
-                        try:
-                            val = value(v[(t_src,) + key])
-                        except ValueError:
-                            print("Error at {}, {}".format(v.name, (t_src,) + key))
-                        v_tgt[(t_tgt,) + key].set_value(val)
+    def patch_jumps(self, fe):
+        # type: (int) -> None
+        """ Replaces the states of the tgt_model after the discrete jumps that take place in the element before fe.
+
+        Args:
+            fe (int): The current finite element to be patched (tgt_model).
+        """
+        ttgt = getattr(self.tgt, self.time_set)
         ##############################
         #Inclusion of discrete jumps: (CS)
         if self.jump:
@@ -625,6 +668,104 @@ class fe_initialize(object):
         for i in range(0, len(self.fe_list)):
             self.march_forward(i, resto_strategy=resto_strategy)
 
+    def run_multiple_shooting(self, guess=None, n_groups=None, n_workers=None, max_iter=None, tol=1e-6):
+        # type: (dict, int, int, int, float) -> int
+        """Solves the elements by multiple shooting in parallel worker processes.
+
+        The elements are split into groups of consecutive elements. Every group is marched forward from a guess
+        of the states at its first element, all groups at the same time. The groups whose initial states do not
+        match the final states of the group before (continuity defects) are solved again from those final
+        states until all the defects are within the tolerance. The first group starts from the true initial
+        conditions, so after k iterations the first k groups are exact: the method needs at most as many
+        iterations as there are groups, and far fewer with a good guess (e.g. a coarse CasADi integration).
+
+        Args:
+            guess (dict): Map of differential state name to a DataFrame (time x remaining index) with the guess
+                of its trajectory. The values are interpolated at the beginning of every group. States missing
+                from the guess start from their initial conditions.
+            n_groups (int): Number of groups of elements (defaults to the number of workers).
+            n_workers (int): Number of worker processes (defaults to the number of available cores).
+            max_iter (int): Maximum number of iterations (defaults to the number of groups).
+            tol (float): Tolerance of the continuity defects (relative to the magnitude of the states).
+
+        Returns:
+            int: The number of iterations.
+        """
+        from kipet.library.parallel_tools import parallel_map, default_number_of_workers
+
+        if n_workers is None:
+            n_workers = default_number_of_workers()
+        if n_groups is None:
+            n_groups = n_workers
+        n_groups = max(1, min(n_groups, self.nfe))
+        if max_iter is None:
+            max_iter = n_groups
+        bounds = np.linspace(0, self.nfe, n_groups + 1).round().astype(int)
+        groups = [list(range(bounds[g], bounds[g + 1])) for g in range(n_groups)]
+
+        print("*" * 5, end='\t')
+        print("Fe Factory: multiple shooting", end='\t')
+        print("*" * 5)
+        print("*" * 5 + '\tSolving for {} elements in {} groups\t'.format(len(self.fe_list), n_groups) + "*" * 5)
+
+        ttgt = getattr(self.tgt, self.time_set)
+        starts = [[value(v) for v in self._ics_tgt]]
+        for g in range(1, n_groups):
+            starts.append(self._states_from_guess(guess, t_ij(ttgt, groups[g][0], 0), starts[0]))
+
+        values = dict()
+        ends = [None] * n_groups
+        to_solve = list(range(n_groups))
+        for it in range(1, max_iter + 1):
+            tasks = [(groups[g], starts[g]) for g in to_solve]
+            results = parallel_map(_shoot_group, tasks, n_workers=n_workers, shared=self)
+            for g, (group_values, end) in zip(to_solve, results):
+                values.update(group_values)
+                ends[g] = end
+
+            to_solve = []
+            max_defect = 0.0
+            for g in range(1, n_groups):
+                defect = max([abs(a - b) / (1.0 + abs(a)) for a, b in zip(ends[g - 1], starts[g])] + [0.0])
+                max_defect = max(max_defect, defect)
+                if defect > tol:
+                    to_solve.append(g)
+                    starts[g] = list(ends[g - 1])
+            print("iteration {} - max. continuity defect {:.3e}".format(it, max_defect))
+            if not to_solve:
+                break
+        else:
+            print("***WARNING: The continuity defects did not converge in {} iterations".format(max_iter))
+
+        for fe in range(0, self.nfe):
+            weird_values, fe_values = values[fe]
+            for tgt, val in zip(self._weird_tgt, weird_values):
+                if val is not None:
+                    tgt.value = val
+            for tgt, val in zip(self._patch_tgt[fe], fe_values):
+                if val is not None:
+                    tgt.value = val
+            self.patch_jumps(fe)
+        return it
+
+    def _states_from_guess(self, guess, time, default):
+        # type: (dict, float, list) -> list
+        """Interpolates the guess of the differential states at time (ordered as the initial conditions)."""
+        states = list(default)
+        if not guess:
+            return states
+        for n, (name, key) in enumerate(self._ics_keys):
+            if name not in guess:
+                continue
+            traj = guess[name]
+            if isinstance(traj, pd.DataFrame):
+                column = traj.columns[0] if key is None else (key[0] if len(key) == 1 else key)
+                if column not in traj.columns:
+                    continue
+                traj = traj[column]
+            states[n] = float(np.interp(time, np.asarray(traj.index, dtype=float), np.asarray(traj.values, dtype=float)))
+        return states
+
     def load_input(self, fe):
         # type: (int) -> None
         """ Loads the current value of input from tgt_model into the initializing model at the current fe.
@@ -688,27 +829,32 @@ class fe_initialize(object):
 
 
 
-def t_ij(time_set, i, j):
-    # type: (ContinuousSet, int, int) -> float
-    """Return the corresponding time(continuous set) based on the i-th finite element and j-th collocation point
-    From the NMPC_MHE framework by @dthierry.
+
+
+def _shoot_group(init, task):
+    # type: (fe_initialize, tuple) -> tuple
+    """Worker of fe_initialize.run_multiple_shooting: marches forward over a group of elements.
 
     Args:
-        time_set (ContinuousSet): Parent Continuous set
-        i (int): finite element
-        j (int): collocation point
+        init (fe_initialize): The initializer (a copy inherited by the worker process).
+        task (tuple): The elements of the group and the initial states of its first element.
 
     Returns:
-        float: Corresponding index of the ContinuousSet
+        tuple: Map of element to the values to patch (None where patch skips the variable), and the final states.
     """
-    if i < time_set.get_discretization_info()['nfe']:
-        h = time_set.get_finite_elements()[i + 1] - time_set.get_finite_elements()[i]  #: This would work even for 1 fe
-    else:
-        h = time_set.get_finite_elements()[i] - time_set.get_finite_elements()[i - 1]  #: This would work even for 1 fe
-    tau = time_set.get_discretization_info()['tau_points']
-    fe = time_set.get_finite_elements()[i]
-    time = fe + tau[j] * h
-    return round(time, 6)
+    group, start = task
+    for tgt, val in zip(init._ics_tgt, start):
+        tgt.value = val
+        if not tgt.fixed:
+            tgt.fix()
+    values = dict()
+    for fe in group:
+        init.solve_element(fe, tee=False)
+        weird_values = [None if (v.stale or v.fixed) else v.value for v in init._weird_src]
+        fe_values = [None if (v.stale or v.fixed) else v.value for v in init._patch_src]
+        values[fe] = (weird_values, fe_values)
+        init.cycle_ics(fe)
+    return values, [value(v) for v in init._ics_tgt]
 
 
 def write_nl(d_mod, filename=None):
@@ -770,35 +916,6 @@ def disp_vars(model, file):
             c.pprint(ostream=f)
         f.close()
 
-#Function needed for inclusion of discrete jump to get fe and cp:
-def fe_cp(time_set, feedtime):
-    # type: (ContinuousSet, float) -> tuple
-    # """Return the corresponding fe and cp for a given time
-    # Args:
-    #    time_set:
-    #    t:
-    # """
-    fe_l = time_set.get_lower_element_boundary(feedtime)
-   # print("fe_l", fe_l)
-    fe = None
-    j = 0
-    for i in time_set.get_finite_elements():
-        if fe_l == i:
-            fe = j
-            break
-        j += 1
-    h = time_set.get_finite_elements()[1] - time_set.get_finite_elements()[0]
-    tauh = [i * h for i in time_set.get_discretization_info()['tau_points']]
-    j = 0  #: Watch out for LEGENDRE
-    cp = None
-    for i in tauh:
-        if round(i + fe_l, 6) == feedtime:
-            cp = j
-            break
-        j += 1
-    return fe, cp
-
-
 #: This class can replace variables from an expression
 class ReplacementVisitor(EXPR.ExpressionReplacementVisitor):
     def __init__(self):
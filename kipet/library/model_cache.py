@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Cache for discretized KIPET models.
+
+Building a model with TemplateBuilder.create_pyomo_model and discretizing it
+with pyomo.dae is repeated for the simulator and every estimator, often with
+identical settings. The ModelCache fingerprints the content of the builder
+together with the model and discretization options, keeps one pristine
+discretized model per fingerprint and hands out clones of it. The pristine
+models can also be pickled to a local directory so that runs on the same host
+skip the construction and the discretization altogether. The fingerprint also
+covers the pyomo version and the source of kipet.library, so that pickled
+models are not reused after an update of either.
+
+Example:
+
+    model = create_discretized_model(builder, 0.0, 10.0, nfe=60, ncp=3,
+                                     scheme='LAGRANGE-RADAU')
+    p_estimator = ParameterEstimator(model)
+    # no call to apply_discretization is needed
+
+Pickling a pyomo model that contains rules defined inside functions requires
+cloudpickle (or dill). Without either, or if the model cannot be pickled, the
+cache is kept in memory only.
+"""
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyomo.version
+
+try:
+    import cloudpickle as model_pickle
+except ImportError:
+    try:
+        import dill as model_pickle
+    except ImportError:
+        model_pickle = pickle
+
+#=============================================================================
+#--------------------------------MODEL CACHE----------------------------------
+#=============================================================================
+
+def _global_names(code):
+    """Returns the names used by a code object and the code objects nested in
+    it (lambdas, comprehensions)."""
+    names = set(code.co_names)
+    for c in code.co_consts:
+        if inspect.iscode(c):
+            names.update(_global_names(c))
+    return names
+
+# packages whose functions are hashed by name only (the standard library too)
+_library_packages = ('numpy', 'scipy', 'pandas', 'pyomo', 'casadi', 'six', 'kipet')
+_kipet_source_hash = None
+
+def _is_library_module(name):
+    """Checks whether a module belongs to the standard library or an installed
+    package, as opposed to the modules of the user (e.g. a file with rate laws
+    next to the script)."""
+    if not name:
+        return True
+    top = name.split('.')[0]
+    if top in _library_packages or top == 'builtins' or top in getattr(sys, 'stdlib_module_names', ()):
+        return True
+    path = getattr(sys.modules.get(top), '__file__', None) or ''
+    return 'site-packages' in path or 'dist-packages' in path
+
+def kipet_source_hash():
+    """Returns a hash of the source of kipet.library, so that models pickled by
+    another version of KIPET are not served from the cache."""
+    global _kipet_source_hash
+    if _kipet_source_hash is None:
+        h = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                h.update(name.encode())
+                with open(os.path.join(directory, name), 'rb') as f:
+                    h.update(f.read())
+        _kipet_source_hash = h.hexdigest()
+    return _kipet_source_hash
+
+def _update_hash_global(h, obj, module, _depth, _seen):
+    """Adds a module global used by a function to the hash h. Modules, classes
+    and the functions of the standard library and installed packages (numpy,
+    pyomo, ...) are hashed by name only, the other values (constants, helper
+    functions of the user, also when imported from another module) by their
+    content."""
+    if inspect.ismodule(obj):
+        h.update(obj.__name__.encode())
+    elif inspect.isclass(obj) or inspect.isbuiltin(obj) or (
+            callable(obj) and getattr(obj, '__module__', None) != module and
+            _is_library_module(getattr(obj, '__module__', None))):
+        h.update('{}.{}'.format(getattr(obj, '__module__', None),
+                                getattr(obj, '__qualname__', type(obj).__name__)).encode())
+    else:
+        _update_hash(h, obj, _depth, _seen)
+
+def _update_hash(h, obj, _depth=0, _seen=None):
+    """Adds the content of obj to the hash h.
+
+    DataFrames are hashed by their values, index and columns, functions (the
+    rules of the builder) by their byte code, constants, the values of their
+    closures and the values of the module globals they use. Containers are
+    hashed recursively.
+    """
+    if _seen is None:
+        _seen = set()
+    if _depth > 20 or id(obj) in _seen:
+        h.update(type(obj).__name__.encode())
+        return
+    if isinstance(obj, (dict, set, frozenset, list, tuple)) or inspect.isfunction(obj) or hasattr(obj, '__dict__'):
+        _seen.add(id(obj))
+
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(b'frame')
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+        if isinstance(obj, pd.DataFrame):
+            h.update(repr(list(obj.columns)).encode())
+    elif isinstance(obj, np.ndarray):
+        h.update(b'array')
+        h.update(repr(obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'dict')
+        for k in sorted(obj.keys(), key=repr):
+            h.update(repr(k).encode())
+            _update_hash(h, obj[k], _depth + 1, _seen)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(b'set')
+        for v in sorted(obj, key=repr):
+            _update_hash(h, v, _depth + 1, _seen)
+    elif isinstance(obj, (list, tuple)):
+        h.update(type(obj).__name__.encode())
+        for v in obj:
+            _update_hash(h, v, _depth + 1, _seen)
+    elif inspect.ismethod(obj):
+        _update_hash(h, obj.__func__, _depth + 1, _seen)
+    elif inspect.isfunction(obj):
+        code = obj.__code__
+        h.update(b'function')
+        h.update(code.co_code)
+        h.update(repr(code.co_names).encode())
+        _update_hash(h, [c for c in code.co_consts if not inspect.iscode(c)], _depth + 1, _seen)
+        for c in code.co_consts:
+            if inspect.iscode(c):
+                h.update(c.co_code)
+        for name in sorted(_global_names(code)):
+            if name in obj.__globals__:
+                h.update(name.encode())
+                _update_hash_global(h, obj.__globals__[name], obj.__module__, _depth + 1, _seen)
+        if obj.__closure__:
+            for cell in obj.__closure__:
+                try:
+                    _update_hash(h, cell.cell_contents, _depth + 1, _seen)
+                except ValueError:
+                    pass
+        if obj.__defaults__:
+            _update_hash(h, obj.__defaults__, _depth + 1, _seen)
+    elif isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        h.update(repr(obj).encode())
+    elif hasattr(obj, '__dict__'):
+        h.update(type(obj).__name__.encode())
+        _update_hash(h, vars(obj), _depth + 1, _seen)
+    else:
+        h.update(repr(obj).encode())
+
+def builder_fingerprint(builder, start_time=None, end_time=None, create_options=None,
+                        transformation='dae.collocation', **kwargs):
+    """Returns a fingerprint of the builder content together with the model and
+    discretization options, the pyomo version and the source of KIPET.
+
+    Args:
+        builder (TemplateBuilder): the template
+
+        start_time (float, optional): start time passed to create_pyomo_model
+
+        end_time (float, optional): end time passed to create_pyomo_model
+
+        create_options (dict, optional): other keywords of create_pyomo_model
+
+        transformation (str, optional): the pyomo.dae transformation
+
+        kwargs: the options of the transformation (nfe, ncp, scheme, ...)
+
+    Returns:
+        fingerprint (str): hex digest
+
+    """
+    h = hashlib.sha256()
+    h.update(pyomo.version.version.encode())
+    h.update(kipet_source_hash().encode())
+    _update_hash(h, vars(builder))
+    _update_hash(h, [start_time, end_time, create_options or dict(), transformation, kwargs])
+    return h.hexdigest()
+
+def _discretize(model, transformation, kwargs):
+    """Discretizes and initializes the model as the simulator/estimators do."""
+    from kipet.library.PyomoSimulator import PyomoSimulator
+    simulator = PyomoSimulator(model)
+    simulator.apply_discretization(transformation, **kwargs)
+    return model
+
+class ModelCache(object):
+    """Keeps pristine discretized models keyed by the builder fingerprint and
+    hands out clones.
+
+    Attributes:
+
+        cache_dir (str): directory for the pickled models (None for an
+            in-memory cache only)
+
+        max_models (int): maximum number of models kept in memory
+
+        hits (int): number of models served from the cache
+
+        misses (int): number of models that had to be built
+
+    """
+    def __init__(self, cache_dir=None, max_models=10):
+        self.cache_dir = cache_dir
+        self.max_models = max_models
+        self.hits = 0
+        self.misses = 0
+        self._models = dict()
+        self._order = []
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, 'kipet_model_{}.pkl'.format(key))
+
+    def _store(self, key, model):
+        if key not in self._models:
+            self._order.append(key)
+        self._models[key] = model
+        while len(self._order) > self.max_models:
+            del self._models[self._order.pop(0)]
+
+    def _load_from_disk(self, key):
+        if self.cache_dir is None or not os.path.isfile(self._filename(key)):
+            return None
+        try:
+            with open(self._filename(key), 'rb') as f:
+                return model_pickle.load(f)
+        except Exception as e:
+            print('***WARNING: Could not read the cached model {}: {}'.format(key, e))
+            return None
+
+    def _save_to_disk(self, key, model):
+        if self.cache_dir is None:
+            return
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                model_pickle.dump(model, f)
+            os.replace(tmp_name, self._filename(key))
+        except Exception as e:
+            os.remove(tmp_name)
+            print('***WARNING: The model cannot be pickled, it is only cached in memory: {}'.format(e))
+
+    def get_model(self, builder, start_time=None, end_time=None, transformation='dae.collocation',
+                  create_options=None, **kwargs):
+        """Returns a discretized model for the builder. The model is built and
+        discretized only if no model with the same fingerprint is cached.
+
+        Args:
+            builder (TemplateBuilder): the template
+
+            start_time (float, optional): start time passed to create_pyomo_model
+
+            end_time (float, optional): end time passed to create_pyomo_model
+
+            transformation (str, optional): the pyomo.dae transformation
+
+            create_options (dict, optional): other keywords of
+                create_pyomo_model (e.g. mutable_data)
+
+            kwargs: the options of the transformation (nfe, ncp, scheme, ...)
+
+        Returns:
+            model (ConcreteModel): a clone of the pristine discretized model
+
+        """
+        if create_options is None:
+            create_options = dict()
+        key = builder_fingerprint(builder, start_time, end_time, create_options, transformation, **kwargs)
+
+        model = self._models.get(key)
+        if model is None:
+            model = self._load_from_disk(key)
+            if model is not None:
+                self._store(key, model)
+
+        if model is None:
+            self.misses += 1
+            model = builder.create_pyomo_model(start_time, end_time, **create_options)
+            _discretize(model, transformation, dict(kwargs))
+            self._store(key, model)
+            self._save_to_disk(key, model)
+        else:
+            self.hits += 1
+
+        return model.clone()
+
+    def clear(self, disk=False):
+        """Removes the models from memory (and optionally from the directory).
+
+        Args:
+            disk (bool, optional): also remove the pickled models
+
+        Returns:
+            None
+
+        """
+        self._models = dict()
+        self._order = []
+        if disk and self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.startswith('kipet_model_') and name.endswith('.pkl'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+_default_cache = ModelCache()
+
+def create_discretized_model(builder, start_time=None, end_time=None, transformation='dae.collocation',
+                             cache=None, **kwargs):
+    """Creates the pyomo model of the builder and discretizes it, reusing a
+    cached model with the same fingerprint if there is one.
+
+    Args:
+        builder (TemplateBuilder): the template
+
+        start_time (float, optional): start time passed to create_pyomo_model
+
+        end_time (float, optional): end time passed to create_pyomo_model
+
+        transformation (str, optional): the pyomo.dae transformation
+
+        cache (ModelCache, optional): the cache (defaults to the in-memory
+            cache of this module)
+
+        create_options (dict, optional): other keywords of create_pyomo_model
+
+        kwargs: the options of the transformation (nfe, ncp, scheme, ...)
+
+    Returns:
+        model (ConcreteModel): the discretized model
+
+    """
+    if cache is None:
+        cache = _default_cache
+    return cache.get_model(builder, start_time, end_time, transformation, **kwargs)
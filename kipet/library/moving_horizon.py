@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Moving-horizon estimation of the kinetic parameters from streaming spectra.
+
+New spectra are appended to a rolling window of the last measurements and the
+parameters (and states) are re-estimated over the window after each update.
+The window is solved on a relative time axis that starts at the first spectrum
+of the window. If the spectra are sampled regularly, the relative grid does
+not change when the window moves, so the discretized model is built once: on
+each update the data is swapped in place, the primal values are shifted by the
+window step, the multipliers of the last solve are shifted in the same way and
+ipopt is started warm from them. Otherwise the model is rebuilt for the new
+grid and initialized from the previous estimate.
+
+The model has to be autonomous (no explicit dependence on time, inputs or
+feeds), since the time axis is reset at every window.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import copy
+import time
+
+import numpy as np
+import pandas as pd
+from pyomo.environ import *
+
+from kipet.library.ParameterEstimator import ParameterEstimator
+
+#=============================================================================
+#--------------------------MOVING HORIZON ESTIMATION--------------------------
+#=============================================================================
+
+_trajectories = ['Z', 'dZdt', 'X', 'dXdt', 'Y', 'C']
+
+def _shift_suffix(suffix, delta, times):
+    """Shifts the values of a suffix on time indexed components by delta, in
+    place. The value of the component data at t takes the value it had at
+    t + delta; data whose shifted time falls out of the window keeps its value.
+
+    Args:
+        suffix (Suffix): the suffix (duals or bound multipliers)
+
+        delta (float): the step of the window
+
+        times (set): the (rounded) time points of the model
+
+    Returns:
+        None
+
+    """
+    by_component = dict()
+    for data, val in list(suffix.items()):
+        index = data.index()
+        if not isinstance(index, tuple):
+            index = (index,)
+        if not index or not isinstance(index[0], (int, float)):
+            continue
+        by_component.setdefault(data.parent_component(), dict())[(round(index[0], 6),) + index[1:]] = (data, val)
+
+    for component, entries in by_component.items():
+        if not all(key[0] in times for key in entries):
+            continue
+        for key, (data, val) in entries.items():
+            source = entries.get((round(key[0] + delta, 6),) + key[1:])
+            if source is not None:
+                suffix[data] = source[1]
+
+class MovingHorizonEstimator(object):
+    """Estimates the parameters over a rolling window of spectra.
+
+    Attributes:
+
+        builder (TemplateBuilder): copy of the builder of the model
+
+        window (int): number of spectra in the window
+
+        spectra (DataFrame): spectra of the current window (absolute times)
+
+        init_conditions (dict): states at the start of the current window
+
+        results (ResultsObject): estimate of the last update (absolute times)
+
+        latencies (list): wall time of each update
+
+    """
+    def __init__(self, builder, variances, **kwds):
+        """MovingHorizonEstimator constructor.
+
+        Args:
+            builder (TemplateBuilder): builder of the model with the parameters,
+            components and odes. Its spectral data (if any) is ignored
+
+            variances (dict): map of component name to noise variance. The map
+            also contains the device noise variance
+
+            window (int, optional): number of spectra in the window (default 20)
+
+            nfe (int, optional): number of finite elements of the window (default
+            one per interval between spectra)
+
+            ncp (int, optional): number of collocation points (default 3)
+
+            scheme (str, optional): collocation scheme (default 'LAGRANGE-RADAU')
+
+            solver (str, optional): nonlinear solver (default 'ipopt')
+
+            solver_opts (dict, optional): options passed to the nonlinear solver
+
+            max_latency (float, optional): bound on the cpu time of each update in
+            seconds, passed to ipopt as max_cpu_time. If the bound is hit, the
+            last iterate is published
+
+            time_tol (float, optional): tolerance to consider two window grids equal
+
+        """
+        self.builder = copy.deepcopy(builder)
+        self.variances = variances
+        self.window = kwds.pop('window', 20)
+        self.nfe = kwds.pop('nfe', None)
+        self.ncp = kwds.pop('ncp', 3)
+        self.scheme = kwds.pop('scheme', 'LAGRANGE-RADAU')
+        self.solver = kwds.pop('solver', 'ipopt')
+        self.solver_opts = kwds.pop('solver_opts', dict())
+        self.max_latency = kwds.pop('max_latency', None)
+        self.time_tol = kwds.pop('time_tol', 1e-6)
+        if kwds:
+            raise RuntimeError('Unknown options {}'.format(list(kwds.keys())))
+        if self.window < 2:
+            raise RuntimeError('The window needs at least two spectra')
+
+        self.spectra = None
+        self.init_conditions = dict(self.builder._init_conditions)
+        self.results = None
+        self.latencies = list()
+
+        self._estimator = None
+        self._grid = None
+        self._t0 = None
+        self._parameter_history = list()
+
+    @property
+    def parameter_history(self):
+        """DataFrame with the parameter estimates of each update, indexed by
+        the time of the last spectrum of the window."""
+        if not self._parameter_history:
+            return pd.DataFrame()
+        times = [t for t, p in self._parameter_history]
+        return pd.DataFrame([p for t, p in self._parameter_history], index=times)
+
+    def update(self, spectra, tee=False):
+        """Appends new spectra to the window and re-estimates the parameters.
+
+        Args:
+            spectra (DataFrame): new spectra (times x wavelengths), on the
+            wavelengths of the previous ones
+
+            tee (bool, optional): flag to stream the solver output
+
+        Returns:
+            Results object of the window (with absolute times), or None while
+            the window has less than two spectra
+
+        """
+        start = time.time()
+        if self.spectra is None:
+            data = spectra
+        else:
+            if list(spectra.columns) != list(self.spectra.columns):
+                raise RuntimeError('The new spectra must be given on the wavelengths of the previous ones')
+            data = pd.concat([self.spectra, spectra])
+        data = data[~data.index.duplicated(keep='last')].sort_index()
+        self.spectra = data.iloc[-self.window:]
+        if len(self.spectra.index) < 2:
+            return None
+
+        times = [float(t) for t in self.spectra.index]
+        t0 = times[0]
+        grid = [round(t - t0, 6) for t in times]
+
+        if self.results is not None:
+            self.init_conditions = self._states_at(t0)
+
+        reuse = (self._estimator is not None and len(grid) == len(self._grid) and
+                 np.allclose(grid, self._grid, atol=self.time_tol))
+        if reuse:
+            self._shift(t0 - self._t0)
+            d_window = self.spectra.copy()
+            d_window.index = self._grid
+            self._estimator.load_data(D=d_window)
+        else:
+            self._build(grid)
+
+        m = self._estimator.model
+        for k, v in self.init_conditions.items():
+            m.init_conditions[k] = v
+        self._t0 = t0
+
+        opts = dict(self.solver_opts)
+        if self.max_latency is not None:
+            opts['max_cpu_time'] = self.max_latency
+        if reuse and self.solver == 'ipopt':
+            opts.setdefault('warm_start_init_point', 'yes')
+            opts.setdefault('warm_start_bound_push', 1e-9)
+            opts.setdefault('warm_start_mult_bound_push', 1e-9)
+
+        results = self._estimator.run_opt(self.solver,
+                                          variances=self.variances,
+                                          solver_opts=opts,
+                                          warmstart=True,
+                                          tee=tee)
+
+        for name in _trajectories + ['D']:
+            frame = getattr(results, name, None)
+            if isinstance(frame, pd.DataFrame) and not frame.empty:
+                frame.index = [round(t + t0, 6) for t in frame.index]
+        self.results = results
+        self._parameter_history.append((times[-1], dict(results.P)))
+        self.latencies.append(time.time() - start)
+        return results
+
+    def _states_at(self, t):
+        """Interpolates the states of the last estimate at the (absolute) time t."""
+        states = dict(self.init_conditions)
+        for name in ['Z', 'X']:
+            frame = getattr(self.results, name, None)
+            if not isinstance(frame, pd.DataFrame) or frame.empty:
+                continue
+            index = np.array(frame.index, dtype=float)
+            for k in frame.columns:
+                states[k] = float(np.interp(t, index, frame[k].values))
+        return states
+
+    def _build(self, grid):
+        """Builds and discretizes the model of a window with relative times grid,
+        and initializes it from the last estimate."""
+        d_window = self.spectra.copy()
+        d_window.index = grid
+        self.builder._init_conditions.update(self.init_conditions)
+        self.builder.add_spectral_data(d_window)
+
+        model = self.builder.create_pyomo_model(0.0, grid[-1], mutable_data=True)
+
+        # the initial conditions move with the window
+        def rule_init_conditions(m, k):
+            if k in m.mixture_components:
+                return m.Z[0.0, k] == m.init_conditions[k]
+            else:
+                return m.X[0.0, k] == m.init_conditions[k]
+
+        model.del_component('init_conditions_c')
+        model.init_conditions_c = Constraint(model.states, rule=rule_init_conditions)
+
+        estimator = ParameterEstimator(model)
+        nfe = self.nfe if self.nfe is not None else len(grid) - 1
+        estimator.apply_discretization('dae.collocation', nfe=nfe, ncp=self.ncp, scheme=self.scheme)
+
+        if self.results is not None:
+            t0 = float(self.spectra.index[0])
+            for name in _trajectories:
+                frame = getattr(self.results, name, None)
+                if isinstance(frame, pd.DataFrame) and not frame.empty and hasattr(model, name):
+                    shifted = frame.copy()
+                    shifted.index = [round(t - t0, 6) for t in frame.index]
+                    estimator.initialize_from_trajectory(name, shifted)
+            if isinstance(getattr(self.results, 'S', None), pd.DataFrame):
+                estimator.initialize_from_trajectory('S', self.results.S)
+            for k, v in self.results.P.items():
+                model.P[k].value = v
+
+        # the multipliers of each solve are kept for the next one
+        model.dual = Suffix(direction=Suffix.IMPORT_EXPORT)
+        model.ipopt_zL_out = Suffix(direction=Suffix.IMPORT)
+        model.ipopt_zU_out = Suffix(direction=Suffix.IMPORT)
+        model.ipopt_zL_in = Suffix(direction=Suffix.EXPORT)
+        model.ipopt_zU_in = Suffix(direction=Suffix.EXPORT)
+
+        self._estimator = estimator
+        self._grid = grid
+
+    def _shift(self, delta):
+        """Shifts the primal values and the multipliers of the model by the step
+        of the window, so that the next solve starts from the last estimate."""
+        estimator = self._estimator
+        m = estimator.model
+        for name in _trajectories:
+            frame = getattr(self.results, name, None)
+            if isinstance(frame, pd.DataFrame) and not frame.empty and hasattr(m, name):
+                shifted = frame.copy()
+                shifted.index = [round(t - self._t0 - delta, 6) for t in frame.index]
+                estimator.initialize_from_trajectory(name, shifted)
+
+        # run_opt(warmstart=True) copies the bound multipliers out -> in before the solve
+        times = set(round(t, 6) for t in m.alltime)
+        for suffix in [m.dual, m.ipopt_zL_out, m.ipopt_zU_out]:
+            _shift_suffix(suffix, delta, times)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Tools for running independent solves of a KIPET model in parallel worker
+processes.
+
+Pyomo models built with rules (closures) cannot be pickled, so the model is
+not sent to the workers. Instead it is placed in a module level variable
+before the worker processes are forked and each worker works on its own copy.
+Only the tasks and the results (plain python objects or numpy arrays) are
+passed between the processes.
+"""
+import multiprocessing
+import os
+
+#=============================================================================
+#-----------------------------PARALLEL TOOLS----------------------------------
+#=============================================================================
+
+_shared_object = None
+
+def _call_with_shared_object(args):
+    """Worker side wrapper that passes the shared object to the function."""
+    func, task = args
+    return func(_shared_object, task)
+
+def default_number_of_workers():
+    """ Returns the number of workers used if none is given (the number of
+        available cores).
+
+        Returns:
+            n_workers (int): number of workers
+
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def parallel_map(func, tasks, n_workers=None, shared=None):
+    """ Evaluates func(shared, task) for every task using forked worker
+        processes.
+
+        The shared object (usually a pyomo model) is inherited by the workers
+        through fork and is never pickled. Changes made to it by the workers
+        are not seen by the parent process, so anything needed afterwards has
+        to be returned. If fork is not available on the platform, or only one
+        worker is requested, the tasks are evaluated serially in this process.
+
+        Args:
+            func (callable): module level function with signature
+                func(shared, task)
+
+            tasks (list): the tasks (must be picklable)
+
+            n_workers (int, optional): number of worker processes (defaults to
+                the number of available cores)
+
+            shared (object, optional): object passed to func in every worker
+
+        Returns:
+            results (list): the results of func in the order of the tasks
+
+    """
+    global _shared_object
+
+    tasks = list(tasks)
+    if n_workers is None:
+        n_workers = default_number_of_workers()
+    n_workers = max(1, min(n_workers, len(tasks)))
+
+    if n_workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return [func(shared, task) for task in tasks]
+
+    _shared_object = shared
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(n_workers) as pool:
+            results = pool.map(_call_with_shared_object, [(func, task) for task in tasks], chunksize=1)
+    finally:
+        _shared_object = None
+
+    return results
+
+def parallel_imap(func, tasks, n_workers=None, shared=None):
+    """ Evaluates func(shared, task) for every task using forked worker
+        processes, like parallel_map, but yields the results as soon as they
+        are finished (in any order). Closing the generator (or breaking out of
+        a loop over it and closing it) terminates the workers, so the caller
+        can stop early; the tasks not started yet are never evaluated.
+
+        Args:
+            func (callable): module level function with signature
+                func(shared, task)
+
+            tasks (list): the tasks (must be picklable)
+
+            n_workers (int, optional): number of worker processes (defaults to
+                the number of available cores)
+
+            shared (object, optional): object passed to func in every worker
+
+        Yields:
+            result: the result of func for one of the tasks
+
+    """
+    global _shared_object
+
+    tasks = list(tasks)
+    if n_workers is None:
+        n_workers = default_number_of_workers()
+    n_workers = max(1, min(n_workers, len(tasks)))
+
+    if n_workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for task in tasks:
+            yield func(shared, task)
+        return
+
+    _shared_object = shared
+    try:
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(n_workers) as pool:
+            for result in pool.imap_unordered(_call_with_shared_object, [(func, task) for task in tasks], chunksize=1):
+                yield result
+    finally:
+        _shared_object = None
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation tools for recording the wall time (and optionally the peak
+memory) of the different phases of a KIPET run.
+
+The phases are recorded by every active PhaseTimer. Code is instrumented with
+timed_phase, which can be used as a context manager or as a decorator, and
+with timed_solver, which splits a pyomo solve into writing the problem, the
+solver subprocess and reading/loading the results. If no PhaseTimer is active
+the instrumentation does nothing.
+
+Example:
+
+    with PhaseTimer() as timer:
+        model = builder.create_pyomo_model(0.0, 10.0)
+        ...
+    print(timer.to_json())
+"""
+import json
+import time
+import tracemalloc
+from contextlib import ContextDecorator
+
+#=============================================================================
+#------------------------------TIMING TOOLS-----------------------------------
+#=============================================================================
+
+_active_timers = []
+
+class PhaseTimer(object):
+    """Records the wall time and optionally the peak memory of the phases
+    executed while the timer is active.
+
+    Attributes:
+
+        track_memory (bool): also record the peak memory allocated by python
+            in each phase (uses tracemalloc, which slows down the run)
+
+        records (list): one dict per phase with the keys phase, depth,
+            wall_time and peak_memory (bytes, only if track_memory)
+
+    """
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.records = []
+        self._stack = []
+        self._started_tracemalloc = False
+        self._start_time = None
+        self._total_time = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def start(self):
+        """Activates the timer."""
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._start_time = time.perf_counter()
+        _active_timers.append(self)
+
+    def stop(self):
+        """Deactivates the timer."""
+        if self in _active_timers:
+            _active_timers.remove(self)
+        if self._start_time is not None:
+            self._total_time += time.perf_counter() - self._start_time
+            self._start_time = None
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _enter_phase(self, name):
+        entry = {'phase': name, 'start': time.perf_counter(), 'peak': 0, 'memory': 0}
+        if self.track_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            entry['memory'] = current
+        self._stack.append(entry)
+
+    def _exit_phase(self):
+        entry = self._stack.pop()
+        record = {'phase': entry['phase'],
+                  'depth': len(self._stack),
+                  'wall_time': time.perf_counter() - entry['start'],
+                  }
+        if self.track_memory and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], entry['peak'])
+            record['peak_memory'] = peak - entry['memory']
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+        self.records.append(record)
+
+    def totals(self):
+        """Returns the total wall time and the number of calls per phase.
+
+        Returns:
+            totals (dict): phase: {'wall_time': float, 'count': int}
+
+        """
+        totals = dict()
+        for record in self.records:
+            total = totals.setdefault(record['phase'], {'wall_time': 0.0, 'count': 0})
+            total['wall_time'] += record['wall_time']
+            total['count'] += 1
+            if 'peak_memory' in record:
+                total['peak_memory'] = max(total.get('peak_memory', 0), record['peak_memory'])
+        return totals
+
+    def to_dict(self):
+        """Returns the records as a dict.
+
+        Returns:
+            timing (dict): with the keys total_time, phases (the individual
+                records in the order they finished) and totals (per phase)
+
+        """
+        total_time = self._total_time
+        if self._start_time is not None:
+            total_time += time.perf_counter() - self._start_time
+        return {'total_time': total_time,
+                'phases': [dict(r) for r in self.records],
+                'totals': self.totals(),
+                }
+
+    def to_json(self, filename=None):
+        """Returns the records as a JSON string and optionally writes them to
+        a file.
+
+        Args:
+            filename (str, optional): name of the output file
+
+        Returns:
+            json_str (str): the records as JSON
+
+        """
+        json_str = json.dumps(self.to_dict(), indent=2)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(json_str)
+        return json_str
+
+class timed_phase(ContextDecorator):
+    """Records the enclosed code (or the decorated function) as a phase in
+    every active PhaseTimer.
+
+    Args:
+        name (str): the name of the phase
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self._timers = []
+
+    def __enter__(self):
+        timers = list(_active_timers)
+        self._timers.append(timers)
+        for timer in timers:
+            timer._enter_phase(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        for timer in self._timers.pop():
+            timer._exit_phase()
+        return False
+
+def timed_solver(opt):
+    """Instruments a pyomo solver (from SolverFactory) so that a solve is
+    recorded as the phases nl_write, solver and solution_read. The time for
+    loading the solution into the model is recorded as solution_load.
+
+    Args:
+        opt: the pyomo solver object
+
+    Returns:
+        opt: the same solver object
+
+    """
+    if getattr(opt, '_kipet_timed', False):
+        return opt
+
+    def wrap(method_name, phase_name):
+        method = getattr(opt, method_name, None)
+        if method is None:
+            return
+        def timed_method(*args, **kwds):
+            with timed_phase(phase_name):
+                return method(*args, **kwds)
+        setattr(opt, method_name, timed_method)
+
+    wrap('_presolve', 'nl_write')
+    wrap('_apply_solver', 'solver')
+    wrap('_postsolve', 'solution_read')
+
+    solve = opt.solve
+    def timed_solve(*args, **kwds):
+        if not _active_timers:
+            return solve(*args, **kwds)
+        with timed_phase('solve'):
+            start = time.perf_counter()
+            n_records = [len(t.records) for t in _active_timers]
+            results = solve(*args, **kwds)
+            for timer, n in zip(_active_timers, n_records):
+                inner = sum(r['wall_time'] for r in timer.records[n:] if r['depth'] == len(timer._stack))
+                timer.records.append({'phase': 'solution_load',
+                                      'depth': len(timer._stack),
+                                      'wall_time': max(0.0, time.perf_counter() - start - inner),
+                                      })
+        return results
+
+    opt.solve = timed_solve
+    opt._kipet_timed = True
+    return opt
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for KIPET.
+
+Synthetic spectral problems (a chain of first order reactions A0 -> A1 -> ...)
+are generated with data_tools.generate_random_absorbance_data and
+PyomoSimulator.run_sim for a given number of components, time points,
+wavelengths, finite elements, collocation points and experiments. The main
+pipelines are timed on these problems and the results are appended as JSON
+lines to a file, so that the scaling curves can be compared across commits.
+
+Only ipopt is required. The covariance in the parameter estimation is
+computed if ipopt_sens is available and skipped otherwise.
+
+Usage:
+
+    python benchmark_suite.py --sizes small medium --output benchmarks.jsonl
+    python benchmark_suite.py --pipelines simulation parameter_estimation
+    python benchmark_suite.py --compare benchmarks.jsonl
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import traceback
+
+import numpy as np
+from pyomo.environ import SolverFactory
+
+from kipet.library.TemplateBuilder import TemplateBuilder
+from kipet.library.PyomoSimulator import PyomoSimulator
+from kipet.library.ParameterEstimator import ParameterEstimator
+from kipet.library.VarianceEstimator import VarianceEstimator
+from kipet.library.MultipleExperimentsEstimator import MultipleExperimentsEstimator
+from kipet.library.data_tools import generate_random_absorbance_data
+from kipet.library.timing_tools import PhaseTimer
+
+PROBLEM_SIZES = {
+    'small': dict(n_components=3, n_times=50, n_wavelengths=50, nfe=50, ncp=3, n_experiments=2),
+    'medium': dict(n_components=4, n_times=100, n_wavelengths=150, nfe=100, ncp=3, n_experiments=4),
+    'large': dict(n_components=6, n_times=200, n_wavelengths=400, nfe=200, ncp=3, n_experiments=8),
+    }
+
+PIPELINES = ['simulation', 'variance_estimation', 'parameter_estimation', 'multiple_experiments']
+
+END_TIME = 10.0
+
+#=============================================================================
+#-------------------------SYNTHETIC PROBLEM GENERATOR-------------------------
+#=============================================================================
+
+def chain_reaction_builder(n_components, rate_constants, estimate=False):
+    """Builds the TemplateBuilder for the reaction chain A0 -> A1 -> ... with
+    first order kinetics.
+
+    Args:
+        n_components (int): number of components
+
+        rate_constants (dict): parameter name: value
+
+        estimate (bool): if True the parameters are free (bounded) for
+            estimation, otherwise they are fixed for simulation
+
+    Returns:
+        builder (TemplateBuilder): the template without data
+
+    """
+    components = [f'A{i}' for i in range(n_components)]
+    params = sorted(rate_constants.keys(), key=lambda k: int(k[1:]))
+
+    builder = TemplateBuilder()
+    builder.add_mixture_component({k: (1e-2 if i == 0 else 0.0) for i, k in enumerate(components)})
+
+    if estimate:
+        for p in params:
+            builder.add_parameter(p, init=0.8*rate_constants[p], bounds=(0.01, 10.0))
+    else:
+        builder.add_parameter(dict(rate_constants))
+
+    def rule_odes(m, t):
+        exprs = dict()
+        for i, k in enumerate(components):
+            exprs[k] = 0
+            if i > 0:
+                exprs[k] += m.P[params[i-1]]*m.Z[t, components[i-1]]
+            if i < n_components - 1:
+                exprs[k] -= m.P[params[i]]*m.Z[t, k]
+        return exprs
+
+    builder.set_odes_rule(rule_odes)
+    return builder
+
+def generate_problem(n_components=3, n_times=50, n_wavelengths=50, nfe=50, ncp=3, n_experiments=1, seed=0):
+    """Generates a synthetic spectral problem by simulating the reaction chain
+    with random absorbance profiles and adding noise.
+
+    Args:
+        n_components (int): number of components
+
+        n_times (int): number of measurement times
+
+        n_wavelengths (int): number of wavelengths
+
+        nfe (int): number of finite elements
+
+        ncp (int): number of collocation points
+
+        n_experiments (int): number of experiments (datasets with different
+            noise realizations)
+
+        seed (int): seed for the absorbances and the noise
+
+    Returns:
+        problem (dict): with the keys rate_constants, variances, datasets
+            (experiment name: D DataFrame), S, n_components, nfe and ncp
+
+    """
+    rate_constants = {f'k{i+1}': 2.0/(i + 1) for i in range(n_components - 1)}
+    variances = {f'A{i}': 1e-10 for i in range(n_components)}
+    variances['device'] = 1e-8
+
+    wl_span = np.linspace(200.0, 400.0, n_wavelengths)
+    S_frame = generate_random_absorbance_data(wl_span, {f'A{i}': 2 for i in range(n_components)}, seed=seed)
+
+    datasets = dict()
+    for e in range(n_experiments):
+        builder = chain_reaction_builder(n_components, rate_constants)
+        builder.add_absorption_data(S_frame)
+        builder.add_measurement_times([float(t) for t in np.linspace(0.0, END_TIME, n_times)])
+        model = builder.create_pyomo_model(0.0, END_TIME)
+
+        simulator = PyomoSimulator(model)
+        simulator.apply_discretization('dae.collocation', nfe=nfe, ncp=ncp, scheme='LAGRANGE-RADAU')
+        results = simulator.run_sim('ipopt', variances=variances, seed=seed + e)
+        datasets[f'Exp{e + 1}'] = results.D
+
+    return {'rate_constants': rate_constants,
+            'variances': variances,
+            'datasets': datasets,
+            'S': S_frame,
+            'n_components': n_components,
+            'nfe': nfe,
+            'ncp': ncp,
+            }
+
+#=============================================================================
+#---------------------------------PIPELINES-----------------------------------
+#=============================================================================
+
+def estimation_builder(problem, D_frame):
+    builder = chain_reaction_builder(problem['n_components'], problem['rate_constants'], estimate=True)
+    builder.add_spectral_data(D_frame)
+    return builder
+
+def run_variance_estimation(problem):
+    D_frame = problem['datasets']['Exp1']
+    model = estimation_builder(problem, D_frame).create_pyomo_model(0.0, END_TIME)
+    v_estimator = VarianceEstimator(model)
+    v_estimator.apply_discretization('dae.collocation', nfe=problem['nfe'], ncp=problem['ncp'], scheme='LAGRANGE-RADAU')
+    A_set = [l for i, l in enumerate(model.meas_lambdas) if (i % 4 == 0)]
+    return v_estimator.run_opt('ipopt', tee=False, tolerance=1e-5, max_iter=15, subset_lambdas=A_set)
+
+def run_parameter_estimation(problem):
+    D_frame = problem['datasets']['Exp1']
+    model = estimation_builder(problem, D_frame).create_pyomo_model(0.0, END_TIME)
+    p_estimator = ParameterEstimator(model)
+    p_estimator.apply_discretization('dae.collocation', nfe=problem['nfe'], ncp=problem['ncp'], scheme='LAGRANGE-RADAU')
+    if SolverFactory('ipopt_sens').available(exception_flag=False):
+        return p_estimator.run_opt('ipopt_sens', tee=False, variances=problem['variances'], covariance=True)
+    return p_estimator.run_opt('ipopt', tee=False, variances=problem['variances'])
+
+def run_multiple_experiments(problem):
+    experiments = sorted(problem['datasets'].keys())
+    builder = estimation_builder(problem, problem['datasets'][experiments[0]])
+    estimator = MultipleExperimentsEstimator(problem['datasets'])
+    return estimator.run_parameter_estimation(solver='ipopt',
+                                              builder=builder,
+                                              tee=False,
+                                              nfe=problem['nfe'],
+                                              ncp=problem['ncp'],
+                                              sigma_sq={e: dict(problem['variances']) for e in experiments},
+                                              start_time={e: 0.0 for e in experiments},
+                                              end_time={e: END_TIME for e in experiments},
+                                              )
+
+#=============================================================================
+#----------------------------BENCHMARK RUNNER---------------------------------
+#=============================================================================
+
+def current_commit():
+    """Returns the current git commit of the repository (or None)."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def time_pipeline(func, *args):
+    """Runs func(*args) with a PhaseTimer and returns the timing record."""
+    record = {'status': 'ok'}
+    with PhaseTimer() as timer:
+        try:
+            func(*args)
+        except Exception:
+            record['status'] = 'failed'
+            record['error'] = traceback.format_exc(limit=3)
+    timing = timer.to_dict()
+    record['wall_time'] = timing['total_time']
+    record['phases'] = timing['totals']
+    return record
+
+def run_benchmarks(sizes, pipelines, output, repeats=1, seed=0):
+    """Generates the problems and times the pipelines. Every run is appended
+    as one JSON line to output.
+
+    Args:
+        sizes (list): names of the problem sizes in PROBLEM_SIZES
+
+        pipelines (list): names of the pipelines in PIPELINES
+
+        output (str): the JSON lines file for the results
+
+        repeats (int): number of repetitions of every pipeline
+
+        seed (int): seed for the problem generator
+
+    Returns:
+        records (list): the benchmark records
+
+    """
+    commit = current_commit()
+    records = []
+
+    for size in sizes:
+        problem_size = PROBLEM_SIZES[size]
+        for repeat in range(repeats):
+            base = {'commit': commit,
+                    'timestamp': datetime.datetime.now().isoformat(),
+                    'size': size,
+                    'repeat': repeat,
+                    }
+            base.update(problem_size)
+
+            problem = dict()
+            def generate():
+                problem.update(generate_problem(seed=seed, **problem_size))
+
+            runs = [('simulation', generate)]
+            if 'variance_estimation' in pipelines:
+                runs.append(('variance_estimation', lambda: run_variance_estimation(problem)))
+            if 'parameter_estimation' in pipelines:
+                runs.append(('parameter_estimation', lambda: run_parameter_estimation(problem)))
+            if 'multiple_experiments' in pipelines:
+                runs.append(('multiple_experiments', lambda: run_multiple_experiments(problem)))
+
+            for name, func in runs:
+                print(f'Running benchmark {name} ({size}, repeat {repeat + 1}/{repeats})')
+                record = dict(base)
+                record['pipeline'] = name
+                record.update(time_pipeline(func))
+                print(f'\t{record["status"]}: {record["wall_time"]:.2f} s')
+                records.append(record)
+                with open(output, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                if name == 'simulation' and record['status'] != 'ok':
+                    print(record['error'])
+                    break
+
+    return records
+
+def compare_results(filename, commits=None):
+    """Prints the median wall time per problem size and pipeline for the
+    given commits (default: the last two commits in the file).
+
+    Args:
+        filename (str): the JSON lines file with the results
+
+        commits (list, optional): the commits to compare
+
+    Returns:
+        table (dict): (size, pipeline): {commit: median wall time}
+
+    """
+    with open(filename, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    if commits is None:
+        commits = []
+        for r in records:
+            if r['commit'] in commits:
+                commits.remove(r['commit'])
+            commits.append(r['commit'])
+        commits = commits[-2:]
+
+    table = dict()
+    for r in records:
+        if r['commit'] in commits and r['status'] == 'ok':
+            times = table.setdefault((r['size'], r['pipeline']), dict()).setdefault(r['commit'], [])
+            times.append(r['wall_time'])
+
+    print("{: >8} {: >22} ".format('size', 'pipeline') + ' '.join("{: >12}".format(str(c)) for c in commits) + "{: >10}".format('ratio'))
+    for (size, pipeline), times in sorted(table.items()):
+        medians = [float(np.median(times[c])) if c in times else np.nan for c in commits]
+        ratio = medians[-1]/medians[0] if len(medians) > 1 else np.nan
+        print("{: >8} {: >22} ".format(size, pipeline) + ' '.join("{: >12.3f}".format(m) for m in medians) + "{: >10.2f}".format(ratio))
+        table[(size, pipeline)] = dict(zip(commits, medians))
+
+    return table
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='KIPET benchmark suite')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=sorted(PROBLEM_SIZES.keys()))
+    parser.add_argument('--pipelines', nargs='+', default=PIPELINES, choices=PIPELINES)
+    parser.add_argument('--output', default='benchmark_results.jsonl')
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', default=None, help='compare the results in this file')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(args.compare)
+        sys.exit(0)
+
+    if not SolverFactory('ipopt').available(exception_flag=False):
+        print('ipopt is required to run the benchmarks')
+        sys.exit(1)
+
+    run_benchmarks(args.sizes, args.pipelines, args.output, repeats=args.repeats, seed=args.seed)